@@ -0,0 +1,176 @@
+"""
+Throughput and retry overhead of download-azure-artifact.py
+
+Every scenario starts a FakeAzureServer with a set of injected faults and
+downloads the artifact with download_file. The throughput, the time from
+every fault to the next successful response (time-to-recover), the extra
+wall time compared to the clean scenario (retry overhead) and the bytes
+that were sent but thrown away are reported. The "run" scenario calls
+run() with --base-url, including the build and artifact list requests.
+
+  clean     no faults
+  status    503, 429 and 503 before the body
+  reset     connections cut off in the middle of the body twice
+  slow      throttled to --rate MiB/s
+  no-range  Range requests are ignored and the connection is cut off once
+  run       run() with one reset
+  batch     run() with three artifacts matched by a glob and one reset
+
+Everything runs offline on 127.0.0.1.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+from fake_azure_server import FakeAzureServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# keyword arguments of FakeAzureServer for every scenario
+SCENARIOS = {
+  'clean': {},
+  'status': {'statuses': [503, 429, 503]},
+  'reset': {'resets': 2},
+  'slow': {},
+  'no-range': {'ranges': False, 'resets': 1},
+  'run': {'resets': 1},
+  'batch': {'resets': 1,
+            'artifact_names': ['phenix_regression', 'phenix_examples', 'phenix_data']},
+}
+
+# =============================================================================
+def load_download_module():
+  """Import download-azure-artifact.py, the name is not a module name."""
+  spec = importlib.util.spec_from_file_location(
+    'download_azure_artifact', os.path.join(SCRIPT_DIR, 'download-azure-artifact.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def run_scenario(download, name, size, work_dir, segments=1, rate=None):
+  """Download the artifact of one scenario and return the measurements."""
+  kwargs = dict(SCENARIOS[name])
+  if name == 'slow':
+    kwargs['rate'] = rate
+  local_filename = os.path.join(work_dir, f'{name}.zip')
+  output = StringIO()
+  with FakeAzureServer(artifact_size=size, **kwargs) as server:
+    local_filenames = {server.artifact_name: local_filename}
+    t0 = time.perf_counter()
+    with redirect_stdout(output):
+      if name in ('run', 'batch'):
+        argv = ['download-azure-artifact.py', '--base-url', server.base_url,
+                '--organization', 'cctbx', '--project', 'cctbx_project',
+                '--definitions', '4', '--segments', str(segments)]
+        if name == 'batch':
+          argv += ['--artifact-name', 'phenix_*', '--download-dir', work_dir]
+          local_filenames = {artifact: os.path.join(work_dir, f'{artifact}.zip')
+                             for artifact in server.artifacts}
+        else:
+          argv += ['--artifact-name', server.artifact_name,
+                   '--local-filename', local_filename,
+                   '--sha256', server.artifact_sha256]
+        with mock.patch.object(sys, 'argv', argv):
+          download.run()
+      else:
+        url = f'{server.base_url}/_download/{server.artifact_name}.zip'
+        download.download_file(url, local_filename, segments=segments,
+                               sha256=server.artifact_sha256)
+    elapsed = time.perf_counter() - t0
+    events = list(server.events)
+    recovery_times = server.recovery_times()
+    expected_sha256 = {artifact: hashlib.sha256(server.artifacts[artifact]).hexdigest()
+                       for artifact in local_filenames}
+    n_bytes = sum(len(server.artifacts[artifact]) for artifact in local_filenames)
+
+  sent = sum(event['bytes'] for event in events if event['path'].startswith('/_download/'))
+  result = {
+    'seconds': elapsed,
+    'bytes': n_bytes,
+    'mb_per_s': n_bytes / elapsed / 1024**2,
+    'requests': len(events),
+    'faults': sum(1 for event in events if event['fault'] is not None),
+    'recover_seconds': recovery_times,
+    'wasted_bytes': max(sent - n_bytes, 0),
+    'sha256_ok': all(download.file_sha256(filename) == expected_sha256[artifact]
+                     for artifact, filename in local_filenames.items()),
+  }
+  for filename in local_filenames.values():
+    os.remove(filename)
+  return result
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--size', type=float, default=64,
+                      help='The size of the artifact in MiB.')
+  parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                      help='Comma separated scenarios to run.')
+  parser.add_argument('--segments', type=int, default=1,
+                      help='The segments argument of download_file.')
+  parser.add_argument('--chunk-size', type=int, default=None,
+                      help='Override CHUNK_SIZE of the download script in bytes.')
+  parser.add_argument('--backoff-factor', type=float, default=0.1,
+                      help='Override BACKOFF_FACTOR of the download script, the '
+                           'default keeps the benchmark short.')
+  parser.add_argument('--rate', type=float, default=32,
+                      help='The rate of the slow scenario in MiB/s.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the results to this JSON file.')
+  namespace = parser.parse_args()
+
+  scenarios = namespace.scenarios.split(',')
+  for name in scenarios:
+    if name not in SCENARIOS:
+      sys.exit(f'Unknown scenario {name!r}, use one of {", ".join(SCENARIOS)}.')
+
+  download = load_download_module()
+  download.BACKOFF_FACTOR = namespace.backoff_factor
+  if namespace.chunk_size is not None:
+    download.CHUNK_SIZE = namespace.chunk_size
+  size = int(namespace.size * 1024 * 1024)
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for name in scenarios:
+      results[name] = run_scenario(download, name, size, tmp_dir,
+                                   segments=namespace.segments,
+                                   rate=namespace.rate * 1024 * 1024)
+
+  clean = results.get('clean')
+  print(f'{"scenario":<10} {"seconds":>8} {"MB/s":>8} {"requests":>8} {"faults":>6} '
+        f'{"recover":>8} {"overhead":>8} {"wasted MB":>9} {"sha256":>6}')
+  for name, result in results.items():
+    recover = max(result['recover_seconds'], default=0.0)
+    overhead = result['seconds'] - clean['seconds'] if clean is not None else float('nan')
+    result['overhead_seconds'] = overhead
+    print(f'{name:<10} {result["seconds"]:>8.3f} {result["mb_per_s"]:>8.1f} '
+          f'{result["requests"]:>8} {result["faults"]:>6} {recover:>8.3f} '
+          f'{overhead:>8.3f} {result["wasted_bytes"] / 1024**2:>9.1f} '
+          f'{"ok" if result["sha256_ok"] else "FAIL":>6}')
+
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump({
+        'parameters': {
+          'size': size,
+          'segments': namespace.segments,
+          'chunk_size': download.CHUNK_SIZE,
+          'backoff_factor': download.BACKOFF_FACTOR,
+          'rate': namespace.rate,
+        },
+        'results': results,
+      }, f, indent=2)
+
+  if not all(result['sha256_ok'] for result in results.values()):
+    sys.exit(1)
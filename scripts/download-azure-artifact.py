@@ -2,10 +2,24 @@
 Script for downloading the phenix_regression artifact
 """
 import argparse
+import fnmatch
+import hashlib
+import json
 import os
 import shutil
 import sys
+import threading
 import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+  import msvcrt
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -13,35 +27,202 @@ from urllib3.exceptions import ProtocolError, ReadTimeoutError
 from urllib3.util.retry import Retry
 
 # =============================================================================
+# the Azure DevOps REST API, a local server can be used for testing
+BASE_URL = 'https://dev.azure.com'
+
 # def construct_url(organization, pipelineId, project, run_id, api_version, artifactName):
-def construct_url(organization, project, run_id, api_version):
+def construct_url(organization, project, run_id, api_version, base_url=BASE_URL):
   # https://docs.microsoft.com/en-us/rest/api/azure/devops/pipelines/artifacts/get?view=azure-devops-rest-6.0
   # url = f'https://dev.azure.com/{organization}/{project}/_apis/pipelines/{pipelineId}/runs/{runId}/artifacts?artifactName={artifactName}&$expand=signedContent&api-version={api_version}'
 
   # https://docs.microsoft.com/en-us/rest/api/azure/devops/build/artifacts/list?view=azure-devops-rest-6.0
   # url = f'https://dev.azure.com/{organization}/{project}/_apis/build/builds/{buildId}/artifacts?artifactName={artifactName}&api-version=6.0'
-  url = f'https://dev.azure.com/{organization}/{project}/_apis/build/builds/{run_id}/artifacts?api-version={api_version}'
+  url = f'{base_url}/{organization}/{project}/_apis/build/builds/{run_id}/artifacts?api-version={api_version}'
   return url
 
-def get_run_id(organization, project, definitions, api_version):
+def get_run_id(organization, project, definitions, api_version, base_url=BASE_URL):
   # https://docs.microsoft.com/en-us/rest/api/azure/devops/build/builds/list?view=azure-devops-rest-6.0
   # https://dev.azure.com/{organization}/{project}/_apis/build/builds?definitions={definitions}&queues={queues}&buildNumber={buildNumber}&minTime={minTime}&maxTime={maxTime}&requestedFor={requestedFor}&reasonFilter={reasonFilter}&statusFilter={statusFilter}&resultFilter={resultFilter}&tagFilters={tagFilters}&properties={properties}&$top={$top}&continuationToken={continuationToken}&maxBuildsPerDefinition={maxBuildsPerDefinition}&deletedFilter={deletedFilter}&queryOrder={queryOrder}&branchName={branchName}&buildIds={buildIds}&repositoryId={repositoryId}&repositoryType={repositoryType}&api-version={api_version}
   # url = f'https://dev.azure.com/{organization}/{project}/_apis/build/builds?api-version=6.0'
-  url = f'https://dev.azure.com/{organization}/{project}/_apis/build/builds?definitions={definitions}&resultFilter=succeeded&statusFilter=completed&api-version={api_version}'
+  # only the newest successful build is needed, so no continuation token
+  url = f'{base_url}/{organization}/{project}/_apis/build/builds?definitions={definitions}&resultFilter=succeeded&statusFilter=completed&queryOrder=finishTimeDescending&$top=1&api-version={api_version}'
   return url
 
 # =============================================================================
+# size of the blocks read from the response and written to disk
+CHUNK_SIZE = 1024 * 1024
+
+# segments smaller than this are not worth a separate connection
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# factor of the exponential backoff between retries, for both the urllib3
+# Retry and the streaming retries
+BACKOFF_FACTOR = 1
+
+# errors raised while reading a response body that are retried
+STREAMING_ERRORS = (
+  ProtocolError,
+  ReadTimeoutError,
+  requests.exceptions.ChunkedEncodingError,
+)
+
+def make_session(max_retries=5, pool_size=10):
+  """Create a ``requests.Session`` that retries on transient HTTP errors.
+
+  Connections are kept alive and reused by all requests to the same host.
+
+  Parameters
+  ----------
+  max_retries : int, optional
+      Maximum number of retries for retryable statuses (429, 500, 502,
+      503, 504) and connection errors. Default is 5.
+  pool_size : int, optional
+      Maximum number of pooled connections per host, this should be at
+      least the number of concurrent requests. Default is 10.
+
+  Returns
+  -------
+  requests.Session
+  """
+  retry_strategy = Retry(
+    total=max_retries,
+    backoff_factor=BACKOFF_FACTOR,
+    status_forcelist=[429, 500, 502, 503, 504],
+  )
+  adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size,
+                        pool_maxsize=pool_size)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+def get_range_support(session, url):
+  """Return the total size of the resource if the server honors Range
+  requests, otherwise None.
+
+  A single-byte range is requested, so nothing else is transferred when
+  the server supports ranges. Servers that ignore the Range header reply
+  with 200 and the connection is closed without reading the body.
+  """
+  with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+    if r.status_code == 416:  # empty file
+      return None
+    r.raise_for_status()
+    content_range = r.headers.get('Content-Range', '')
+    if r.status_code != 206 or '/' not in content_range:
+      return None
+    total = content_range.rsplit('/', 1)[-1].strip()
+    if not total.isdigit():
+      return None
+    return int(total)
+
+def _write_stream(r, f, chunk_size=None, progress=None, hasher=None):
+  """Copy the raw response body into an open file and return the number
+  of bytes written. Bytes already written stay on disk if reading fails,
+  and hasher is updated with exactly the written bytes."""
+  chunk_size = chunk_size or CHUNK_SIZE
+  n_bytes = 0
+  while True:
+    chunk = r.raw.read(chunk_size)
+    if not chunk:
+      break
+    f.write(chunk)
+    if hasher is not None:
+      hasher.update(chunk)
+    n_bytes += len(chunk)
+    if progress is not None:
+      progress.add(len(chunk))
+  return n_bytes
+
+def _retry_or_raise(e, attempt, max_retries):
+  if attempt >= max_retries:
+    raise e
+  backoff = BACKOFF_FACTOR * 2 ** attempt if attempt > 0 else 0
+  print(f'{type(e).__name__} on attempt {attempt + 1}/{max_retries + 1}: {e}. Retrying in {backoff}s...')
+  time.sleep(backoff)
+
+class DownloadProgress():
+  """Aggregate progress and throughput of concurrent downloads.
+
+  ``add`` is called by the download threads for every chunk, and a line
+  with the bytes transferred so far is printed at most every ``interval``
+  seconds.
+  """
+  def __init__(self, interval=5.0):
+    self.interval = interval
+    self.n_bytes = 0
+    self.start_time = time.perf_counter()
+    self._last_print = self.start_time
+    self._lock = threading.Lock()
+
+  def add(self, n_bytes):
+    with self._lock:
+      self.n_bytes += n_bytes
+      now = time.perf_counter()
+      if now - self._last_print < self.interval:
+        return
+      self._last_print = now
+      print(f'Downloaded {self.n_bytes / 1024**2:.1f} MB ({self.rate:.1f} MB/s)')
+
+  def log(self, text):
+    """Print a line from a download thread."""
+    with self._lock:
+      print(text)
+
+  @property
+  def elapsed(self):
+    return time.perf_counter() - self.start_time
+
+  @property
+  def rate(self):
+    elapsed = self.elapsed
+    return self.n_bytes / elapsed / 1024**2 if elapsed > 0 else 0.0
+
+def _download_segment(session, url, filename, start, end, max_retries, progress=None):
+  """Download bytes start..end (inclusive) of url into the same offsets of
+  filename, resuming from the last written byte after a streaming error."""
+  offset = start
+  for attempt in range(max_retries + 1):
+    try:
+      headers = {'Range': f'bytes={offset}-{end}'}
+      with session.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+          raise requests.exceptions.HTTPError(
+            f'Range request for bytes {offset}-{end} returned {r.status_code}',
+            response=r)
+        with open(filename, 'r+b') as f:
+          f.seek(offset)
+          try:
+            _write_stream(r, f, progress=progress)
+          finally:
+            offset = f.tell()
+      if offset != end + 1:
+        raise ProtocolError(
+          f'Segment ended at byte {offset}, expected {end + 1}')
+      return
+    except STREAMING_ERRORS as e:
+      _retry_or_raise(e, attempt, max_retries)
+
 # https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests
 # modified to use a specific filename
-def download_file(url, local_filename, max_retries=5):
+def download_file(url, local_filename, max_retries=5, segments=1, session=None,
+                  progress=None, sha256=None):
   """Stream-download a URL to a local file with retry on transient failures.
 
   Two layered retry mechanisms are used. ``urllib3.Retry`` on the
   ``HTTPAdapter`` retries the request on retryable HTTP statuses
   (429, 500, 502, 503, 504) and connection errors during request
-  setup. An outer loop with exponential backoff retries the whole
-  download on streaming-time errors raised while reading the
-  response body. The two retry counters do not share state.
+  setup. An outer loop with exponential backoff retries the download
+  on streaming-time errors raised while reading the response body.
+  The two retry counters do not share state.
+
+  If the server honors HTTP Range requests, a retry resumes from the
+  bytes already written instead of starting again from byte 0, and
+  with ``segments > 1`` large files are split into that many byte
+  ranges that are downloaded concurrently, each with its own retry
+  loop. Servers without Range support get a single stream that is
+  restarted from the beginning after an error.
 
   The download is written to ``<local_filename>.part`` and atomically
   renamed to ``local_filename`` on success, so a partial file is never
@@ -57,14 +238,35 @@ def download_file(url, local_filename, max_retries=5):
   max_retries : int, optional
       Maximum number of retries for both the inner ``urllib3.Retry``
       and the outer streaming loop. Default is 5.
+  segments : int, optional
+      Number of concurrent Range requests for large files. Default is
+      1, a single connection.
+  session : requests.Session, optional
+      Session for the requests, e.g. ``AzureClient.session``. Default is
+      None, a new session from ``make_session(max_retries)``.
+  progress : DownloadProgress, optional
+      Shared progress of several concurrent downloads. Default is None.
+  sha256 : str, optional
+      Expected hex digest of the file. Default is None, no check.
+
+  Returns
+  -------
+  str or None
+      The sha256 hex digest of the file. A single stream is hashed while
+      it is written, also across resumed requests. Segments arrive out of
+      order, so a segmented download is only hashed afterwards if sha256
+      is given, and None is returned otherwise.
 
   Raises
   ------
   requests.exceptions.HTTPError
-      If ``raise_for_status()`` fires on a non-retryable HTTP status.
+      If ``raise_for_status()`` fires on a non-retryable HTTP status,
+      or a segment request is not answered with a partial response.
   requests.exceptions.RetryError
       If the inner ``urllib3.Retry`` exhausts on a retryable status
       in ``status_forcelist``.
+  ValueError
+      If the digest does not match sha256, the partial file is removed.
   requests.exceptions.ConnectionError
       If connection setup repeatedly fails past the inner retry
       budget (also covers ``ConnectTimeout`` and ``SSLError`` as
@@ -79,34 +281,478 @@ def download_file(url, local_filename, max_retries=5):
       If the local filesystem cannot be written (e.g. ENOSPC,
       permission error, or a failed rename).
   """
-  retry_strategy = Retry(
-    total=max_retries,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
-  )
-  adapter = HTTPAdapter(max_retries=retry_strategy)
-  session = requests.Session()
-  session.mount('https://', adapter)
-  session.mount('http://', adapter)
+  if session is None:
+    session = make_session(max_retries, pool_size=max(segments, 10))
   tmp_filename = local_filename + '.part'
+
+  # split large files into concurrent segments
+  total = get_range_support(session, url)
+  if segments > 1 and total is not None and total >= 2 * MIN_SEGMENT_SIZE:
+    segments = min(segments, total // MIN_SEGMENT_SIZE)
+    with open(tmp_filename, 'wb') as f:
+      f.truncate(total)
+    bounds = [total * i // segments for i in range(segments + 1)]
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+      futures = [
+        executor.submit(_download_segment, session, url, tmp_filename,
+                        bounds[i], bounds[i + 1] - 1, max_retries, progress)
+        for i in range(segments)]
+      for future in futures:
+        future.result()
+    digest = None
+    if sha256 is not None:
+      digest = file_sha256(tmp_filename)
+      _check_digest(url, tmp_filename, digest, sha256)
+    os.replace(tmp_filename, local_filename)
+    return digest
+
+  # single stream, resumed with a Range request after an error
+  offset = 0
+  hasher = hashlib.sha256()
   for attempt in range(max_retries + 1):
     try:
-      with session.get(url, stream=True) as r:
+      if total is not None and offset == total:
+        break
+      headers = {}
+      if offset > 0 and total is not None:
+        headers['Range'] = f'bytes={offset}-'
+      with session.get(url, headers=headers, stream=True) as r:
         r.raise_for_status()
-        with open(tmp_filename, 'wb') as f:
-          shutil.copyfileobj(r.raw, f)
-      os.replace(tmp_filename, local_filename)
-      return
-    except (
-      ProtocolError,
-      ReadTimeoutError,
-      requests.exceptions.ChunkedEncodingError,
-    ) as e:
-      if attempt >= max_retries:
-        raise
-      backoff = 2 ** attempt if attempt > 0 else 0
-      print(f'{type(e).__name__} on attempt {attempt + 1}/{max_retries + 1}: {e}. Retrying in {backoff}s...')
-      time.sleep(backoff)
+        mode = 'ab' if r.status_code == 206 else 'wb'
+        if mode == 'wb':
+          hasher = hashlib.sha256()
+        with open(tmp_filename, mode) as f:
+          try:
+            _write_stream(r, f, progress=progress, hasher=hasher)
+          finally:
+            offset = f.tell()
+      if total is not None and offset != total:
+        raise ProtocolError(f'Download ended at byte {offset}, expected {total}')
+      break
+    except STREAMING_ERRORS as e:
+      _retry_or_raise(e, attempt, max_retries)
+  digest = hasher.hexdigest()
+  if sha256 is not None:
+    _check_digest(url, tmp_filename, digest, sha256)
+  os.replace(tmp_filename, local_filename)
+  return digest
+
+def _check_digest(url, filename, digest, expected):
+  if digest != expected.lower():
+    os.remove(filename)
+    raise ValueError(f'{url} has sha256 {digest}, expected {expected}.')
+
+# =============================================================================
+class AzureClient():
+  """Client for the metadata requests to the Azure DevOps REST API.
+
+  All requests share one pooled session with retries and keep-alive, so
+  the build list, the artifact list and the artifact download reuse the
+  same connections. With a cache directory, JSON responses are stored
+  with their ETag and repeated requests are sent with ``If-None-Match``,
+  so an unchanged listing is answered with a 304 without a body.
+
+  Parameters
+  ----------
+  access_token : str, optional
+      Azure Pipelines access token, sent with the metadata requests.
+      Default is None, anonymous access.
+  cache_dir : str, optional
+      Directory for the cached responses, created if necessary. Default
+      is None, no caching.
+  max_retries : int, optional
+      See ``make_session``. Default is 5.
+  pool_size : int, optional
+      See ``make_session``. Default is 10.
+  """
+  def __init__(self, access_token=None, cache_dir=None, max_retries=5, pool_size=10):
+    self.session = make_session(max_retries, pool_size=pool_size)
+    self.auth = ('user', access_token) if access_token is not None else None
+    self.cache_dir = cache_dir
+    self.cache_hits = 0
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    self.session.close()
+
+  def _cache_file(self, url):
+    key = hashlib.sha256(url.encode('utf8')).hexdigest()
+    return os.path.join(self.cache_dir, key + '.json')
+
+  def _read_cache(self, url):
+    if self.cache_dir is None:
+      return None
+    try:
+      with open(self._cache_file(url)) as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if entry.get('url') != url:
+      return None
+    return entry
+
+  def _write_cache(self, url, etag, body):
+    tmp_file = self._cache_file(url) + f'.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+      json.dump({'url': url, 'etag': etag, 'body': body}, f)
+    os.replace(tmp_file, self._cache_file(url))
+
+  def get_json(self, url):
+    """Return the decoded JSON response of url, or exit if the request
+    does not succeed."""
+    print(url)
+    entry = self._read_cache(url)
+    headers = {}
+    if entry is not None:
+      headers['If-None-Match'] = entry['etag']
+    r = self.session.get(url, headers=headers, auth=self.auth)
+    if r.status_code == 304 and entry is not None:
+      print(f'{r.status_code} (cached response)')
+      self.cache_hits += 1
+      return entry['body']
+    print(r.status_code)
+    if r.status_code != 200:
+      print('URL did not succeed')
+      print(r.text)
+      sys.exit(1)
+    body = r.json()
+    etag = r.headers.get('ETag')
+    if self.cache_dir is not None and etag is not None:
+      self._write_cache(url, etag, body)
+    return body
+
+# -----------------------------------------------------------------------------
+def get_latest_run_id(client, organization, project, definitions, api_version,
+                      base_url=BASE_URL):
+  """Return the id of the newest successful build of a definition."""
+  url = get_run_id(
+    organization=organization,
+    project=project,
+    definitions=definitions,
+    api_version=api_version,
+    base_url=base_url
+  )
+  j = client.get_json(url)
+  return j['value'][0]['id']
+
+def is_pattern(name):
+  return any(c in name for c in '*?[')
+
+def get_artifact_urls(client, organization, project, run_id, artifact_names,
+                      api_version, base_url=BASE_URL):
+  """Return the download URLs of the artifacts of a run, keyed by name.
+
+  The artifact names may be glob patterns. A ValueError is raised if a
+  name or pattern does not match any artifact of the run.
+  """
+  url = construct_url(
+    organization=organization,
+    project=project,
+    run_id=run_id,
+    api_version=api_version,
+    base_url=base_url
+  )
+  j = client.get_json(url)
+  available = {value['name']: value['resource']['downloadUrl'] for value in j['value']}
+  urls = {}
+  for pattern in artifact_names:
+    matches = fnmatch.filter(available, pattern)
+    if not matches:
+      raise ValueError(f'No artifact of run {run_id} matches {pattern}, the '
+                       f'artifacts are {", ".join(sorted(available))}.')
+    for name in matches:
+      urls[name] = available[name]
+  for name, raw_url in urls.items():
+    print(f'{name}: {raw_url}')
+  return urls
+
+# =============================================================================
+def _safe_destination(root, name):
+  """Return the extraction path of a zip member, or raise ValueError if
+  the member would be written outside of root."""
+  normalized = name.replace('\\', '/')
+  parts = normalized.split('/')
+  if normalized.startswith('/') or '..' in parts \
+    or (len(parts[0]) == 2 and parts[0][1] == ':'):
+    raise ValueError(f'Unsafe path in archive: {name}')
+  dest = os.path.realpath(os.path.join(root, *parts))
+  if os.path.commonpath([root, dest]) != root:
+    raise ValueError(f'Unsafe path in archive: {name}')
+  return dest
+
+def extract_archive(filename, extract_to, max_workers=None):
+  """Extract a zip archive with a pool of workers.
+
+  Every worker reads from its own handle on the archive, so members are
+  decompressed and written concurrently. Member names are validated
+  before anything is written and absolute paths, drive letters and
+  ``..`` components are rejected. Unix permission bits stored in the
+  archive are restored.
+
+  Parameters
+  ----------
+  filename : str
+      The zip archive.
+  extract_to : str
+      The directory for the extracted files, created if necessary.
+  max_workers : int, optional
+      Number of workers. Default is None, the ``ThreadPoolExecutor``
+      default.
+
+  Raises
+  ------
+  ValueError
+      If a member would be extracted outside of ``extract_to``.
+
+  Returns
+  -------
+  int
+      The number of extracted bytes.
+  """
+  os.makedirs(extract_to, exist_ok=True)
+  root = os.path.realpath(extract_to)
+
+  t0 = time.perf_counter()
+  with zipfile.ZipFile(filename) as zf:
+    members = zf.infolist()
+
+  # validate all names and create directories first
+  files = []
+  for info in members:
+    dest = _safe_destination(root, info.filename)
+    if info.is_dir():
+      os.makedirs(dest, exist_ok=True)
+    else:
+      os.makedirs(os.path.dirname(dest), exist_ok=True)
+      files.append((info, dest))
+
+  local = threading.local()
+  handles = []
+
+  def extract_one(item):
+    info, dest = item
+    if not hasattr(local, 'zf'):
+      local.zf = zipfile.ZipFile(filename)
+      handles.append(local.zf)
+    with local.zf.open(info) as src, open(dest, 'wb') as dst:
+      shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    mode = (info.external_attr >> 16) & 0o777
+    if mode:
+      os.chmod(dest, mode)
+    return info.file_size
+
+  # larger members first for a better balance between workers
+  files.sort(key=lambda item: item[0].file_size, reverse=True)
+  try:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      n_bytes = sum(executor.map(extract_one, files))
+  finally:
+    for zf in handles:
+      zf.close()
+
+  elapsed = time.perf_counter() - t0
+  rate = n_bytes / elapsed / 1024**2 if elapsed > 0 else 0.0
+  print(f'Extracted {len(files)} files ({n_bytes / 1024**2:.1f} MB) to '
+        f'{extract_to} in {elapsed:.1f}s ({rate:.1f} MB/s)')
+  return n_bytes
+
+# =============================================================================
+def file_sha256(filename, chunk_size=CHUNK_SIZE):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def link_or_copy(source, dest):
+  """Atomically publish source at dest as a hardlink, or as a copy if
+  a hardlink is not possible (e.g. different filesystems). Returns the
+  method used."""
+  if os.path.exists(dest) and os.path.samefile(source, dest):
+    return 'hardlink'
+  tmp_dest = dest + '.part'
+  if os.path.lexists(tmp_dest):
+    os.remove(tmp_dest)
+  try:
+    os.link(source, tmp_dest)
+    method = 'hardlink'
+  except OSError:
+    shutil.copyfile(source, tmp_dest)
+    method = 'copy'
+  os.replace(tmp_dest, dest)
+  return method
+
+@contextmanager
+def file_lock(filename):
+  """Hold an exclusive lock on filename, created if necessary. The lock
+  is taken on a new file descriptor, so it excludes other processes and
+  other threads of the same process."""
+  with open(filename, 'a+b') as f:
+    if fcntl is not None:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+      # LK_LOCK gives up after 10 attempts of one second
+      while True:
+        try:
+          f.seek(0)
+          msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except OSError:
+          pass
+    try:
+      yield
+    finally:
+      if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+      else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class ArtifactCache():
+  """On-disk cache of downloaded artifacts.
+
+  Artifact contents are stored once under ``objects/<sha256>`` and
+  looked up through small index entries under ``index/<key>.json``,
+  where the key is derived from the organization, project, run id and
+  artifact name. An entry is only used if the stored object still has
+  the recorded size and checksum. The least recently used entries are
+  evicted when the objects exceed ``max_size`` bytes.
+
+  Objects and index entries are only changed while holding the lock file
+  ``index.lock``, so an object stored by one process or thread is never
+  evicted by another before its index entry exists.
+
+  Parameters
+  ----------
+  cache_dir : str
+      The root directory of the cache, created if necessary.
+  max_size : int, optional
+      Maximum total size of the cached objects in bytes. Default is
+      None, no limit.
+  """
+  def __init__(self, cache_dir, max_size=None):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.index_dir = os.path.join(cache_dir, 'index')
+    self.objects_dir = os.path.join(cache_dir, 'objects')
+    self.lock_file = os.path.join(cache_dir, 'index.lock')
+    os.makedirs(self.index_dir, exist_ok=True)
+    os.makedirs(self.objects_dir, exist_ok=True)
+
+  @staticmethod
+  def make_key(organization, project, run_id, artifact_name):
+    key = json.dumps([organization, project, str(run_id), artifact_name])
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+  def _index_file(self, key):
+    return os.path.join(self.index_dir, key + '.json')
+
+  def _object_file(self, sha256):
+    return os.path.join(self.objects_dir, sha256)
+
+  def _read_entry(self, key):
+    try:
+      with open(self._index_file(key)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def _write_entry(self, key, entry):
+    tmp_file = self._index_file(key) + f'.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+      json.dump(entry, f)
+    os.replace(tmp_file, self._index_file(key))
+
+  def _remove_entry(self, key):
+    if os.path.exists(self._index_file(key)):
+      os.remove(self._index_file(key))
+
+  def fetch(self, key, local_filename):
+    """Publish the cached artifact for key at local_filename.
+
+    Returns the method used ("hardlink" or "copy") on a hit and None on
+    a miss. Entries whose object is missing or fails validation are
+    dropped.
+    """
+    with file_lock(self.lock_file):
+      return self._fetch(key, local_filename)
+
+  def _fetch(self, key, local_filename):
+    entry = self._read_entry(key)
+    if entry is None:
+      return None
+    object_file = self._object_file(entry['sha256'])
+    if not os.path.exists(object_file) \
+      or os.path.getsize(object_file) != entry['size'] \
+      or file_sha256(object_file) != entry['sha256']:
+      print(f'Dropping invalid cache entry for {entry["artifact_name"]}')
+      self._remove_entry(key)
+      if os.path.exists(object_file):
+        os.remove(object_file)
+      return None
+    method = link_or_copy(object_file, local_filename)
+    entry['last_used'] = time.time()
+    self._write_entry(key, entry)
+    return method
+
+  def store(self, key, filename, sha256=None, **metadata):
+    """Add the file to the cache under key, then evict old entries. The
+    file is hashed unless its sha256 is given, e.g. from download_file."""
+    if sha256 is None:
+      sha256 = file_sha256(filename)
+    object_file = self._object_file(sha256)
+    # the object and its index entry are added in one step for evict
+    with file_lock(self.lock_file):
+      if not os.path.exists(object_file):
+        tmp_file = object_file + f'.{os.getpid()}'
+        try:
+          os.link(filename, tmp_file)
+        except OSError:
+          shutil.copyfile(filename, tmp_file)
+        os.replace(tmp_file, object_file)
+      entry = dict(metadata)
+      entry.update(sha256=sha256, size=os.path.getsize(object_file),
+                   last_used=time.time())
+      self._write_entry(key, entry)
+      self._evict()
+
+  def evict(self):
+    """Remove least recently used entries until the objects fit in
+    max_size, and remove objects that are no longer referenced."""
+    with file_lock(self.lock_file):
+      self._evict()
+
+  def _evict(self):
+    entries = []
+    for name in os.listdir(self.index_dir):
+      if name.endswith('.json'):
+        key = name[:-len('.json')]
+        entry = self._read_entry(key)
+        if entry is not None:
+          entries.append((entry['last_used'], key, entry))
+    entries.sort()
+
+    sizes = {}
+    for _, _, entry in entries:
+      sizes[entry['sha256']] = entry['size']
+    total = sum(sizes.values())
+    while self.max_size is not None and total > self.max_size and entries:
+      _, key, entry = entries.pop(0)
+      self._remove_entry(key)
+      if entry['sha256'] not in [e['sha256'] for _, _, e in entries]:
+        total -= sizes.pop(entry['sha256'])
+        print(f'Evicted {entry["artifact_name"]} (run {entry["run_id"]}) from cache')
+
+    for name in os.listdir(self.objects_dir):
+      if name not in sizes and '.' not in name:
+        os.remove(self._object_file(name))
 
 # =============================================================================
 def run():
@@ -120,14 +766,39 @@ def run():
     help='ID of the run of that pipeline, also called the build id')
   parser.add_argument('--definitions', default=None, type=int,
     help='Build definition used if run-id is not available')
-  parser.add_argument('--artifact-name', default=None, type=str,
-    help='The artifact name to download')
+  parser.add_argument('--artifact-name', default=None, type=str, nargs='+',
+    help='The artifact names to download, glob patterns are matched against '
+         'the artifacts of the run')
   parser.add_argument('--local-filename', default='artifact.zip', type=str,
-    help='The local filename for the downloaded artifact')
+    help='The local filename for the downloaded artifact if a single name '
+         'without wildcards is given')
+  parser.add_argument('--download-dir', default='.', type=str,
+    help='Directory for the downloaded <artifact name>.zip files if several '
+         'artifacts are requested')
+  parser.add_argument('--jobs', default=4, type=int,
+    help='Number of artifacts downloaded concurrently')
+  parser.add_argument('--segments', default=1, type=int,
+    help='Number of concurrent ranged connections for large artifacts')
+  parser.add_argument('--sha256', default=None, type=str, nargs='+',
+    help='Expected sha256 of the artifact, or NAME=SHA256 for each of '
+         'several artifacts')
+  parser.add_argument('--extract-to', default=None, type=str,
+    help='Extract the artifact into this directory and remove the archive')
+  parser.add_argument('--extract-workers', default=None, type=int,
+    help='Number of parallel workers for extracting the artifact')
+  parser.add_argument('--cache-dir', default=None, type=str,
+    help='Directory for caching artifacts between invocations')
+  parser.add_argument('--cache-max-size', default=20.0, type=float,
+    help='Maximum size of the artifact cache in GB')
+  parser.add_argument('--api-cache-dir', default=None, type=str,
+    help='Directory for caching build and artifact listings with their ETag, '
+         'the default is the api subdirectory of --cache-dir')
   parser.add_argument('--api-version', default='7.1', type=str,
     help='Version of the API to use')
   parser.add_argument('--accessToken', default=None, type=str,
     help='Azure Pipelines access token for accessing the resource')
+  parser.add_argument('--base-url', default=BASE_URL, type=str,
+    help='Base URL of the Azure DevOps API, e.g. a local server for testing')
 
   # show help if no arguments are provided
   if len(sys.argv) == 1:
@@ -136,62 +807,117 @@ def run():
 
   namespace = parser.parse_args()
 
+  # one pooled session for the metadata requests and the download
+  api_cache_dir = namespace.api_cache_dir
+  if api_cache_dir is None and namespace.cache_dir is not None:
+    api_cache_dir = os.path.join(namespace.cache_dir, 'api')
+  client = AzureClient(access_token=namespace.accessToken, cache_dir=api_cache_dir,
+                       pool_size=max(namespace.jobs * namespace.segments, 10))
+
   # get latest runID for "Update data cache" pipeline
   run_id = namespace.run_id
   if run_id is None:
     if namespace.definitions is None:
       raise ValueError('A definitions id is needed if run-id is not available.')
-    url = get_run_id(
+    run_id = get_latest_run_id(
+      client,
       organization=namespace.organization,
       project=namespace.project,
       definitions=namespace.definitions,
-      api_version=namespace.api_version
+      api_version=namespace.api_version,
+      base_url=namespace.base_url
     )
-    print(url)
-    if namespace.accessToken is not None:
-      r = requests.get(url, auth=('user', namespace.accessToken))
-    else:
-      r = requests.get(url)
-    print(r.status_code)
-    run_id = None
-    if r.status_code == 200:
-      j = r.json()
-      run_id = j['value'][0]['id']
-    else:
-      print('URL did not succeed')
-      print(r.text)
-      sys.exit(1)
 
-  # get URL for downloading artifact
-  url = construct_url(
-    organization=namespace.organization,
-    project=namespace.project,
-    run_id=run_id,
-    api_version=namespace.api_version
-  )
-  print(url)
-  if namespace.accessToken is not None:
-    r = requests.get(url, auth=('user', namespace.accessToken))
+  # names are only known after listing the artifacts if there are patterns
+  patterns = namespace.artifact_name or []
+  urls = None
+  if any(is_pattern(pattern) for pattern in patterns):
+    urls = get_artifact_urls(client, namespace.organization, namespace.project,
+                             run_id, patterns, namespace.api_version,
+                             base_url=namespace.base_url)
+    names = list(urls)
   else:
-    r = requests.get(url)
-  print(r.status_code)
-  raw_url = None
-  if r.status_code == 200:
-    j = r.json()
-    phenix_regression = None
-    for value in j['value']:
-      if value['name'] == namespace.artifact_name:
-        phenix_regression = value
-        break
-    raw_url = phenix_regression['resource']['downloadUrl']
-    print(raw_url)
+    names = list(dict.fromkeys(patterns))
+  if len(names) == 1 and urls is None:
+    local_filenames = {names[0]: namespace.local_filename}
   else:
-    print('URL did not succeed')
-    print(r.text)
-    sys.exit(1)
+    os.makedirs(namespace.download_dir, exist_ok=True)
+    local_filenames = {name: os.path.join(namespace.download_dir, f'{name}.zip')
+                       for name in names}
+
+  # expected digests by artifact name
+  expected_sha256 = {}
+  for value in namespace.sha256 or []:
+    name, _, digest = value.rpartition('=')
+    if not name:
+      if len(names) != 1:
+        raise ValueError('Use NAME=SHA256 for --sha256 with several artifacts.')
+      name = names[0]
+    expected_sha256[name] = digest
+
+  # serve the artifacts from the cache if this run was downloaded before
+  cache = None
+  missing = names
+  if namespace.cache_dir is not None:
+    cache = ArtifactCache(namespace.cache_dir,
+                          max_size=int(namespace.cache_max_size * 1024**3))
+    missing = []
+    for name in names:
+      method = cache.fetch(cache.make_key(namespace.organization, namespace.project,
+                                          run_id, name),
+                           local_filenames[name])
+      if method is not None:
+        print(f'Cache hit: {name} from run {run_id} '
+              f'({method} from {namespace.cache_dir})')
+      else:
+        print(f'Cache miss: {name} from run {run_id}')
+        missing.append(name)
+
+  if missing:
+    # get URLs for downloading artifacts
+    if urls is None:
+      urls = get_artifact_urls(client, namespace.organization, namespace.project,
+                               run_id, missing, namespace.api_version,
+                               base_url=namespace.base_url)
+
+    # download files, every file is renamed from its .part file when done
+    progress = DownloadProgress()
+    digests = {}
+
+    def download_one(name):
+      digests[name] = download_file(urls[name], local_filenames[name],
+                                    segments=namespace.segments,
+                                    session=client.session, progress=progress,
+                                    sha256=expected_sha256.get(name))
+      size = os.path.getsize(local_filenames[name])
+      verified = ', sha256 verified' if name in expected_sha256 else ''
+      progress.log(f'Downloaded {name} ({size / 1024**2:.1f} MB{verified}) '
+                   f'to {local_filenames[name]}')
+      return size
+
+    with ThreadPoolExecutor(max_workers=namespace.jobs) as executor:
+      n_bytes = sum(executor.map(download_one, missing))
+    print(f'Downloaded {len(missing)} artifact(s) ({n_bytes / 1024**2:.1f} MB) in '
+          f'{progress.elapsed:.1f}s ({n_bytes / progress.elapsed / 1024**2:.1f} MB/s)')
+
+    if cache is not None:
+      for name in missing:
+        cache.store(cache.make_key(namespace.organization, namespace.project,
+                                   run_id, name),
+                    local_filenames[name],
+                    sha256=digests[name],
+                    organization=namespace.organization,
+                    project=namespace.project,
+                    run_id=run_id,
+                    artifact_name=name)
+  client.close()
 
-  # download file
-  download_file(raw_url, namespace.local_filename)
+  # extract and remove the archives
+  if namespace.extract_to is not None:
+    for name in names:
+      extract_archive(local_filenames[name], namespace.extract_to,
+                      max_workers=namespace.extract_workers)
+      os.remove(local_filenames[name])
 
 # =============================================================================
 if __name__ == '__main__':
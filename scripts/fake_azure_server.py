@@ -0,0 +1,306 @@
+"""
+Local stand-in for the Azure DevOps REST API with fault injection
+
+The server answers the build list and artifact list requests made by
+download-azure-artifact.py, with an ETag for conditional requests, and
+serves a zip archive as the artifact body.
+Faults can be injected into the artifact downloads:
+
+  statuses  HTTP statuses returned instead of the first bodies
+  resets    connections closed in the middle of the first bodies
+  rate      bytes per second for slow reads
+  ranges    whether Range requests are honored
+
+Every request is recorded with its time, status, the number of body bytes
+sent, the injected fault and whether the body was sent completely (the
+client may close the connection early), so clients can measure retries
+and recovery times.
+
+Run it standalone to test the download script by hand, e.g.
+
+  python fake_azure_server.py --size 256 --resets 2
+  python download-azure-artifact.py --base-url http://127.0.0.1:<port> \\
+    --organization cctbx --project cctbx_project --definitions 4 \\
+    --artifact-name phenix_regression
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# size of the blocks written to the socket
+WRITE_SIZE = 64 * 1024
+
+# =============================================================================
+def make_artifact(size, seed=0, name='phenix_regression'):
+  """Return a zip archive of about size bytes with incompressible data
+  in the directory name, like the stored phenix_regression artifact."""
+  rng = random.Random(seed)
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+    n_files = max(1, size // (8 * 1024 * 1024))
+    for i in range(n_files):
+      zf.writestr(f'{name}/data_{i}.bin', rng.randbytes(size // n_files))
+  return buffer.getvalue()
+
+# =============================================================================
+class FakeAzureHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send_json(self, data, status=200):
+    body = json.dumps(data).encode('utf8')
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    if status == 200 and self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      self.server.record(self.path, 304, 0)
+      return
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    if status == 200:
+      self.send_header('ETag', etag)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.record(self.path, status, len(body))
+
+  def do_GET(self):
+    server = self.server
+    url = urlsplit(self.path)
+    query = parse_qs(url.query)
+
+    m = re.fullmatch(r'/[^/]+/[^/]+/_apis/build/builds/(\d+)/artifacts', url.path)
+    if m is not None:
+      values = [{
+        'id': i + 1,
+        'name': name,
+        'resource': {'type': 'Container',
+                     'downloadUrl': f'{server.base_url}/_download/{name}.zip'},
+      } for i, name in enumerate(server.artifacts)]
+      self._send_json({'count': len(values), 'value': values})
+      return
+
+    if re.fullmatch(r'/[^/]+/[^/]+/_apis/build/builds', url.path):
+      builds = [{'id': build_id, 'result': 'succeeded', 'status': 'completed'}
+                for build_id in server.build_ids]
+      top = query.get('$top')
+      if top is not None:
+        builds = builds[:int(top[0])]
+      self._send_json({'count': len(builds), 'value': builds})
+      return
+
+    m = re.fullmatch(r'/_download/(.+)\.zip', url.path)
+    if m is not None and m.group(1) in server.artifacts:
+      self._send_artifact(server.artifacts[m.group(1)])
+      return
+
+    self._send_json({'message': f'{url.path} not found'}, status=404)
+
+  def _send_artifact(self, body):
+    server = self.server
+    fault = server.next_fault(status=True)
+
+    if fault is not None:
+      self.send_response(fault)
+      if server.retry_after is not None:
+        self.send_header('Retry-After', str(server.retry_after))
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      server.record(self.path, fault, 0, fault=f'status {fault}')
+      return
+
+    start, end = 0, len(body) - 1
+    range_header = self.headers.get('Range')
+    m = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header or '')
+    if server.ranges and m is not None:
+      start = int(m.group(1))
+      end = min(int(m.group(2)), end) if m.group(2) else end
+      if start > end:
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{len(body)}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        server.record(self.path, 416, 0)
+        return
+      status = 206
+      self.send_response(206)
+      self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+    else:
+      status = 200
+      self.send_response(200)
+    if server.ranges:
+      self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('Content-Type', 'application/zip')
+    self.send_header('Content-Length', str(end - start + 1))
+    self.end_headers()
+
+    # stop after reset_fraction of the body for a reset, probes of a single
+    # byte are never cut off
+    stop = end + 1
+    if range_header != 'bytes=0-0':
+      fault = server.next_fault(status=False)
+    if fault == 'reset':
+      stop = start + int((end - start + 1) * server.reset_fraction)
+    n_bytes = 0
+    t0 = time.perf_counter()
+    try:
+      for offset in range(start, stop, WRITE_SIZE):
+        chunk = body[offset:min(offset + WRITE_SIZE, stop)]
+        self.wfile.write(chunk)
+        n_bytes += len(chunk)
+        if server.rate is not None:
+          delay = n_bytes / server.rate - (time.perf_counter() - t0)
+          if delay > 0:
+            time.sleep(delay)
+    except (BrokenPipeError, ConnectionResetError):
+      server.record(self.path, status, n_bytes, complete=False)
+      return
+    if fault == 'reset' and stop <= end:
+      self.wfile.flush()
+      self.close_connection = True
+      self.connection.shutdown(2)
+      server.record(self.path, status, n_bytes, fault='reset', complete=False)
+      return
+    server.record(self.path, status, n_bytes)
+
+# =============================================================================
+class FakeAzureServer(ThreadingHTTPServer):
+  """Threaded HTTP server on 127.0.0.1 with the faults of one scenario.
+
+  Parameters
+  ----------
+  artifact_size : int, optional
+      Approximate size of the artifact in bytes. Default is 64 MiB.
+  artifact_name : str, optional
+      Default is "phenix_regression".
+  artifact_names : list of str, optional
+      Several artifacts with different contents, instead of artifact_name.
+  statuses : list of int, optional
+      Statuses returned for the first artifact requests, e.g. [429, 503].
+  resets : int, optional
+      Number of artifact responses that are cut off after the statuses.
+  reset_fraction : float, optional
+      Fraction of a response body sent before a reset. Default is 0.5.
+  rate : float, optional
+      Bytes per second of every artifact response. Default is None,
+      unlimited.
+  ranges : bool, optional
+      Honor Range requests. Default is True.
+  retry_after : int, optional
+      Retry-After header of the status responses. Default is None.
+  build_ids : list of int, optional
+      The successful builds, newest first.
+  """
+  daemon_threads = True
+
+  def __init__(self, artifact_size=64 * 1024 * 1024, artifact_name='phenix_regression',
+               artifact_names=None, statuses=(), resets=0, reset_fraction=0.5,
+               rate=None, ranges=True, retry_after=None, build_ids=(1234, 1230, 1201),
+               seed=0):
+    super().__init__(('127.0.0.1', 0), FakeAzureHandler)
+    self.artifacts = {name: make_artifact(artifact_size, seed=seed + i, name=name)
+                      for i, name in enumerate(artifact_names or [artifact_name])}
+    self.artifact_name = next(iter(self.artifacts))
+    self.artifact = self.artifacts[self.artifact_name]
+    self.artifact_sha256 = hashlib.sha256(self.artifact).hexdigest()
+    self.faults = list(statuses) + ['reset'] * resets
+    self.reset_fraction = reset_fraction
+    self.rate = rate
+    self.ranges = ranges
+    self.retry_after = retry_after
+    self.build_ids = list(build_ids)
+    self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+    self.events = []
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def next_fault(self, status):
+    """Pop the next fault if it is a status (status=True) or a reset
+    (status=False)."""
+    with self._lock:
+      if self.faults and isinstance(self.faults[0], int) == status:
+        return self.faults.pop(0)
+      return None
+
+  def record(self, path, status, n_bytes, fault=None, complete=True):
+    with self._lock:
+      self.events.append({'time': time.perf_counter(), 'path': path,
+                          'status': status, 'bytes': n_bytes, 'fault': fault,
+                          'complete': complete})
+
+  # ---------------------------------------------------------------------------
+  def start(self):
+    self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  # ---------------------------------------------------------------------------
+  def recovery_times(self):
+    """Return the seconds from every fault to the end of the next
+    successful artifact response."""
+    times = []
+    pending = None
+    for event in self.events:
+      if not event['path'].startswith('/_download/'):
+        continue
+      if event['fault'] is not None:
+        if pending is None:
+          pending = event['time']
+      elif pending is not None and event['complete'] and event['status'] in (200, 206):
+        times.append(event['time'] - pending)
+        pending = None
+    return times
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--size', type=float, default=64,
+                      help='The size of the artifact in MiB.')
+  parser.add_argument('--statuses', type=str, default='',
+                      help='Comma separated statuses for the first requests, e.g. 429,503.')
+  parser.add_argument('--resets', type=int, default=0,
+                      help='The number of responses that are cut off.')
+  parser.add_argument('--rate', type=float, default=None,
+                      help='Bytes per second of the artifact responses.')
+  parser.add_argument('--no-ranges', action='store_true',
+                      help='Ignore Range requests.')
+  parser.add_argument('--artifacts', type=str, default='phenix_regression',
+                      help='Comma separated artifact names.')
+  namespace = parser.parse_args()
+
+  server = FakeAzureServer(
+    artifact_size=int(namespace.size * 1024 * 1024),
+    statuses=[int(status) for status in namespace.statuses.split(',') if status],
+    resets=namespace.resets, rate=namespace.rate, ranges=not namespace.no_ranges,
+    artifact_names=namespace.artifacts.split(','))
+  print(f'Serving on {server.base_url}')
+  for name, body in server.artifacts.items():
+    print(f'  {name}.zip sha256 {hashlib.sha256(body).hexdigest()}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
@@ -0,0 +1,422 @@
+"""
+Duration-aware sharding of the tests run by libtbx.run_tests_parallel
+
+The test jobs publish the JUnit report (output.xml) of run_tests_parallel,
+which has the wall time of every test. The reports are ingested into a
+timing database, a JSON file with the last HISTORY durations of every
+test, and the database is used to plan the next runs:
+
+  ingest  add one or more output.xml files to the database
+  plan    split the tests into --jobs shards with the longest processing
+          time first rule, every job running its tests on --nproc workers,
+          and simulate the expected wall time against the current setup
+          (all tests in one job, in the order of the reports)
+  sample  write synthetic reports for trying the planner offline
+
+A test is identified by the classname and name attributes of its testcase
+element, the module is the first component of the classname. Tests that
+are not in the database (listed with --tests) are estimated with the
+median of their module, and tests of unknown modules with the median of all
+tests. By default whole modules are assigned to the jobs, so every job can
+be run with its module= arguments, and run_tests_parallel keeps the order
+of the tests within a job, e.g.
+
+  python plan-test-shards.py sample reports
+  python plan-test-shards.py ingest timings.json reports/*.xml
+  python plan-test-shards.py plan timings.json --jobs 2 --nproc 4
+
+run_tests_parallel only selects tests by module, so --granularity test,
+which assigns single tests longest first, is an estimate of what a finer
+split would gain and does not print commands.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import statistics
+import sys
+import xml.etree.ElementTree as ET
+
+# =============================================================================
+# version of the database format
+DB_VERSION = 1
+
+# durations kept per test, the estimate is their median
+HISTORY = 5
+
+# tests that are missing from this many consecutive reports are dropped
+STALE_REPORTS = 20
+
+# estimate in seconds if the database has no tests at all
+DEFAULT_SECONDS = 1.0
+
+# modules and numbers of tests of the sample reports, like the module list of
+# the test jobs
+SAMPLE_MODULES = {
+  'annlib_adaptbx': 3,
+  'boost_adaptbx': 12,
+  'cctbx': 180,
+  'cctbx_website': 6,
+  'cma_es': 2,
+  'fable': 25,
+  'gltbx': 2,
+  'iotbx': 140,
+  'libtbx': 45,
+  'rstbx': 20,
+  'scitbx': 110,
+  'smtbx': 30,
+  'spotfinder': 8,
+}
+
+# =============================================================================
+def test_id(classname, name):
+  return f'{classname}::{name}' if classname else name
+
+def module_of(classname, name):
+  """Return the module of a test, the first component of the classname."""
+  return (classname or name).split('.')[0]
+
+def read_junit(filename):
+  """Return the tests of a JUnit report as a list of (test id, module,
+  seconds, status). Tests without a time attribute are skipped."""
+  tests = []
+  for testcase in ET.parse(filename).getroot().iter('testcase'):
+    time = testcase.get('time')
+    if time is None:
+      continue
+    classname = testcase.get('classname', '')
+    name = testcase.get('name', '')
+    if testcase.find('skipped') is not None:
+      status = 'skipped'
+    elif testcase.find('failure') is not None or testcase.find('error') is not None:
+      status = 'failed'
+    else:
+      status = 'passed'
+    tests.append((test_id(classname, name), module_of(classname, name),
+                  float(time), status))
+  return tests
+
+# =============================================================================
+class TimingDatabase():
+  """The durations of the tests in the ingested reports.
+
+  Parameters
+  ----------
+  filename : str, optional
+      The JSON file of the database. Default is None, an empty database that
+      can only be saved with an explicit filename.
+  """
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.reports = 0
+    self.tests = {}
+    if filename is not None and os.path.isfile(filename):
+      with open(filename) as f:
+        data = json.load(f)
+      if data.get('version') != DB_VERSION:
+        raise ValueError(f'{filename} has version {data.get("version")}, '
+                         f'expected {DB_VERSION}')
+      self.reports = data['reports']
+      self.tests = data['tests']
+
+  # ---------------------------------------------------------------------------
+  def ingest(self, filename):
+    """Add the durations of a JUnit report and return the number of tests.
+    Skipped tests do not run and are not added."""
+    self.reports += 1
+    n_tests = 0
+    for key, module, seconds, status in read_junit(filename):
+      if status == 'skipped':
+        continue
+      entry = self.tests.setdefault(key, {'module': module, 'seconds': []})
+      if entry.get('last_report') == self.reports:
+        # retried in the same run, the retries add up
+        entry['seconds'][-1] = round(entry['seconds'][-1] + seconds, 3)
+      else:
+        entry['seconds'] = (entry['seconds'] + [round(seconds, 3)])[-HISTORY:]
+        n_tests += 1
+      entry['module'] = module
+      entry['status'] = status
+      entry['last_report'] = self.reports
+    return n_tests
+
+  def prune(self):
+    """Remove the tests that are missing from the last STALE_REPORTS reports
+    and return their number."""
+    stale = [key for key, entry in self.tests.items()
+             if self.reports - entry['last_report'] >= STALE_REPORTS]
+    for key in stale:
+      del self.tests[key]
+    return len(stale)
+
+  def save(self, filename=None):
+    filename = filename if filename is not None else self.filename
+    data = {'version': DB_VERSION, 'reports': self.reports, 'tests': self.tests}
+    with open(f'{filename}.tmp', 'w') as f:
+      json.dump(data, f, indent=0, separators=(',', ':'))
+    os.replace(f'{filename}.tmp', filename)
+
+  # ---------------------------------------------------------------------------
+  def estimates(self):
+    """Return {test id: seconds}, the median of the kept durations."""
+    return {key: statistics.median(entry['seconds']) for key, entry in self.tests.items()}
+
+  def module_estimates(self):
+    """Return {module: median seconds of its tests} and the median of all
+    tests, the estimates of unseen tests."""
+    estimates = self.estimates()
+    modules = {}
+    for key, seconds in estimates.items():
+      modules.setdefault(self.tests[key]['module'], []).append(seconds)
+    default = statistics.median(estimates.values()) if estimates else DEFAULT_SECONDS
+    return {module: statistics.median(values) for module, values in modules.items()}, default
+
+  def estimate(self, keys=None, modules=None):
+    """Return {test id: (module, seconds, seen)} for the tests, by default
+    all tests of the database. Tests of other modules than modules are
+    left out."""
+    if keys is None:
+      keys = list(self.tests)
+    estimates = self.estimates()
+    module_estimates, default = self.module_estimates()
+    result = {}
+    for key in keys:
+      if key in self.tests:
+        module = self.tests[key]['module']
+        value = (module, estimates[key], True)
+      else:
+        classname, _, name = key.rpartition('::')
+        module = module_of(classname, name)
+        value = (module, module_estimates.get(module, default), False)
+      if modules is None or module in modules:
+        result[key] = value
+    return result
+
+# =============================================================================
+def simulate(durations, nproc):
+  """Return the wall time of running the durations in this order on nproc
+  workers, every test starting on the first worker that is free, like the
+  process pool of run_tests_parallel."""
+  workers = [0.0] * nproc
+  for seconds in durations:
+    heapq.heapreplace(workers, workers[0] + seconds)
+  return max(workers)
+
+def lpt(units, n_shards):
+  """Assign (key, seconds) units to n_shards, the longest unit first to the
+  shard with the least work, and return the shards as lists of keys."""
+  shards = [(0.0, index, []) for index in range(n_shards)]
+  for key, seconds in sorted(units, key=lambda unit: (-unit[1], unit[0])):
+    load, index, keys = heapq.heappop(shards)
+    keys.append(key)
+    heapq.heappush(shards, (load + seconds, index, keys))
+  return [keys for _, _, keys in sorted(shards, key=lambda shard: shard[1])]
+
+def plan_shards(tests, jobs=1, nproc=4, granularity='module'):
+  """Return the plan for running the tests on jobs jobs with nproc workers.
+
+  Parameters
+  ----------
+  tests : dict
+      {test id: (module, seconds, seen)} as returned by TimingDatabase.estimate,
+      in the current order of the tests.
+  jobs : int, optional
+      The number of jobs. Default is 1.
+  nproc : int, optional
+      The number of workers per job, the nproc argument of run_tests_parallel.
+      Default is 4.
+  granularity : str, optional
+      "module" assigns whole modules to the jobs, which run their tests in
+      the current order, and "test" assigns single tests that are started
+      longest first. Default is "module".
+
+  Returns
+  -------
+  dict
+      The jobs with their modules and tests in the order they are started,
+      the simulated wall time of every job, and the simulated wall time
+      (makespan) of the plan and of the current setup with the lower bound.
+  """
+  if granularity == 'module':
+    modules = {}
+    for key, (module, seconds, _) in tests.items():
+      modules.setdefault(module, []).append(key)
+    units = [(module, sum(tests[key][1] for key in keys)) for module, keys in modules.items()]
+    shards = [[key for module in shard for key in modules[module]]
+              for shard in lpt(units, jobs)]
+  else:
+    units = [(key, seconds) for key, (_, seconds, _) in tests.items()]
+    # balance the workers of all jobs, so a long test leaves less work for
+    # the other tests of its job
+    workers = lpt(units, jobs * nproc)
+    shards = [sum(workers[index:index + nproc], []) for index in range(0, len(workers), nproc)]
+
+  plan_jobs = []
+  for shard in shards:
+    # the pool of run_tests_parallel starts the tests in the order they are
+    # given, which is only planned for single tests
+    if granularity == 'module':
+      ordered = shard
+    else:
+      ordered = sorted(shard, key=lambda key: (-tests[key][1], key))
+    modules = sorted({tests[key][0] for key in shard})
+    plan_jobs.append({
+      'modules': modules,
+      'tests': ordered,
+      'seconds': sum(tests[key][1] for key in shard),
+      'makespan': simulate([tests[key][1] for key in ordered], nproc),
+      'unseen': sum(1 for key in shard if not tests[key][2]),
+    })
+
+  durations = [seconds for _, seconds, _ in tests.values()]
+  total = sum(durations)
+  return {
+    'jobs': plan_jobs,
+    'nproc': nproc,
+    'granularity': granularity,
+    'makespan': max((job['makespan'] for job in plan_jobs), default=0.0),
+    'baseline': simulate(durations, nproc),
+    'lower_bound': max(total / (jobs * nproc), max(durations, default=0.0)),
+  }
+
+def format_plan(plan):
+  """Return the lines of a table with the jobs of a plan."""
+  lines = [f'{"job":>4} {"tests":>6} {"unseen":>6} {"work":>10} {"wall":>10}  modules']
+  for index, job in enumerate(plan['jobs']):
+    lines.append(f'{index:>4} {len(job["tests"]):>6} {job["unseen"]:>6} '
+                 f'{job["seconds"]:>9.1f}s {job["makespan"]:>9.1f}s  '
+                 f'{" ".join(job["modules"])}')
+  lines.append(f'Current setup (jobs=1, nproc={plan["nproc"]}): {plan["baseline"]:.1f}s')
+  lines.append(f'Planned (jobs={len(plan["jobs"])}, nproc={plan["nproc"]}, '
+               f'{plan["granularity"]}): {plan["makespan"]:.1f}s, '
+               f'lower bound {plan["lower_bound"]:.1f}s')
+  if plan['makespan'] > 0:
+    lines.append(f'Speedup: {plan["baseline"] / plan["makespan"]:.2f}x')
+  if plan['granularity'] == 'module':
+    for index, job in enumerate(plan['jobs']):
+      if not job['modules']:
+        continue
+      lines.append(f'job {index}: libtbx.run_tests_parallel '
+                   f'{" ".join(f"module={module}" for module in job["modules"])} '
+                   f'nproc={plan["nproc"]}')
+  else:
+    lines.append('run_tests_parallel cannot run single tests of a module, use '
+                 '--granularity module for runnable jobs.')
+  return lines
+
+# =============================================================================
+def write_sample_reports(output_dir, n_reports=3, seed=0, modules=SAMPLE_MODULES):
+  """Write n_reports synthetic output.xml files of run_tests_parallel and
+  return their filenames. The durations are log-normal with a few long tests
+  per module and vary by 10% between the reports."""
+  rng = random.Random(seed)
+  tests = []
+  for module, n_tests in modules.items():
+    for index in range(n_tests):
+      seconds = rng.lognormvariate(0.5, 1.2)
+      if rng.random() < 0.03:
+        seconds *= 10
+      tests.append((f'{module}.regression', f'tst_{module}_{index:03d}.py', seconds))
+  os.makedirs(output_dir, exist_ok=True)
+  filenames = []
+  for report in range(n_reports):
+    suite = ET.Element('testsuite', name='libtbx.run_tests_parallel',
+                       tests=str(len(tests)))
+    for classname, name, seconds in tests:
+      testcase = ET.SubElement(suite, 'testcase', classname=classname, name=name,
+                               time=f'{seconds * rng.uniform(0.9, 1.1):.3f}')
+      if rng.random() < 0.01:
+        ET.SubElement(testcase, 'failure', type='failure', message='')
+      elif rng.random() < 0.01:
+        ET.SubElement(testcase, 'skipped', type='skipped', message='expected test failure')
+    root = ET.Element('testsuites')
+    root.append(suite)
+    filename = os.path.join(output_dir, f'output-{report}.xml')
+    ET.ElementTree(root).write(filename, encoding='utf-8', xml_declaration=True)
+    filenames.append(filename)
+  return filenames
+
+# =============================================================================
+def run():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  ingest_parser = subparsers.add_parser('ingest', help='Add JUnit reports to the database.')
+  ingest_parser.add_argument('database', type=str,
+                             help='The JSON timing database, created if it does not exist.')
+  ingest_parser.add_argument('reports', type=str, nargs='+',
+                             help='The output.xml files of run_tests_parallel.')
+
+  plan_parser = subparsers.add_parser('plan', help='Plan the shards of the next run.')
+  plan_parser.add_argument('database', type=str,
+                           help='The JSON timing database.')
+  plan_parser.add_argument('--jobs', type=int, default=1,
+                           help='The number of jobs the tests are split into.')
+  plan_parser.add_argument('--nproc', type=int, default=4,
+                           help='The nproc argument of run_tests_parallel in every job.')
+  plan_parser.add_argument('--modules', type=str, nargs='+', default=None,
+                           help='Only plan the tests of these modules.')
+  plan_parser.add_argument('--tests', type=str, default=None,
+                           help='A file with the ids (classname::name) of the tests '
+                                'to plan, one per line, instead of the tests in the '
+                                'database.')
+  plan_parser.add_argument('--granularity', type=str, default='module',
+                           choices=['module', 'test'],
+                           help='Assign whole modules, which can be run with '
+                                'module= arguments, or single tests (an estimate '
+                                'only) to the jobs.')
+  plan_parser.add_argument('--output', type=str, default=None,
+                           help='Write the plan to this JSON file.')
+
+  sample_parser = subparsers.add_parser('sample', help='Write synthetic JUnit reports.')
+  sample_parser.add_argument('output_dir', type=str,
+                             help='The directory of the reports.')
+  sample_parser.add_argument('--reports', type=int, default=3,
+                             help='The number of reports.')
+  sample_parser.add_argument('--seed', type=int, default=0,
+                             help='The seed of the durations.')
+
+  namespace = parser.parse_args()
+
+  if namespace.command == 'ingest':
+    database = TimingDatabase(namespace.database)
+    for filename in namespace.reports:
+      n_tests = database.ingest(filename)
+      print(f'Ingested {n_tests} tests from {filename}')
+    n_stale = database.prune()
+    if n_stale:
+      print(f'Removed {n_stale} tests that were not run in the last {STALE_REPORTS} reports')
+    database.save()
+    print(f'{len(database.tests)} tests from {database.reports} reports in {namespace.database}')
+
+  elif namespace.command == 'plan':
+    if namespace.jobs < 1 or namespace.nproc < 1:
+      sys.exit('--jobs and --nproc must be at least 1.')
+    if not os.path.isfile(namespace.database):
+      sys.exit(f'The database {namespace.database} does not exist, ingest reports first.')
+    database = TimingDatabase(namespace.database)
+    keys = None
+    if namespace.tests is not None:
+      with open(namespace.tests) as f:
+        keys = [line.strip() for line in f if line.strip()]
+    tests = database.estimate(keys, modules=namespace.modules)
+    if not tests:
+      sys.exit('There are no tests to plan.')
+    plan = plan_shards(tests, jobs=namespace.jobs, nproc=namespace.nproc,
+                       granularity=namespace.granularity)
+    for line in format_plan(plan):
+      print(line)
+    if namespace.output is not None:
+      with open(namespace.output, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+  elif namespace.command == 'sample':
+    for filename in write_sample_reports(namespace.output_dir, n_reports=namespace.reports,
+                                         seed=namespace.seed):
+      print(f'Wrote {filename}')
+
+# =============================================================================
+if __name__ == '__main__':
+  sys.exit(run())
@@ -0,0 +1,133 @@
+"""
+Tests of the resumable and segmented downloads of download-azure-artifact.py
+against FakeAzureServer and of the artifact cache, run with
+
+  python -m pytest scripts
+"""
+import importlib.util
+import os
+import threading
+
+import pytest
+
+from fake_azure_server import FakeAzureServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# small enough to keep the tests fast, large enough for several chunks
+ARTIFACT_SIZE = 1024 * 1024
+
+# =============================================================================
+@pytest.fixture
+def download(monkeypatch):
+  """download-azure-artifact.py with small blocks and without backoff."""
+  spec = importlib.util.spec_from_file_location(
+    'download_azure_artifact', os.path.join(SCRIPT_DIR, 'download-azure-artifact.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  monkeypatch.setattr(module, 'BACKOFF_FACTOR', 0)
+  monkeypatch.setattr(module, 'CHUNK_SIZE', 64 * 1024)
+  monkeypatch.setattr(module, 'MIN_SEGMENT_SIZE', 128 * 1024)
+  return module
+
+def artifact_url(server):
+  return f'{server.base_url}/_download/{server.artifact_name}.zip'
+
+def artifact_events(server):
+  return [event for event in server.events if event['path'].startswith('/_download/')]
+
+# =============================================================================
+def test_resume_after_reset(download, tmp_path):
+  local_filename = str(tmp_path / 'artifact.zip')
+  with FakeAzureServer(artifact_size=ARTIFACT_SIZE, resets=2) as server:
+    digest = download.download_file(artifact_url(server), local_filename,
+                                    sha256=server.artifact_sha256)
+    events = artifact_events(server)
+    artifact = server.artifact
+
+  assert digest == server.artifact_sha256
+  with open(local_filename, 'rb') as f:
+    assert f.read() == artifact
+  assert not os.path.exists(local_filename + '.part')
+  # the retries continue with Range requests instead of starting again
+  faults = [event for event in events if event['fault'] == 'reset']
+  assert len(faults) == 2
+  assert events[-1]['status'] == 206 and events[-1]['complete']
+  sent = sum(event['bytes'] for event in events)
+  assert sent < 2 * len(artifact)
+
+def test_segments_resume_after_reset(download, tmp_path):
+  local_filename = str(tmp_path / 'artifact.zip')
+  with FakeAzureServer(artifact_size=ARTIFACT_SIZE, resets=1) as server:
+    digest = download.download_file(artifact_url(server), local_filename,
+                                    segments=4, sha256=server.artifact_sha256)
+    events = artifact_events(server)
+
+  assert digest == server.artifact_sha256
+  assert download.file_sha256(local_filename) == server.artifact_sha256
+  ranges = [event for event in events if event['status'] == 206 and event['complete']]
+  # the probe of the range support and one complete response per segment
+  assert len(ranges) >= 4
+
+def test_no_range_fallback(download, tmp_path):
+  local_filename = str(tmp_path / 'artifact.zip')
+  with FakeAzureServer(artifact_size=ARTIFACT_SIZE, resets=1, ranges=False) as server:
+    digest = download.download_file(artifact_url(server), local_filename,
+                                    segments=4, sha256=server.artifact_sha256)
+    events = artifact_events(server)
+
+  assert digest == server.artifact_sha256
+  assert download.file_sha256(local_filename) == server.artifact_sha256
+  # without Range support the download starts again from the first byte
+  assert all(event['status'] == 200 for event in events)
+  assert events[-1]['complete']
+
+def test_checksum_mismatch(download, tmp_path):
+  local_filename = tmp_path / 'artifact.zip'
+  local_filename.write_bytes(b'previous download')
+  with FakeAzureServer(artifact_size=ARTIFACT_SIZE, resets=1) as server:
+    with pytest.raises(ValueError, match='sha256'):
+      download.download_file(artifact_url(server), str(local_filename), sha256='0' * 64)
+
+  # the partial file is removed and the previous file is left untouched
+  assert not os.path.exists(f'{local_filename}.part')
+  assert local_filename.read_bytes() == b'previous download'
+
+def test_checksum_mismatch_segments(download, tmp_path):
+  local_filename = tmp_path / 'artifact.zip'
+  with FakeAzureServer(artifact_size=ARTIFACT_SIZE) as server:
+    with pytest.raises(ValueError, match='sha256'):
+      download.download_file(artifact_url(server), str(local_filename), segments=4,
+                             sha256='0' * 64)
+
+  assert not os.path.exists(f'{local_filename}.part')
+  assert not local_filename.exists()
+
+# =============================================================================
+def test_cache_store_is_atomic_for_evict(download, tmp_path, monkeypatch):
+  cache = download.ArtifactCache(str(tmp_path / 'cache'))
+  artifact = tmp_path / 'artifact.zip'
+  artifact.write_bytes(b'artifact' * 1024)
+  key = cache.make_key('cctbx', 'cctbx_project', 1234, 'phenix_regression')
+
+  # evict from another thread as soon as the object is renamed into place,
+  # before the index entry is written
+  replace = os.replace
+  evictions = []
+  def replace_and_evict(source, dest):
+    replace(source, dest)
+    if os.path.dirname(dest) == cache.objects_dir:
+      thread = threading.Thread(target=cache.evict)
+      thread.start()
+      thread.join(timeout=0.2)
+      evictions.append(thread)
+  monkeypatch.setattr(download.os, 'replace', replace_and_evict)
+
+  cache.store(key, str(artifact), artifact_name='phenix_regression', run_id=1234)
+  for thread in evictions:
+    thread.join()
+  monkeypatch.setattr(download.os, 'replace', replace)
+
+  assert len(evictions) == 1
+  assert cache.fetch(key, str(tmp_path / 'fetched.zip')) is not None
+  assert (tmp_path / 'fetched.zip').read_bytes() == artifact.read_bytes()
@@ -0,0 +1,151 @@
+"""
+Tests of plan-test-shards.py against small JUnit reports, run with
+
+  python -m pytest scripts
+"""
+import importlib.util
+import os
+
+import pytest
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# =============================================================================
+@pytest.fixture
+def shards():
+  """plan-test-shards.py, the name is not a module name."""
+  spec = importlib.util.spec_from_file_location(
+    'plan_test_shards', os.path.join(SCRIPT_DIR, 'plan-test-shards.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def write_report(filename, testcases):
+  """Write a JUnit report with (classname, name, seconds, result) test
+  cases, result is None, "failure" or "skipped"."""
+  lines = ['<?xml version="1.0" encoding="utf-8"?>',
+           '<testsuites><testsuite name="libtbx.run_tests_parallel">']
+  for classname, name, seconds, result in testcases:
+    lines.append(f'<testcase classname="{classname}" name="{name}" time="{seconds}">')
+    if result is not None:
+      lines.append(f'<{result} message=""/>')
+    lines.append('</testcase>')
+  lines.append('</testsuite></testsuites>')
+  with open(filename, 'w') as f:
+    f.write('\n'.join(lines))
+  return str(filename)
+
+# =============================================================================
+def test_simulate_depends_on_order(shards):
+  durations = [1, 1, 1, 1, 4]
+  assert shards.simulate(durations, 2) == 6
+  assert shards.simulate(sorted(durations, reverse=True), 2) == 4
+  assert shards.simulate([], 4) == 0
+
+def test_lpt_balance(shards):
+  units = [('a', 5), ('b', 4), ('c', 3), ('d', 3), ('e', 3)]
+  result = shards.lpt(units, 2)
+  assert result == [['a', 'd'], ['b', 'c', 'e']]
+  seconds = dict(units)
+  loads = [sum(seconds[key] for key in shard) for shard in result]
+  # the optimum is 9 (a+b and c+d+e), LPT is within 4/3 of it
+  assert max(loads) <= 4 / 3 * 9
+  assert sorted(key for shard in result for key in shard) == sorted(seconds)
+
+@pytest.mark.parametrize('granularity', ['module', 'test'])
+def test_plan_shards(shards, tmp_path, granularity):
+  database = shards.TimingDatabase()
+  for filename in shards.write_sample_reports(tmp_path, n_reports=2):
+    database.ingest(filename)
+  tests = database.estimate()
+  plan = shards.plan_shards(tests, jobs=3, nproc=4, granularity=granularity)
+
+  assert len(plan['jobs']) == 3
+  planned = [key for job in plan['jobs'] for key in job['tests']]
+  assert sorted(planned) == sorted(tests)
+  assert plan['makespan'] >= plan['lower_bound'] - 1e-9
+  assert plan['makespan'] < plan['baseline']
+  assert plan['makespan'] == max(job['makespan'] for job in plan['jobs'])
+  total = sum(seconds for _, seconds, _ in tests.values())
+  assert sum(job['seconds'] for job in plan['jobs']) == pytest.approx(total)
+  if granularity == 'module':
+    modules = [module for job in plan['jobs'] for module in job['modules']]
+    assert len(modules) == len(set(modules))
+  else:
+    # the longest test alone bounds the plan, the rest is spread evenly
+    assert plan['makespan'] <= 4 / 3 * plan['lower_bound'] + max(
+      seconds for _, seconds, _ in tests.values())
+
+def test_lower_bound_is_longest_test(shards):
+  tests = {'a::long': ('a', 100.0, True), 'a::short': ('a', 1.0, True)}
+  plan = shards.plan_shards(tests, jobs=2, nproc=4, granularity='test')
+  assert plan['lower_bound'] == 100.0
+  assert plan['makespan'] == 100.0
+
+def test_ingest_retries_and_skipped(shards, tmp_path):
+  database = shards.TimingDatabase()
+  report = write_report(tmp_path / 'output.xml', [
+    ('cctbx.regression', 'tst_a.py', 2.0, 'failure'),
+    ('cctbx.regression', 'tst_a.py', 3.0, None),
+    ('cctbx.regression', 'tst_b.py', 1.0, 'skipped'),
+    ('iotbx.pdb', 'tst_c.py', 4.0, None),
+  ])
+  assert database.ingest(report) == 2
+  # the retry of tst_a adds to the run it belongs to
+  assert database.tests['cctbx.regression::tst_a.py']['seconds'] == [5.0]
+  assert database.tests['cctbx.regression::tst_a.py']['status'] == 'passed'
+  assert 'cctbx.regression::tst_b.py' not in database.tests
+  assert database.tests['iotbx.pdb::tst_c.py']['module'] == 'iotbx'
+
+  # a second report is a new run
+  database.ingest(report)
+  assert database.tests['cctbx.regression::tst_a.py']['seconds'] == [5.0, 5.0]
+
+  # save and load
+  database.save(str(tmp_path / 'timings.json'))
+  loaded = shards.TimingDatabase(str(tmp_path / 'timings.json'))
+  assert loaded.reports == 2
+  assert loaded.tests == database.tests
+
+def test_history_is_limited(shards, tmp_path, monkeypatch):
+  monkeypatch.setattr(shards, 'HISTORY', 3)
+  database = shards.TimingDatabase()
+  for index in range(5):
+    database.ingest(write_report(tmp_path / f'{index}.xml',
+                                 [('cctbx', 'tst.py', index, None)]))
+  assert database.tests['cctbx::tst.py']['seconds'] == [2.0, 3.0, 4.0]
+  assert database.estimates() == {'cctbx::tst.py': 3.0}
+
+def test_prune(shards, tmp_path, monkeypatch):
+  monkeypatch.setattr(shards, 'STALE_REPORTS', 2)
+  database = shards.TimingDatabase()
+  database.ingest(write_report(tmp_path / 'old.xml', [('cctbx', 'tst_old.py', 1.0, None),
+                                                      ('cctbx', 'tst_new.py', 1.0, None)]))
+  new = write_report(tmp_path / 'new.xml', [('cctbx', 'tst_new.py', 1.0, None)])
+  database.ingest(new)
+  assert database.prune() == 0
+  database.ingest(new)
+  assert database.prune() == 1
+  assert list(database.tests) == ['cctbx::tst_new.py']
+
+def test_unseen_estimates(shards, tmp_path):
+  assert shards.TimingDatabase().estimate(['cctbx::tst.py']) == {
+    'cctbx::tst.py': ('cctbx', shards.DEFAULT_SECONDS, False)}
+
+  database = shards.TimingDatabase()
+  database.ingest(write_report(tmp_path / 'output.xml', [
+    ('cctbx.regression', 'tst_a.py', 1.0, None),
+    ('cctbx.regression', 'tst_b.py', 3.0, None),
+    ('cctbx.regression', 'tst_c.py', 8.0, None),
+    ('iotbx', 'tst_d.py', 20.0, None),
+  ]))
+  estimates = database.estimate(['cctbx.regression::tst_a.py', 'cctbx.sgtbx::tst_new.py',
+                                 'mmtbx.x::tst_new.py'])
+  assert estimates == {
+    'cctbx.regression::tst_a.py': ('cctbx', 1.0, True),
+    # median of the module
+    'cctbx.sgtbx::tst_new.py': ('cctbx', 3.0, False),
+    # median of all tests
+    'mmtbx.x::tst_new.py': ('mmtbx', 5.5, False),
+  }
+  assert list(database.estimate(modules=['iotbx'])) == ['iotbx::tst_d.py']
@@ -0,0 +1,183 @@
+"""
+Micro-benchmark for the classification rules used by convert.py
+
+A synthetic paths.json with the directory layout of a cctbx-base conda
+package is classified several times and the best time per path and the
+number of files handled by every rule are reported. The counts can be
+compared with a previous run, so changes to the rule table that move
+files to a different rule are caught.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from classify import Classifier
+
+# the fraction of the paths of every kind, roughly following a cctbx-base
+# package
+DEFAULT_MIX = {
+  'bin': 0.05,
+  'site-packages': 0.40,
+  'pycache': 0.25,
+  'extension': 0.03,
+  'dist-info': 0.01,
+  'share': 0.11,
+  'include': 0.12,
+  'lib': 0.03,
+}
+
+# =============================================================================
+def synthetic_paths(n_paths=50000, platform='linux', seed=0, mix=None, max_depth=4):
+  """Return a paths.json dictionary with n_paths synthetic entries.
+
+  mix changes the fractions in DEFAULT_MIX of dispatchers, Python modules,
+  bytecode, extensions, shared data, headers and libraries, and max_depth
+  is the maximum number of subdirectories below a module.
+  """
+  weights = dict(DEFAULT_MIX)
+  weights.update(mix or {})
+  total = sum(weights.values())
+  thresholds = []
+  cumulative = 0
+  for kind in DEFAULT_MIX:
+    cumulative += weights[kind]
+    thresholds.append((cumulative / total, kind))
+
+  rng = random.Random(seed)
+  modules = ['cctbx', 'iotbx', 'mmtbx', 'scitbx', 'libtbx', 'smtbx', 'boost_adaptbx',
+             'fable', 'rstbx', 'spotfinder', 'xfel', 'dxtbx', 'wxtbx', 'gltbx']
+  words = ['array_family', 'regression', 'command_line', 'geometry', 'restraints',
+           'maptbx', 'sgtbx', 'uctbx', 'examples', 'data', 'tests', 'detail']
+  if platform == 'win32':
+    site_packages = 'Lib/site-packages'
+    bin_dir = 'Library/bin'
+    share_dir = 'Library/share'
+    include_dir = 'Library/include'
+    lib_dir = 'Library/lib'
+    ext = '.pyd'
+  else:
+    site_packages = 'lib/python3.12/site-packages'
+    bin_dir = 'bin'
+    share_dir = 'share'
+    include_dir = 'include'
+    lib_dir = 'lib'
+    ext = '.so'
+
+  def subdirs():
+    return '/'.join(rng.choice(words) for _ in range(rng.randint(0, max_depth)))
+
+  paths = set()
+  while len(paths) < n_paths:
+    module = rng.choice(modules)
+    r = rng.random()
+    i = rng.randint(0, 10**6)
+    kind = next((kind for threshold, kind in thresholds if r < threshold), 'lib')
+    if kind == 'bin':
+      path = f'{bin_dir}/{module}.command_{i}'
+      if platform == 'win32':
+        path += rng.choice(['.bat', '.exe'])
+    elif kind == 'site-packages':
+      path = f'{site_packages}/{module}/{subdirs()}/tst_{i}.py'
+    elif kind == 'pycache':
+      path = f'{site_packages}/{module}/{subdirs()}/__pycache__/tst_{i}.cpython-312.pyc'
+    elif kind == 'extension':
+      path = f'{site_packages}/{module}_ext_{i}{ext}'
+    elif kind == 'dist-info':
+      path = f'{site_packages}/{module}-1.0.dist-info/FILE_{i}'
+    elif kind == 'share':
+      path = f'{share_dir}/{module}/{subdirs()}/data_{i}.dat'
+    elif kind == 'include':
+      path = f'{include_dir}/{module}/{subdirs()}/header_{i}.h'
+    else:
+      path = f'{lib_dir}/lib{module}_{i}{".dll" if platform == "win32" else ".so"}'
+    paths.add(path.replace('//', '/'))
+  return {'paths': [{'_path': path} for path in sorted(paths)], 'paths_version': 1}
+
+# =============================================================================
+def run_benchmark(paths_list, binary_files, platform=None, repeat=5):
+  """Classify all paths repeat times and return the best time and the
+  per-rule counts of one pass."""
+  paths = [f['_path'] for f in paths_list['paths']]
+  best = None
+  counts = None
+  for _ in range(repeat):
+    classifier = Classifier(binary_files, platform=platform)
+    t0 = time.perf_counter()
+    for path in paths:
+      classifier.classify(path)
+    elapsed = time.perf_counter() - t0
+    if best is None or elapsed < best:
+      best = elapsed
+    counts = classifier.counts
+  return best, counts
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--n-paths', type=int, default=50000,
+                      help='The number of synthetic paths.')
+  parser.add_argument('--platform', type=str, default=sys.platform,
+                      help='The target platform of the rules and the synthetic paths.')
+  parser.add_argument('--paths-json', type=str, default=None,
+                      help='Classify the paths of an existing paths.json instead.')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='The number of timed passes, the best one is reported.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the timing and the counts to this JSON file.')
+  parser.add_argument('--compare', type=str, default=None,
+                      help='JSON file from --output to compare with.')
+  parser.add_argument('--max-slowdown', type=float, default=1.5,
+                      help='Fail if the time per path exceeds the compared time '
+                           'by this factor.')
+  namespace = parser.parse_args()
+
+  if namespace.paths_json is not None:
+    with open(namespace.paths_json) as f:
+      paths_list = json.load(f)
+  else:
+    paths_list = synthetic_paths(namespace.n_paths, platform=namespace.platform)
+
+  # the binary names of CondaWheelConverter
+  from convert import CondaWheelConverter
+  binary_files = CondaWheelConverter().binary_files
+
+  best, counts = run_benchmark(paths_list, binary_files,
+                               platform=namespace.platform,
+                               repeat=namespace.repeat)
+  n_paths = len(paths_list['paths'])
+  us_per_path = best / n_paths * 1e6
+
+  print(f'Classified {n_paths} paths in {best:.4f}s ({us_per_path:.3f} us/path)')
+  for rule, count in counts.items():
+    print(f'  {rule:<16} {count}')
+
+  result = {
+    'n_paths': n_paths,
+    'platform': namespace.platform,
+    'seconds': best,
+    'us_per_path': us_per_path,
+    'counts': counts,
+  }
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump(result, f, indent=2)
+
+  if namespace.compare is not None:
+    with open(namespace.compare) as f:
+      baseline = json.load(f)
+    failed = False
+    if baseline['counts'] != counts:
+      print('Rule counts differ from', namespace.compare)
+      for rule in sorted(set(baseline['counts']) | set(counts)):
+        if baseline['counts'].get(rule) != counts.get(rule):
+          print(f'  {rule:<16} {baseline["counts"].get(rule)} -> {counts.get(rule)}')
+      failed = True
+    if us_per_path > baseline['us_per_path'] * namespace.max_slowdown:
+      print(f'Classification slowed down from {baseline["us_per_path"]:.3f} '
+            f'to {us_per_path:.3f} us/path')
+      failed = True
+    if failed:
+      sys.exit(1)
@@ -0,0 +1,254 @@
+"""
+End-to-end benchmark for converting a conda package and building the wheel
+
+A synthetic extracted conda package with consistent info/files and
+info/paths.json is generated, and the steps of the wheel workflow are run
+as separate processes in a fresh copy of the wheel directory:
+
+  update_version  update_version.py
+  convert         convert.py --conda-package-path
+  build           the build_wheel hook of build_backend.py
+  archive         convert.py --conda-archive with a .tar.bz2 of the package
+                  (only with --archive)
+
+The best time of every step is written to a JSON file, together with the
+phases reported by convert.py, and can be compared with a baseline. The
+tooling tests workflow compares every run with the result of the latest
+push to the default branch, which it keeps in the Actions cache.
+Everything runs offline.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from pathlib import Path
+
+from benchmark_classify import DEFAULT_MIX, synthetic_paths
+from convert import CondaWheelConverter
+
+# files copied into the work directory
+WHEEL_FILES = ['build_backend.py', 'classify.py', 'convert.py', 'debug_symbols.py',
+               'instrument.py', 'pyproject.toml', 'README.md', 'rpaths.py',
+               'update_version.py', 'wheel_writer.py']
+
+# text that is repeated in text files, so that they compress like source
+TEXT = b'from scitbx.array_family import flex\nimport iotbx.pdb\n# comment\n'
+
+# =============================================================================
+def parse_mix(text):
+  """Parse "kind=weight" pairs separated by commas, see DEFAULT_MIX."""
+  mix = {}
+  for item in text.split(','):
+    kind, _, weight = item.partition('=')
+    if kind not in DEFAULT_MIX:
+      raise ValueError(f'Unknown kind {kind!r}, use one of {", ".join(DEFAULT_MIX)}.')
+    mix[kind] = float(weight)
+  return mix
+
+def file_contents(path, size, rng):
+  """Return contents of a given size, native binaries get an ELF header and
+  random bytes, everything else compressible text."""
+  if path.endswith('.so') or '.so.' in path:
+    return b'\x7fELF' + rng.randbytes(max(size - 4, 0))
+  return (TEXT * (size // len(TEXT) + 1))[:size]
+
+def generate_package(root, n_files=5000, median_size=8192, size_sigma=1.5,
+                     max_depth=4, mix=None, seed=0):
+  """Write an extracted conda package to root and return its total size.
+
+  The file sizes follow a log-normal distribution with the given median and
+  sigma. The binaries wrapped as entry points by convert.py are added to
+  bin.
+  """
+  rng = random.Random(seed)
+  root = Path(root)
+  paths = [f['_path'] for f in synthetic_paths(n_files, platform=sys.platform,
+                                               seed=seed, mix=mix,
+                                               max_depth=max_depth)['paths']]
+  paths.extend(f'bin/{name}' for name in CondaWheelConverter().binary_files)
+
+  entries = []
+  total_size = 0
+  for path in sorted(paths):
+    size = int(rng.lognormvariate(math.log(median_size), size_sigma))
+    if path.startswith('bin/') and '.command_' not in path:
+      contents = b'\x7fELF' + rng.randbytes(size)
+    else:
+      contents = file_contents(path, size, rng)
+    filename = root / path
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    filename.write_bytes(contents)
+    if path.startswith('bin/'):
+      os.chmod(filename, 0o755)
+    entries.append({
+      '_path': path,
+      'path_type': 'hardlink',
+      'sha256': hashlib.sha256(contents).hexdigest(),
+      'size_in_bytes': len(contents),
+    })
+    total_size += len(contents)
+
+  info = root / 'info'
+  info.mkdir(exist_ok=True)
+  (info / 'files').write_text(''.join(f'{entry["_path"]}\n' for entry in entries))
+  with open(info / 'paths.json', 'w') as f:
+    json.dump({'paths': entries, 'paths_version': 1}, f)
+  return total_size
+
+def make_archive(package_path, archive_path):
+  with tarfile.open(archive_path, 'w:bz2') as tar:
+    for name in ['info'] + sorted(set(os.listdir(package_path)) - {'info'}):
+      tar.add(os.path.join(package_path, name), arcname=name)
+
+def make_work_dir(work_dir, wheel_dir):
+  shutil.rmtree(work_dir, ignore_errors=True)
+  os.makedirs(work_dir)
+  for name in WHEEL_FILES:
+    shutil.copy(os.path.join(wheel_dir, name), work_dir)
+
+def run_step(command, work_dir):
+  """Run a command in work_dir and return the wall time."""
+  t0 = time.perf_counter()
+  subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+  return time.perf_counter() - t0
+
+# =============================================================================
+def run_benchmark(package_path, work_dir, archive_path=None, repeat=1):
+  """Run the steps repeat times and return the best times, the convert.py
+  report of the last run and the size of the wheel."""
+  wheel_dir = os.path.dirname(os.path.abspath(__file__))
+  python = sys.executable
+  steps = {
+    'update_version': [python, 'update_version.py', '--version=1.0'],
+    'convert': [python, 'convert.py', '--conda-package-path', str(package_path),
+                '--quiet', '--report', 'convert_report.json'],
+    'build': [python, '-c', 'import build_backend; build_backend.build_wheel("wheels")'],
+  }
+  if archive_path is not None:
+    steps['archive'] = [python, 'convert.py', '--conda-archive', str(archive_path),
+                        '--wheel-dir', 'archive_wheels', '--quiet']
+
+  best = {}
+  for _ in range(repeat):
+    make_work_dir(work_dir, wheel_dir)
+    for step, command in steps.items():
+      elapsed = run_step(command, work_dir)
+      best[step] = min(best.get(step, elapsed), elapsed)
+  best['total'] = sum(best.values())
+
+  with open(os.path.join(work_dir, 'convert_report.json')) as f:
+    report = json.load(f)
+  wheels = list(Path(work_dir, 'wheels').glob('*.whl'))
+  wheel_size = wheels[0].stat().st_size if wheels else None
+  return best, report, wheel_size
+
+def compare(result, baseline, threshold):
+  """Return the steps that are slower than the baseline by more than the
+  threshold fraction."""
+  regressions = []
+  for step, seconds in result['seconds'].items():
+    reference = baseline.get('seconds', {}).get(step)
+    if reference is not None and seconds > reference * (1 + threshold):
+      regressions.append((step, reference, seconds))
+  return regressions
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--n-files', type=int, default=5000,
+                      help='The number of files in the synthetic package.')
+  parser.add_argument('--median-size', type=int, default=8192,
+                      help='The median file size in bytes.')
+  parser.add_argument('--size-sigma', type=float, default=1.5,
+                      help='The sigma of the log-normal file size distribution.')
+  parser.add_argument('--max-depth', type=int, default=4,
+                      help='The maximum number of subdirectories below a module.')
+  parser.add_argument('--mix', type=parse_mix, default=None,
+                      help='Weights of the kinds of files, e.g. '
+                           '"share=0.3,site-packages=0.5" (see '
+                           'benchmark_classify.DEFAULT_MIX).')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='The seed for the synthetic package.')
+  parser.add_argument('--archive', action='store_true',
+                      help='Also time converting a .tar.bz2 of the package.')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='The number of runs, the best time of every step is '
+                           'reported.')
+  parser.add_argument('--work-dir', type=str, default=None,
+                      help='Directory for the package and the conversion. The '
+                           'default is a temporary directory.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the results to this JSON file.')
+  parser.add_argument('--compare', type=str, default=None,
+                      help='JSON file from --output to compare with.')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Fail if a step is slower than in the compared file '
+                           'by more than this fraction.')
+  namespace = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    root = Path(namespace.work_dir or tmp_dir).resolve()
+    package_path = root / 'cctbx-base-1.0-0'
+    shutil.rmtree(package_path, ignore_errors=True)
+    t0 = time.perf_counter()
+    total_size = generate_package(package_path, n_files=namespace.n_files,
+                                  median_size=namespace.median_size,
+                                  size_sigma=namespace.size_sigma,
+                                  max_depth=namespace.max_depth,
+                                  mix=namespace.mix, seed=namespace.seed)
+    archive_path = None
+    if namespace.archive:
+      archive_path = root / 'cctbx-base-1.0-0.tar.bz2'
+      make_archive(package_path, archive_path)
+    print(f'Generated {namespace.n_files} files ({total_size} bytes) in '
+          f'{time.perf_counter() - t0:.2f}s')
+
+    seconds, report, wheel_size = run_benchmark(package_path, root / 'work',
+                                                archive_path=archive_path,
+                                                repeat=namespace.repeat)
+
+  result = {
+    'parameters': {
+      'n_files': namespace.n_files,
+      'median_size': namespace.median_size,
+      'size_sigma': namespace.size_sigma,
+      'max_depth': namespace.max_depth,
+      'mix': namespace.mix,
+      'seed': namespace.seed,
+      'archive': namespace.archive,
+      'platform': sys.platform,
+    },
+    'package_bytes': total_size,
+    'wheel_bytes': wheel_size,
+    'seconds': seconds,
+    'convert_phases': report['phases'],
+  }
+
+  for step, elapsed in seconds.items():
+    print(f'{step:<16} {elapsed:>8.3f}s')
+  print(f'{"MB/s":<16} {total_size / seconds["total"] / 1e6:>8.1f}')
+
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump(result, f, indent=2)
+
+  if namespace.compare is not None:
+    with open(namespace.compare) as f:
+      baseline = json.load(f)
+    if baseline.get('parameters') != result['parameters']:
+      print('The parameters differ from', namespace.compare)
+    regressions = compare(result, baseline, namespace.threshold)
+    for step, reference, elapsed in regressions:
+      print(f'{step} slowed down from {reference:.3f}s to {elapsed:.3f}s')
+    if regressions:
+      sys.exit(1)
@@ -0,0 +1,118 @@
+"""
+Startup latency of the console script entry points written by convert.py
+
+A site-packages directory with a trivial command line script, the libtbx
+shell dispatcher for the script in dispatcher_fixtures and a native
+executable is created in a temporary directory. The paths of the conda
+environment the dispatcher refers to (the python executable, site-packages
+and LIBTBX_BUILD) are links relative to the dispatcher. Every command is run
+through the subprocess entry point of the previous converter and through
+the entry point chosen by CondaWheelConverter._entry_point, and the median
+wall time per call is reported.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from convert import CondaWheelConverter
+
+# dispatchers written by libtbx for cctbx.show_symmetry
+FIXTURES_DIR = Path(__file__).resolve().parent / 'dispatcher_fixtures'
+
+# =============================================================================
+def make_site_packages(root, converter):
+  """Create site-packages in root and return the entry point modules,
+  (dispatcher, legacy module, new module) for every command."""
+  site_packages = Path(root) / 'lib' / 'site-packages'
+  dispatchers_path = site_packages / 'libtbx' / 'core' / 'dispatchers'
+  os.makedirs(dispatchers_path)
+  for init in ('libtbx', 'libtbx/core', 'libtbx/core/dispatchers'):
+    (site_packages / init / '__init__.py').touch()
+
+  # Python script and its dispatcher
+  script = site_packages / 'cctbx' / 'command_line' / 'show_symmetry.py'
+  os.makedirs(script.parent)
+  script.write_text('import sys\nsys.exit(0)\n')
+  # named like the Windows dispatchers in libtbx/core/dispatchers, whose
+  # console script is the name without .bat, but with shell commands
+  dispatcher = dispatchers_path / 'cctbx.show_symmetry.bat'
+  shutil.copy(FIXTURES_DIR / 'cctbx.show_symmetry', dispatcher)
+  os.chmod(dispatcher, 0o755)
+
+  # the conda environment of the dispatcher, LIBTBX_PREFIX is the parent
+  # of its directory
+  prefix = dispatchers_path.parent
+  os.makedirs(prefix / 'bin')
+  os.symlink(sys.executable, prefix / 'bin' / 'python3.12')
+  os.makedirs(prefix / 'lib' / 'python3.12')
+  os.symlink(site_packages, prefix / 'lib' / 'python3.12' / 'site-packages')
+  os.makedirs(prefix / 'share' / 'cctbx')
+
+  # native executable with the name of a binary wrapped by convert.py
+  binary_name = converter.binary_files[0]
+  binary = dispatchers_path / binary_name
+  shutil.copy(shutil.which('true'), binary)
+
+  commands = []
+  for name in (dispatcher.name, binary_name):
+    _, dispatcher_import = converter._entry_point_names(name)
+    legacy = converter.entry_point_template.format(dispatcher_name=name)
+    new = converter._entry_point(name, (dispatchers_path / name).read_bytes())
+    (dispatchers_path / f'legacy_{dispatcher_import}.py').write_text(legacy)
+    (dispatchers_path / f'{dispatcher_import}.py').write_text(new)
+    commands.append((name, f'legacy_{dispatcher_import}', dispatcher_import))
+  return site_packages, commands
+
+def time_entry_point(site_packages, module, repeat=20):
+  """Run an entry point like a console script and return the wall times."""
+  command = [sys.executable, '-c',
+             f'import sys; from libtbx.core.dispatchers.{module} import run_command; '
+             'sys.exit(run_command())']
+  env = dict(os.environ, PYTHONPATH=str(site_packages))
+  times = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    subprocess.run(command, env=env, check=True)
+    times.append(time.perf_counter() - t0)
+  return times
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--repeat', type=int, default=20,
+                      help='The number of calls of every entry point.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the timings to this JSON file.')
+  namespace = parser.parse_args()
+
+  if sys.platform == 'win32':
+    sys.exit('The benchmark uses a shell dispatcher and only runs on POSIX systems.')
+
+  result = {}
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    site_packages, commands = make_site_packages(tmp_dir, CondaWheelConverter())
+    for name, legacy, new in commands:
+      legacy_times = time_entry_point(site_packages, legacy, repeat=namespace.repeat)
+      new_times = time_entry_point(site_packages, new, repeat=namespace.repeat)
+      result[name] = {
+        'legacy_ms': statistics.median(legacy_times) * 1e3,
+        'new_ms': statistics.median(new_times) * 1e3,
+      }
+
+  print(f'{"command":<40} {"legacy":>10} {"new":>10} {"speedup":>8}')
+  for name, timing in result.items():
+    print(f'{name:<40} {timing["legacy_ms"]:>8.1f}ms {timing["new_ms"]:>8.1f}ms '
+          f'{timing["legacy_ms"] / timing["new_ms"]:>7.2f}x')
+
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump(result, f, indent=2)
@@ -0,0 +1,102 @@
+"""
+Cold-start import time of the wheel with and without precompiled bytecode
+
+Two wheels are built from the converted tree in the current directory
+(convert.py --conda-package-path must have been run), one with the
+compile-bytecode setting of build_backend.py. Both are unpacked into
+temporary directories and the top-level packages are imported in fresh
+interpreters with PYTHONDONTWRITEBYTECODE=1, so every run starts cold like
+on a freshly provisioned node or a read-only installation. The median wall
+time per run and the build times are reported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from build_backend import write_wheel
+
+# top-level packages imported by default, missing packages are skipped
+PACKAGES = ['libtbx', 'boost_adaptbx', 'scitbx', 'cctbx', 'iotbx', 'mmtbx']
+
+# =============================================================================
+def build_and_unpack(root, work_dir, compile_bytecode, jobs=None):
+  """Build a wheel, unpack its site-packages files into work_dir/site-packages
+  and return that directory and the build time."""
+  wheel_dir = os.path.join(work_dir, 'wheels')
+  t0 = time.perf_counter()
+  name = write_wheel(wheel_dir, root=root, jobs=jobs, compile_bytecode=compile_bytecode)
+  elapsed = time.perf_counter() - t0
+  site_packages = os.path.join(work_dir, 'site-packages')
+  with zipfile.ZipFile(os.path.join(wheel_dir, name)) as zf:
+    members = [info for info in zf.infolist() if '.data/' not in info.filename]
+    zf.extractall(site_packages, members=members)
+  return site_packages, elapsed
+
+def time_imports(site_packages, packages, repeat=10, env=None):
+  """Import the packages in fresh interpreters and return the wall times.
+  The environment of the interpreters is env (default os.environ) with
+  PYTHONPATH set to site_packages."""
+  command = [sys.executable, '-c', f'import {", ".join(packages)}']
+  env = dict(env if env is not None else os.environ, PYTHONPATH=site_packages,
+             PYTHONDONTWRITEBYTECODE='1')
+  times = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    subprocess.run(command, env=env, check=True)
+    times.append(time.perf_counter() - t0)
+  return times
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--root', type=str, default='.',
+                      help='The converted tree with conversion_manifest.json.')
+  parser.add_argument('--packages', type=str, default=None,
+                      help='Comma separated packages to import, the default is '
+                           f'{",".join(PACKAGES)}.')
+  parser.add_argument('--repeat', type=int, default=10,
+                      help='The number of fresh interpreters per wheel.')
+  parser.add_argument('--jobs', type=int, default=None,
+                      help='The number of workers for building the wheels.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the timings to this JSON file.')
+  namespace = parser.parse_args()
+
+  result = {}
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for variant, compile_bytecode in (('source', False), ('bytecode', True)):
+      work_dir = os.path.join(tmp_dir, variant)
+      site_packages, build_seconds = build_and_unpack(namespace.root, work_dir,
+                                                      compile_bytecode,
+                                                      jobs=namespace.jobs)
+      if namespace.packages is not None:
+        packages = namespace.packages.split(',')
+      else:
+        packages = [package for package in PACKAGES
+                    if os.path.isdir(os.path.join(site_packages, package))]
+      if not packages:
+        sys.exit('None of the packages are in the wheel, use --packages.')
+      times = time_imports(site_packages, packages, repeat=namespace.repeat)
+      result[variant] = {
+        'packages': packages,
+        'build_seconds': build_seconds,
+        'import_ms': statistics.median(times) * 1e3,
+      }
+
+  print()
+  print(f'{"wheel":<10} {"build":>10} {"import":>10}')
+  for variant, timing in result.items():
+    print(f'{variant:<10} {timing["build_seconds"]:>9.2f}s {timing["import_ms"]:>8.1f}ms')
+  print(f'Speedup of cold imports: '
+        f'{result["source"]["import_ms"] / result["bytecode"]["import_ms"]:.2f}x')
+
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump(result, f, indent=2)
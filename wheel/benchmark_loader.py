@@ -0,0 +1,137 @@
+"""
+Import time and dynamic loader probes with relative rpaths
+
+The wheel is built from the converted tree in the current directory
+(convert.py --conda-package-path --relative-rpaths must have been run) and
+unpacked twice:
+
+  relative     as built, the binaries find the bundled libraries with their
+               $ORIGIN rpaths and LD_LIBRARY_PATH is unset
+  search-path  the rpaths are removed and the libraries are found through
+               LD_LIBRARY_PATH, the search directories (the lib directory
+               of the active conda environment by default) followed by
+               site-packages, like the repair step of the workflow
+
+The extension modules and packages are imported in fresh interpreters and
+the median wall time is reported, with the number of files the dynamic
+loader tried in the process (LD_DEBUG=libs) and how many of them did not
+exist. Linux only, patchelf must be on PATH.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+from benchmark_imports import PACKAGES, build_and_unpack, time_imports
+from convert import HEADER_SIZE, native_format
+
+# =============================================================================
+def default_modules(site_packages):
+  """Return the packages of PACKAGES and the Boost.Python extension modules
+  (named *_ext) in site-packages."""
+  site_packages = Path(site_packages)
+  modules = [package for package in PACKAGES if (site_packages / package).is_dir()]
+  modules.extend(sorted(path.name.split('.')[0] for path in site_packages.glob('*_ext*.so')))
+  return modules
+
+def remove_rpaths(site_packages):
+  """Remove the rpaths of the ELF files below site_packages and return
+  their number."""
+  n_files = 0
+  for path in Path(site_packages).rglob('*'):
+    if not path.is_file() or path.is_symlink():
+      continue
+    with open(path, 'rb') as f:
+      if native_format(f.read(HEADER_SIZE)) != 'elf':
+        continue
+    subprocess.run(['patchelf', '--remove-rpath', str(path)], check=True)
+    n_files += 1
+  return n_files
+
+def count_probes(site_packages, modules, env):
+  """Return the number of files the dynamic loader tried in an interpreter
+  that imports the modules, and how many of them failed. The whole process
+  is counted, LD_LIBRARY_PATH is searched for the libraries of the
+  interpreter as well."""
+  command = [sys.executable, '-c', f'import {", ".join(modules)}']
+  env = dict(env, PYTHONPATH=site_packages, PYTHONDONTWRITEBYTECODE='1',
+             LD_DEBUG='libs')
+  output = subprocess.run(command, env=env, check=True, capture_output=True,
+                          text=True).stderr
+  tried = output.count('trying file=')
+  # every search that succeeds ends with one successful try
+  return tried, tried - output.count('find library=')
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--root', type=str, default='.',
+                      help='The converted tree with conversion_manifest.json.')
+  parser.add_argument('--modules', type=str, default=None,
+                      help='Comma separated modules to import, the default is '
+                           'the packages and *_ext extension modules in the wheel.')
+  parser.add_argument('--search-path', type=str, default=None,
+                      help='Colon separated directories searched before '
+                           'site-packages in the search-path variant, the '
+                           'default is $CONDA_PREFIX/lib.')
+  parser.add_argument('--repeat', type=int, default=10,
+                      help='The number of fresh interpreters per variant.')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Write the timings to this JSON file.')
+  namespace = parser.parse_args()
+
+  if not sys.platform.startswith('linux'):
+    sys.exit('The loader benchmark needs LD_DEBUG, which is only available on Linux.')
+  search_path = namespace.search_path
+  if search_path is None:
+    conda_prefix = os.environ.get('CONDA_PREFIX')
+    search_path = os.path.join(conda_prefix, 'lib') if conda_prefix is not None else ''
+
+  result = {}
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    relative, _ = build_and_unpack(namespace.root, os.path.join(tmp_dir, 'relative'),
+                                   compile_bytecode=False)
+    modules = namespace.modules.split(',') if namespace.modules is not None \
+      else default_modules(relative)
+    if not modules:
+      sys.exit('There is nothing to import in the wheel, use --modules.')
+    searched = os.path.join(tmp_dir, 'search-path', 'site-packages')
+    shutil.copytree(relative, searched, symlinks=True)
+    n_binaries = remove_rpaths(searched)
+
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('LD_LIBRARY_PATH', 'LD_DEBUG')}
+    variants = {
+      'relative': (relative, env),
+      'search-path': (searched, dict(env, LD_LIBRARY_PATH=os.pathsep.join(
+        [directory for directory in search_path.split(os.pathsep) if directory]
+        + [searched]))),
+    }
+    for variant, (site_packages, variant_env) in variants.items():
+      times = time_imports(site_packages, modules, repeat=namespace.repeat,
+                           env=variant_env)
+      tried, failed = count_probes(site_packages, modules, variant_env)
+      result[variant] = {
+        'modules': modules,
+        'import_ms': statistics.median(times) * 1e3,
+        'probes': tried,
+        'failed_probes': failed,
+      }
+
+  print()
+  print(f'Imported {", ".join(modules)} ({n_binaries} ELF files)')
+  print(f'{"variant":<12} {"import":>10} {"probes":>8} {"failed":>8}')
+  for variant, timing in result.items():
+    print(f'{variant:<12} {timing["import_ms"]:>8.1f}ms {timing["probes"]:>8} '
+          f'{timing["failed_probes"]:>8}')
+
+  if namespace.output is not None:
+    with open(namespace.output, 'w') as f:
+      json.dump(result, f, indent=2)
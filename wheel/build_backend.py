@@ -0,0 +1,251 @@
+"""
+In-tree PEP 517 build backend for the converted conda package
+
+The wheel is assembled from the files listed in conversion_manifest.json,
+which is written by convert.py --conda-package-path. The libraries are
+already built, so nothing is compiled and the tree is not scanned for
+package data.
+
+  src/  files installed into site-packages
+  lib/  libraries and extensions installed into site-packages
+  bin/  dispatchers installed as scripts
+
+Files that convert.py --dedup marked as duplicate_of another file are not
+stored, they are restored by a .pth file at the first interpreter start
+after installation (see WheelWriter.write_duplicates). Such wheels must be
+installed into a writable site directory, not with pip install --target or
+onto PYTHONPATH, where .pth files are not processed.
+
+With the compile-bytecode setting, all modules are compiled in parallel to
+checked-hash .pyc files in the wheel. Install the wheel with
+pip install --no-compile to keep them instead of compiling at install time.
+
+The debug sidecars written by convert.py --strip-debug are only part of the
+debug wheel of a split build. The files can be split into a runtime wheel
+and companion wheels (see SPLITS) that depend on it. The split setting builds one of them, because a
+PEP 517 frontend only keeps one wheel per build, and
+
+  python build_backend.py --split --wheel-dir wheels
+
+builds all of them with a size report.
+"""
+import argparse
+import json
+import os
+
+from pathlib import Path
+
+from debug_symbols import is_debug_file
+from wheel_writer import WheelWriter, parse_compression_levels, read_pyproject
+
+MANIFEST_FILE = 'conversion_manifest.json'
+
+# companion wheels of a split build, named <name>-<split>, and the prefixes of
+# the manifest keys of their files. The first matching split is used and
+# other files are in the runtime wheel, which has an extra for every split.
+SPLITS = {
+  # the debug sidecars of the native binaries, see debug_symbols.is_debug_file
+  'debug': (),
+  # dispatchers, the binaries wrapped as entry points and the console scripts
+  'dispatchers': ('bin/', 'src/libtbx/core/dispatchers/', 'src/libtbx/core/__init__.py'),
+  # the native test binaries and the test data in share, which convert.py
+  # marks as "test" in the manifest. The rest of share (e.g. libtbx_env,
+  # which the dispatchers point LIBTBX_BUILD to) and the headers are in the
+  # runtime wheel.
+  'tests': (),
+}
+
+# =============================================================================
+def load_manifest(root='.'):
+  manifest_file = Path(root) / MANIFEST_FILE
+  if not manifest_file.exists():
+    raise FileNotFoundError(f'{manifest_file} does not exist, convert a conda package '
+                            'with convert.py --conda-package-path first.')
+  with manifest_file.open() as f:
+    manifest = json.load(f)
+  for key in manifest:
+    if key.partition('/')[0] not in ('src', 'lib', 'bin'):
+      raise ValueError(f'{key} is not in src, lib or bin')
+  return manifest
+
+def split_of(key, entry=None):
+  """Return the wheel of a split build that contains a manifest key, entry
+  is the manifest entry of the key."""
+  if is_debug_file(key):
+    return 'debug'
+  if entry is not None and entry.get('test'):
+    return 'tests'
+  for split, prefixes in SPLITS.items():
+    if prefixes and key.startswith(prefixes):
+      return split
+  return 'runtime'
+
+def _split_keys(manifest, split):
+  """Return the keys of a wheel, all keys except the debug sidecars if
+  split is None, and the duplicates whose stored file is in the same
+  wheel."""
+  keys = []
+  duplicates = {}
+  for key in sorted(manifest):
+    if split is None and split_of(key) == 'debug':
+      continue
+    if split is not None and split_of(key, manifest[key]) != split:
+      continue
+    canonical = manifest[key].get('duplicate_of')
+    if canonical is not None \
+      and (split is None or split_of(canonical, manifest[canonical]) == split):
+      duplicates[key] = canonical
+    else:
+      keys.append(key)
+  return keys, duplicates
+
+def wheel_members(root='.', split=None):
+  """Return (tree, path below the tree, filename) for the files in the
+  manifest that are stored in the wheel."""
+  keys, _ = _split_keys(load_manifest(root), split)
+  return [(*key.split('/', 1), Path(root) / key) for key in keys]
+
+def wheel_duplicates(root='.', split=None):
+  """Return the duplicates as {path below the tree: path of the stored
+  file below its tree} and their total size."""
+  _, duplicates = _split_keys(load_manifest(root), split)
+  size = sum((Path(root) / key).stat().st_size for key in duplicates)
+  return {key.partition('/')[2]: canonical.partition('/')[2]
+          for key, canonical in duplicates.items()}, size
+
+def wheel_modules(root='.', split=None):
+  """Return (path below the tree, filename) for the Python modules in src
+  and lib, including duplicates, which are restored next to their .pyc
+  file."""
+  modules = []
+  manifest = load_manifest(root)
+  for key in sorted(manifest):
+    tree, _, arcname = key.partition('/')
+    if tree in ('src', 'lib') and arcname.endswith('.py') \
+      and (split is None or split_of(key, manifest[key]) == split):
+      modules.append((arcname, Path(root) / key))
+  return modules
+
+def split_project(project, split):
+  """Return the [project] table of a wheel of a split build."""
+  project = dict(project)
+  name = project['name']
+  version = project['version']
+  if split == 'runtime':
+    project['optional-dependencies'] = {
+      companion: [f'{name}-{companion}=={version}'] for companion in SPLITS}
+    project.pop('scripts', None)
+    return project
+  project['name'] = f'{name}-{split}'
+  project['description'] = f'{project.get("description", name)} ({split})'
+  project['dependencies'] = [f'{name}=={version}']
+  project.pop('entry-points', None)
+  if split != 'dispatchers':
+    project.pop('scripts', None)
+  return project
+
+def write_wheel(wheel_directory, root='.', jobs=None, compression_levels=None,
+                compile_bytecode=False, split=None):
+  """Write the wheel, or one wheel of a split build, and return its file
+  name."""
+  return os.path.basename(_write_wheel(wheel_directory, root=root, jobs=jobs,
+                                       compression_levels=compression_levels,
+                                       compile_bytecode=compile_bytecode,
+                                       split=split).filename)
+
+def _write_wheel(wheel_directory, root='.', jobs=None, compression_levels=None,
+                 compile_bytecode=False, split=None):
+  if split is not None and split != 'runtime' and split not in SPLITS:
+    raise ValueError(f'Unknown split {split}, use runtime or {", ".join(SPLITS)}.')
+  project = read_pyproject(os.path.join(root, 'pyproject.toml'))
+  if split is not None:
+    project = split_project(project, split)
+  writer = WheelWriter(wheel_directory, project['name'], project['version'],
+                       jobs=jobs, levels=compression_levels)
+  for tree, arcname, filename in wheel_members(root, split=split):
+    if tree == 'bin':
+      arcname = f'{writer.data_dir}/scripts/{arcname}'
+    writer.write_file(arcname, filename)
+  if compile_bytecode:
+    writer.write_bytecode(wheel_modules(root, split=split))
+    for arcname in writer.not_compiled:
+      print(f'Could not compile {arcname}')
+  duplicates, size = wheel_duplicates(root, split=split)
+  if duplicates:
+    writer.write_duplicates(duplicates, size=size)
+  writer.write_metadata(project, root=root)
+  writer.close()
+  print(writer.report())
+  return writer
+
+def write_split_wheels(wheel_directory, root='.', jobs=None, compression_levels=None,
+                       compile_bytecode=False):
+  """Write the runtime wheel and the companion wheels, print their sizes
+  and return their file names."""
+  rows = []
+  for split in ['runtime', *SPLITS]:
+    writer = _write_wheel(wheel_directory, root=root, jobs=jobs,
+                          compression_levels=compression_levels,
+                          compile_bytecode=compile_bytecode, split=split)
+    rows.append((split, os.path.basename(writer.filename), len(writer.zf.filelist),
+                 writer.file_size, os.path.getsize(writer.filename)))
+
+  total_size = sum(row[4] for row in rows)
+  print()
+  print(f'{"split":<12} {"files":>8} {"bytes":>14} {"wheel bytes":>14} {"share":>7}')
+  for split, _, n_files, file_size, wheel_size in rows:
+    print(f'{split:<12} {n_files:>8} {file_size:>14} {wheel_size:>14} '
+          f'{wheel_size / total_size if total_size else 0:>7.1%}')
+  print(f'{"total":<12} {sum(row[2] for row in rows):>8} {sum(row[3] for row in rows):>14} '
+        f'{total_size:>14}')
+  return [row[1] for row in rows]
+
+# =============================================================================
+# PEP 517 hooks
+#
+# config_settings (pip wheel --config-settings)
+#   jobs                number of compression workers
+#   compression-levels  see parse_compression_levels
+#   compile-bytecode    "true" to add .pyc files for the building interpreter
+#   split               "runtime" or a key of SPLITS to build one wheel of a
+#                       split build
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+  config_settings = config_settings or {}
+  jobs = config_settings.get('jobs')
+  levels = config_settings.get('compression-levels')
+  compile_bytecode = config_settings.get('compile-bytecode', 'false')
+  return write_wheel(wheel_directory,
+                     jobs=int(jobs) if jobs is not None else None,
+                     compression_levels=parse_compression_levels(levels)
+                       if levels is not None else None,
+                     compile_bytecode=compile_bytecode.lower() in ('1', 'true', 'yes'),
+                     split=config_settings.get('split'))
+
+def build_sdist(sdist_directory, config_settings=None):
+  raise RuntimeError('The converted conda package only contains prebuilt files, '
+                     'a source distribution cannot be built.')
+
+# =============================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build the wheels of the converted '
+                                   'conda package without a PEP 517 frontend.')
+  parser.add_argument('--wheel-dir', type=str, default='wheels',
+                      help='The output directory for the wheels.')
+  parser.add_argument('--split', action='store_true',
+                      help='Build the runtime wheel and the companion wheels.')
+  parser.add_argument('--jobs', type=int, default=None,
+                      help='The number of compression workers.')
+  parser.add_argument('--compression-levels', type=parse_compression_levels,
+                      default=None,
+                      help='See wheel_writer.parse_compression_levels.')
+  parser.add_argument('--compile-bytecode', action='store_true',
+                      help='Add .pyc files for this interpreter.')
+  namespace = parser.parse_args()
+  if namespace.split:
+    write_split_wheels(namespace.wheel_dir, jobs=namespace.jobs,
+                       compression_levels=namespace.compression_levels,
+                       compile_bytecode=namespace.compile_bytecode)
+  else:
+    write_wheel(namespace.wheel_dir, jobs=namespace.jobs,
+                compression_levels=namespace.compression_levels,
+                compile_bytecode=namespace.compile_bytecode)
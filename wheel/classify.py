@@ -0,0 +1,174 @@
+"""
+Rules for classifying the files of a conda package
+"""
+import sys
+
+# =============================================================================
+# The first matching rule decides where a file from paths.json is copied.
+#
+#   name       reported in the per-rule counts of convert.py --classify-only
+#   platforms  platforms the rule applies to, None for all platforms
+#   anchor     component that starts the path used by "first" and "after",
+#              the last occurrence in the parent directories is used
+#   match      conditions on the path, all of them must hold
+#     parent           component in the parent directories
+#     parent_contains  substring of the parent directory
+#     name_contains    substring of the file name
+#     binary           the file name is in binary_files
+#     binary_exe       the file name without ".exe" is in binary_files
+#     not_exe          the file name does not end with ".exe"
+#     first_contains   substring of the first directory (after the anchor)
+#     suffix           suffix of the file name
+#   dest       destination tree and the path below it
+#     name   only the file name
+#     path   the full path
+#     after  the path after the anchor
+#   kind       file list of the destination ('src', 'bin', 'lib'), None to ignore
+RULES = [
+  # ignore __pycache__ files
+  # ignore existing .egg-info and .dist-info directories
+  dict(name='pycache', match=dict(parent='__pycache__'), kind=None),
+  dict(name='egg-info', match=dict(parent_contains='egg-info'), kind=None),
+  dict(name='dist-info', match=dict(parent_contains='dist-info'), kind=None),
+  dict(name='pythonw', match=dict(name_contains='.pythonw.'), kind=None),
+  # binaries are wrapped as entry points
+  dict(name='binary', match=dict(binary=True),
+       dest=('entry_point', 'name'), kind='bin'),
+  # copy all dispatchers in bin
+  dict(name='bin', match=dict(first_contains='bin'),
+       dest=('bin', 'name'), kind='bin'),
+  # copy site-packages files to src
+  dict(name='site-packages', anchor='site-packages', match=dict(parent='site-packages'),
+       dest=('src', 'after'), kind='src'),
+  # copy share files to libtbx/core
+  dict(name='share', match=dict(first_contains='share'),
+       dest=('core', 'path'), kind='src'),
+  dict(name='extension', match=dict(suffix='.so'),
+       dest=('lib', 'name'), kind='lib'),
+  # Windows
+  dict(name='library-bin', platforms=['win32'], anchor='Library',
+       match=dict(parent='Library', first_contains='bin', not_exe=True),
+       dest=('entry_point', 'name'), kind='bin'),
+  dict(name='library-binary', platforms=['win32'], anchor='Library',
+       match=dict(parent='Library', first_contains='', binary_exe=True),
+       dest=('entry_point', 'name'), kind='bin'),
+  dict(name='library-share', platforms=['win32'], anchor='Library',
+       match=dict(parent='Library', first_contains='share'),
+       dest=('core', 'after'), kind='src'),
+  dict(name='library-include', platforms=['win32'], anchor='Library',
+       match=dict(parent='Library', first_contains='include'),
+       dest=('core', 'after'), kind='src'),
+  dict(name='library-lib', platforms=['win32'], anchor='Library',
+       match=dict(parent='Library', first_contains='lib'),
+       dest=('lib', 'name'), kind='lib'),
+  dict(name='library-other', platforms=['win32'], match=dict(parent='Library'), kind=None),
+  dict(name='lib', platforms=['win32'], anchor='Lib', match=dict(parent='Lib'),
+       dest=('lib', 'after'), kind='lib'),
+]
+
+# conditions that only depend on the parent directories
+PARENT_CONDITIONS = ('parent', 'parent_contains', 'first_contains')
+
+# =============================================================================
+class Classifier():
+  """Rule table compiled for one platform and set of binary names.
+
+  The conditions on the parent directories are evaluated once per
+  directory and cached, so classifying a file only checks the name
+  conditions of the rules that are still possible for its directory.
+
+  Parameters
+  ----------
+  binary_files : list of str
+      Names of binaries that are wrapped as entry points.
+  rules : list of dict, optional
+      The rule table. Default is RULES.
+  platform : str, optional
+      The target platform. Default is sys.platform.
+  """
+  def __init__(self, binary_files, rules=None, platform=None):
+    self.binary_files = frozenset(binary_files)
+    self.platform = platform if platform is not None else sys.platform
+    self.rules = [rule for rule in (rules if rules is not None else RULES)
+                  if rule.get('platforms') is None or self.platform in rule['platforms']]
+    self.counts = dict.fromkeys([rule['name'] for rule in self.rules] + ['unmatched'], 0)
+    self._parent_cache = {}
+
+  # ---------------------------------------------------------------------------
+  def _parent_candidates(self, parent):
+    """Return (rule, anchor index) for the rules whose parent conditions
+    hold for a tuple of parent directories."""
+    candidates = self._parent_cache.get(parent)
+    if candidates is not None:
+      return candidates
+    parent_string = '/'.join(parent)
+    candidates = []
+    for rule in self.rules:
+      match = rule['match']
+      anchor = rule.get('anchor')
+      index = -1
+      if anchor is not None:
+        if anchor not in parent:
+          continue
+        index = len(parent) - 1 - parent[::-1].index(anchor)
+      if 'parent' in match and match['parent'] not in parent:
+        continue
+      if 'parent_contains' in match and match['parent_contains'] not in parent_string:
+        continue
+      if 'first_contains' in match:
+        # the first directory after the anchor, or the first directory
+        if index + 1 >= len(parent) \
+          or match['first_contains'] not in parent[index + 1]:
+          continue
+      candidates.append((rule, index))
+    candidates = tuple(candidates)
+    self._parent_cache[parent] = candidates
+    return candidates
+
+  def _name_matches(self, match, name):
+    if 'name_contains' in match and match['name_contains'] not in name:
+      return False
+    if 'binary' in match and name not in self.binary_files:
+      return False
+    if 'binary_exe' in match and name[:-4] not in self.binary_files:
+      return False
+    if 'not_exe' in match and name.endswith('.exe'):
+      return False
+    if 'suffix' in match and not (name.endswith(match['suffix']) and name != match['suffix']):
+      return False
+    return True
+
+  # ---------------------------------------------------------------------------
+  def classify(self, path):
+    """Classify a path from paths.json.
+
+    Parameters
+    ----------
+    path : str
+        The "/" separated path relative to the package root.
+
+    Returns
+    -------
+    (str, str or None, tuple of str, str or None)
+        The rule name, the destination tree, the path components below
+        the destination tree and the file list of the destination. The
+        tree and the file list are None if the file is ignored.
+    """
+    parts = tuple(path.split('/'))
+    parent, name = parts[:-1], parts[-1]
+    for rule, index in self._parent_candidates(parent):
+      if not self._name_matches(rule['match'], name):
+        continue
+      self.counts[rule['name']] += 1
+      if rule['kind'] is None:
+        return rule['name'], None, (), None
+      tree, subpath = rule['dest']
+      if subpath == 'name':
+        relative = (name,)
+      elif subpath == 'path':
+        relative = parts
+      else:
+        relative = parts[index + 1:]
+      return rule['name'], tree, relative, rule['kind']
+    self.counts['unmatched'] += 1
+    return 'unmatched', None, (), None
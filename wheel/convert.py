@@ -1,16 +1,579 @@
 import argparse
-import glob
+import fnmatch
+import hashlib
+import io
 import json
 import os
+import re
 import shutil
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 
+from collections import Counter
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
 from pathlib import Path
-from subprocess import check_output
+
+from classify import Classifier
+from debug_symbols import DebugSymbolSplitter, format_sizes
+from instrument import ConversionReport
+from rpaths import TOOLS, LibraryBundler, RpathFixer
+from wheel_writer import WheelWriter, parse_compression_levels, read_pyproject
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# ioctl request for cloning file extents (Linux), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# size of the blocks for byte copies
+CHUNK_SIZE = 1024 * 1024
+
+# number of leading bytes needed by native_format
+HEADER_SIZE = 8
+
+# position of the offset of the PE signature in the DOS header of PE files,
+# see is_pe_file
+PE_OFFSET_POSITION = 0x3C
+PE_SIGNATURE = b'PE\0\0'
+
+# smaller files are not worth restoring after installation, see
+# CondaWheelConverter.find_duplicates
+MIN_DUPLICATE_SIZE = 4096
+
+# suffixes of native libraries and extensions, which are never deduplicated
+# because an import fails if they are missing, see is_native_library
+NATIVE_SUFFIXES = ('.so', '.dylib', '.pyd', '.dll')
+
+# names of the native binaries in share that only run tests, and the
+# directories of share/<module> with test data, which are marked as "test"
+# in the manifest for the tests wheel of a split build (see build_backend)
+TEST_BINARY_PATTERNS = ('tst*', '*test*', 'driver?', 'fftpack_timer', 'hybrid_36_fem',
+                        'time_trigonometry')
+TEST_DATA_DIRECTORIES = ('regression', 'tests')
+
+# files of the wheel directory that are copied into every target of a batch
+# conversion, see convert_packages
+TARGET_FILES = ['build_backend.py', 'debug_symbols.py', 'pyproject.toml', 'README.md',
+                'wheel_writer.py']
+
+# line of a libtbx dispatcher (shell or batch) that runs a Python script
+PYTHON_DISPATCHER = re.compile(
+  r'"(?:\$LIBTBX_PYEXE|%LIBTBX_PYEXE%)"\s+"([^"]+\.py)"\s*(?:"\$@"|%\*)?\s*$',
+  re.MULTILINE)
+
+# lines of a dispatcher that set variables, "@set NAME=value" in batch files
+# and NAME="value" in shell scripts, which are only passed on with export
+# unless they are in the environment already, and "unset NAME"
+BATCH_ASSIGNMENT = re.compile(r'^@?set\s+"?([A-Za-z_]\w*)=(.*?)"?$', re.IGNORECASE)
+SHELL_ASSIGNMENT = re.compile(r'^(export\s+)?([A-Za-z_]\w*)=(?:"(.*)"|([^\s"]*))$')
+SHELL_EXPORT = re.compile(r'^export((?:\s+[A-Za-z_]\w*)+)$')
+SHELL_UNSET = re.compile(r'^unset((?:\s+[A-Za-z_]\w*)+)$')
+
+# "@for %%F in ("value") do @set NAME=%%~dpF", which sets NAME to the
+# directory of value with a trailing separator
+BATCH_PARENT = re.compile(
+  r'^@?for\s+%%(\w)\s+in\s+\("([^"]*)"\)\s+do\s+@?set\s+"?([A-Za-z_]\w*)=%%~dp\1"?$',
+  re.IGNORECASE)
+
+# conditional blocks of shell dispatchers, only tests whether a variable is
+# empty (e.g. PYTHONPATH) may guard assignments
+SHELL_TEST = re.compile(r'^(if|elif)\s+\[\s+(-n|-z)\s+"\$\{?([A-Za-z_]\w*)\}?"\s+\];?\s*then$')
+SHELL_BRANCH = re.compile(r'^(?:(if|elif)\s.*;\s*then|else|fi)$')
+
+# lines of a dispatcher that do not change the environment of the script
+DISPATCHER_COMMENT = re.compile(r'^(?:#.*|::.*|@?rem(?:\s.*)?|@?echo off|@?setlocal|)$',
+                                re.IGNORECASE)
+
+# references in the values of the assignments: the directory of the
+# dispatcher in shell scripts ($(dirname "$0") and $(cd "$(dirname "$0")" &&
+# cd ... && pwd)), the dispatcher path (%~dp0, %~nx0, %~n0, %0, $0),
+# substrings of batch variables (%NAME:~start,length%) and variables
+# (%NAME%, $NAME, ${NAME})
+DISPATCHER_REFERENCE = re.compile(
+  r'\$\(cd "\$\(dirname "\$0"\)"(?P<cd>(?: && cd [^\s&$"`();]+)*) && pwd(?: -P)?\)'
+  r'|(?P<dirname>\$\(dirname "\$0"\))'
+  r'|%(?P<path>~dp0|~nx0|~n0|0)'
+  r'|%(?P<substring>\w+):~(?P<start>-?\d+)(?:,(?P<length>-?\d+))?%'
+  r'|%(?P<batch>\w+)%|\$\{(?P<braced>\w+)\}|\$(?P<plain>\w+)')
+
+# =============================================================================
+def dispatcher_value(value):
+  """Return the parts of the value of a dispatcher assignment, or None if it
+  uses syntax that cannot be reproduced in-process (other command
+  substitutions, escapes or quotes inside the value).
+
+  Every part is (kind, text), where kind is "text", "variable", "path" (the
+  dispatcher path with a batch modifier, "0" for the full path),
+  "directory" (a path relative to the directory of the dispatcher) or
+  "substring" ((name, start, length) of a batch substring).
+  """
+  parts = []
+  position = 0
+  for reference in DISPATCHER_REFERENCE.finditer(value):
+    parts.append(('text', value[position:reference.start()]))
+    groups = reference.groupdict()
+    if groups['cd'] is not None or groups['dirname'] is not None:
+      directories = (groups['cd'] or '').split(' && cd ')[1:]
+      parts.append(('directory', '/'.join(directories) or '.'))
+    elif groups['path'] is not None:
+      parts.append(('path', groups['path']))
+    elif groups['plain'] == '0':
+      parts.append(('path', '0'))
+    elif groups['substring'] is not None:
+      length = groups['length']
+      parts.append(('substring', (groups['substring'], int(groups['start']),
+                                  int(length) if length is not None else None)))
+    else:
+      parts.append(('variable', groups['batch'] or groups['braced'] or groups['plain']))
+    position = reference.end()
+  parts.append(('text', value[position:]))
+  parts = [part for part in parts if part != ('text', '')]
+  if any(kind == 'text' and any(c in text for c in '%$`^"') for kind, text in parts):
+    return None
+  return parts
+
+def dispatcher_environment(text):
+  """Return the variables a dispatcher sets for its Python script as a list
+  of (name, value, exported, conditions), or None if the dispatcher does
+  anything else or uses syntax that cannot be reproduced in-process.
+
+  The value is a list of parts (see dispatcher_value), a "parent" part has
+  the parts of a batch %%~dpF value, and None for unset variables. The
+  assignment only applies if every (name, nonempty) condition holds, the
+  tests of if/elif blocks are stored in variables named "?<index>" when the
+  test is reached.
+  """
+  assignments = []
+  exported = set()
+  # (tests of the previous branches, conditions of the current branch) of
+  # the open if blocks, the name of a test of anything but a variable is
+  # None
+  blocks = []
+  n_tests = 0
+
+  def conditions():
+    return tuple(condition for _, current in blocks for condition in current)
+
+  for line in text.splitlines():
+    line = line.strip()
+    if DISPATCHER_COMMENT.match(line) or PYTHON_DISPATCHER.search(line):
+      continue
+
+    # if/elif/else/fi
+    match = SHELL_BRANCH.match(line)
+    if match is not None:
+      keyword = match.group(1) or line
+      if keyword in ('elif', 'else', 'fi') and not blocks:
+        return None
+      if keyword in ('elif', 'else', 'fi'):
+        previous, _ = blocks.pop()
+      else:
+        previous = []
+      if keyword == 'fi':
+        continue
+      negated = tuple((test, not nonempty) for test, nonempty in previous)
+      if keyword == 'else':
+        blocks.append((previous, negated))
+        continue
+      test = SHELL_TEST.match(line)
+      if test is not None:
+        name = f'?{n_tests}'
+        n_tests += 1
+        assignments.append((name, [('variable', test.group(3))], conditions()))
+        condition = (name, test.group(2) == '-n')
+      else:
+        condition = (None, True)
+      blocks.append((previous + [condition], negated + (condition,)))
+      continue
+
+    # assignments, exports and unset
+    match = BATCH_PARENT.match(line)
+    if match is not None:
+      _, value, name = match.groups()
+      value = dispatcher_value(value)
+      if value is None:
+        return None
+      value = [('parent', value)]
+      exported.add(name)
+    else:
+      match = BATCH_ASSIGNMENT.match(line)
+      if match is not None:
+        name, value = match.groups()
+        value = dispatcher_value(value)
+        exported.add(name)
+      else:
+        match = SHELL_ASSIGNMENT.match(line)
+        if match is not None:
+          export, name, quoted, plain = match.groups()
+          value = dispatcher_value(quoted if quoted is not None else plain)
+          if export:
+            exported.add(name)
+        else:
+          match = SHELL_EXPORT.match(line) or SHELL_UNSET.match(line)
+          if match is None:
+            return None
+          names = match.group(1).split()
+          if line.startswith('unset'):
+            assignments.extend((name, None, conditions()) for name in names)
+          exported.update(names)
+          continue
+      if value is None:
+        return None
+    assignments.append((name, value, conditions()))
+
+  # variables can only be set in branches with tests of variables
+  if blocks or any(test is None for _, _, conditions in assignments
+                   for test, _ in conditions):
+    return None
+  return [(name, value, name in exported, conditions)
+          for name, value, conditions in assignments]
+
+def is_pe_file(filename):
+  """Return True if a file starting with "MZ" has the PE signature at the
+  offset stored at 0x3C (e_lfanew), like executables and DLLs, unlike text
+  and data files that happen to start with "MZ"."""
+  try:
+    with open(filename, 'rb') as f:
+      f.seek(PE_OFFSET_POSITION)
+      offset = f.read(4)
+      if len(offset) < 4:
+        return False
+      f.seek(int.from_bytes(offset, 'little'))
+      return f.read(4) == PE_SIGNATURE
+  except (OSError, OverflowError, ValueError):
+    return False
+
+def native_format(header, filename=None):
+  """Return "elf", "mach-o" or "pe" if the leading bytes of a file are the
+  magic number of a native executable or library, otherwise None. The
+  magic number of PE files is only two bytes, so they are only recognized
+  if filename is given and has a valid PE header (see is_pe_file)."""
+  magic = header[:4]
+  if magic == b'\x7fELF':
+    return 'elf'
+  if magic in (b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe',
+               b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe'):
+    return 'mach-o'
+  # universal binaries share the magic number with Java class files, which
+  # have the class file version (>= 45) instead of the number of architectures
+  if magic == b'\xca\xfe\xba\xbe' and len(header) >= 8 \
+    and int.from_bytes(header[4:8], 'big') < 45:
+    return 'mach-o'
+  if magic[:2] == b'MZ' and filename is not None and is_pe_file(filename):
+    return 'pe'
+  return None
+
+def is_native_library(name):
+  """Return True if a file name has the suffix of a native library or
+  extension, including versioned shared libraries like libz.so.1."""
+  return name.lower().endswith(NATIVE_SUFFIXES) or '.so.' in name
+
+def copy_stream(fsrc, fdest, chunk_size=CHUNK_SIZE, hasher=None):
+  """Copy between open binary files and return the leading bytes. The
+  bytes are also passed to hasher if it is given, fdest may be None to
+  only hash the file."""
+  header = b''
+  for chunk in iter(lambda: fsrc.read(chunk_size), b''):
+    if len(header) < HEADER_SIZE:
+      header += chunk[:HEADER_SIZE - len(header)]
+    if fdest is not None:
+      fdest.write(chunk)
+    if hasher is not None:
+      hasher.update(chunk)
+  return header
+
+def materialize_file(source, dest, allow_hardlink=False, allow_reflink=True,
+                     hasher=None):
+  """Create dest with the contents of source as cheaply as possible.
+
+  A copy-on-write clone (reflink) is tried first, then a hardlink if it
+  is allowed and both paths are on the same filesystem, and finally a
+  regular byte copy. The file mode of source is always preserved.
+  Hardlinks share the inode with the conda package, so they must only
+  be used for files that are never modified after copying.
+
+  Parameters
+  ----------
+  source : Path
+      The file in the extracted conda package.
+  dest : Path
+      The destination, any existing file is replaced.
+  allow_hardlink : bool, optional
+      Whether a hardlink may be created. Default is False.
+  allow_reflink : bool, optional
+      Whether a reflink may be created. Default is True.
+  hasher : hashlib hash object, optional
+      Updated with the contents of source. A byte copy hashes the blocks
+      while copying them, a reflink or hardlink reads source once.
+
+  Returns
+  -------
+  (str, bytes)
+      The method used, one of "reflink", "hardlink" or "copy", and the
+      leading bytes of the file for native_format.
+  """
+  # never write through an existing (possibly hardlinked) destination
+  if os.path.lexists(dest):
+    os.remove(dest)
+
+  if allow_hardlink \
+    and os.stat(source).st_dev == os.stat(os.path.dirname(dest)).st_dev:
+    try:
+      os.link(source, dest)
+    except OSError:
+      pass
+    else:
+      with open(source, 'rb') as fsrc:
+        if hasher is not None:
+          return 'hardlink', copy_stream(fsrc, None, hasher=hasher)
+        return 'hardlink', fsrc.read(HEADER_SIZE)
+
+  with open(source, 'rb') as fsrc:
+    if allow_reflink and fcntl is not None and sys.platform.startswith('linux'):
+      try:
+        with open(dest, 'wb') as fdest:
+          fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        shutil.copymode(source, dest)
+        if hasher is not None:
+          return 'reflink', copy_stream(fsrc, None, hasher=hasher)
+        return 'reflink', fsrc.read(HEADER_SIZE)
+      except OSError:
+        pass
+
+    with open(dest, 'wb') as fdest:
+      header = copy_stream(fsrc, fdest, hasher=hasher)
+  shutil.copymode(source, dest)
+  return 'copy', header
+
+def peek_header(fileobj):
+  """Return the leading bytes of a file object without consuming them."""
+  if hasattr(fileobj, 'peek'):
+    return fileobj.peek(HEADER_SIZE)[:HEADER_SIZE]
+  header = fileobj.read(HEADER_SIZE)
+  fileobj.seek(-len(header), os.SEEK_CUR)
+  return header
+
+def verify_file(file_json, sha256, size):
+  """Raise ValueError if the sha256 or size of a copied file do not match
+  its paths.json entry. Missing values in the entry and softlinks, whose
+  values may describe the link or its target, are not checked."""
+  if file_json.get('path_type') == 'softlink':
+    return
+  expected_size = file_json.get('size_in_bytes')
+  if expected_size is not None and size != expected_size:
+    raise ValueError(f'{file_json["_path"]} has {size} bytes, but paths.json '
+                     f'lists {expected_size} bytes.')
+  expected_sha256 = file_json.get('sha256')
+  if expected_sha256 is not None and sha256 != expected_sha256:
+    raise ValueError(f'{file_json["_path"]} has sha256 {sha256}, but paths.json '
+                     f'lists {expected_sha256}.')
+
+class HashingReader():
+  """Read-only file object that hashes the bytes read from fileobj."""
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.hasher = hashlib.sha256()
+    self.size = 0
+
+  def read(self, size=-1):
+    data = self.fileobj.read(size)
+    self.hasher.update(data)
+    self.size += len(data)
+    return data
+
+  def peek(self, size=0):
+    return self.fileobj.peek(size)
+
+  def hexdigest(self):
+    return self.hasher.hexdigest()
+
+# =============================================================================
+class SharedFileCache():
+  """Content addressed store for the files that several conversions share.
+
+  A file is stored once as <root>/<sha256[:2]>/<sha256>-<mode> after its
+  contents were checked against paths.json, and conversions hardlink it
+  into their trees, so the trees must be on the filesystem of the cache to
+  share the files. Files are written to a temporary name and renamed, so
+  concurrent processes never see partial files.
+
+  Parameters
+  ----------
+  root : str or Path
+      The cache directory.
+  hashes : set of str, optional
+      The sha256 of the files that are shared. Default is None, all files
+      with a sha256.
+  """
+  def __init__(self, root, hashes=None):
+    self.root = Path(root).resolve()
+    self.hashes = frozenset(hashes) if hashes is not None else None
+
+  def shares(self, file_json):
+    """Return True if a paths.json entry is stored in the cache, the
+    hash of softlinks may describe their target."""
+    if file_json is None or file_json.get('path_type') == 'softlink':
+      return False
+    sha256 = file_json.get('sha256')
+    return sha256 is not None and (self.hashes is None or sha256 in self.hashes)
+
+  def path(self, sha256, mode):
+    return self.root / sha256[:2] / f'{sha256}-{mode & 0o777:o}'
+
+  def add(self, source, file_json):
+    """Store a file unless it is stored already, and return its path in the
+    cache and whether it was stored."""
+    cached = self.path(file_json['sha256'], os.stat(source).st_mode)
+    if cached.exists():
+      return cached, False
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cached.with_name(f'{cached.name}.{os.getpid()}.{threading.get_ident()}')
+    hasher = hashlib.sha256()
+    try:
+      # never hardlink the cache to the conda package, it may be deleted
+      materialize_file(source, tmp_file, hasher=hasher)
+      verify_file(file_json, hasher.hexdigest(), os.path.getsize(tmp_file))
+      os.replace(tmp_file, cached)
+    finally:
+      if tmp_file.exists():
+        tmp_file.unlink()
+    return cached, True
+
+  def materialize(self, source, dest, file_json):
+    """Create dest from the cached copy of a file, like materialize_file.
+
+    Native binaries are copied because they may be patched in place, other
+    files are hardlinked to the cache.
+    """
+    cached, _ = self.add(source, file_json)
+    if os.path.lexists(dest):
+      os.remove(dest)
+    with open(cached, 'rb') as f:
+      header = f.read(HEADER_SIZE)
+    if native_format(header, cached) is None:
+      try:
+        os.link(cached, dest)
+        return 'cache', header
+      except OSError:
+        pass
+    return materialize_file(cached, dest)
+
+# =============================================================================
+def _zstd_reader(fileobj):
+  try:
+    from compression import zstd
+    return zstd.ZstdFile(fileobj)
+  except ImportError:
+    pass
+  try:
+    import zstandard
+  except ImportError:
+    raise ImportError('Reading .conda packages requires Python 3.14 or the zstandard package.')
+  return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+def member_name(name):
+  """Return the package relative path of a tar member name."""
+  if name.startswith('./'):
+    name = name[2:]
+  return name
+
+def iter_package_members(archive_path, component):
+  """Stream the members of a conda package without extracting it.
+
+  Parameters
+  ----------
+  archive_path : Path
+      A .conda or .tar.bz2 package.
+  component : str
+      "info" for the package metadata or "pkg" for the payload.
+
+  Yields
+  ------
+  (tarfile.TarInfo, tarfile.TarFile)
+      The member and the open archive. The member contents must be read
+      with extractfile before advancing to the next member.
+  """
+  archive_path = Path(archive_path)
+  if archive_path.name.endswith('.conda'):
+    stem = archive_path.name[:-len('.conda')]
+    with zipfile.ZipFile(archive_path) as zf, \
+      zf.open(f'{component}-{stem}.tar.zst') as f, \
+      _zstd_reader(f) as zst, \
+      tarfile.open(fileobj=zst, mode='r|') as tar:
+      for member in tar:
+        yield member, tar
+  elif archive_path.name.endswith('.tar.bz2'):
+    with tarfile.open(archive_path, mode='r|bz2') as tar:
+      for member in tar:
+        if member_name(member.name).startswith('info/') == (component == 'info'):
+          yield member, tar
+  else:
+    raise ValueError(f'Unknown conda package format: {archive_path}')
+
+def load_package_info(package_path):
+  """Return the lines of info/files and the contents of info/paths.json of
+  an extracted conda package or a .conda or .tar.bz2 archive."""
+  package_path = Path(package_path)
+  if package_path.is_dir():
+    with (package_path / 'info' / 'files').open() as f:
+      file_list = f.readlines()
+    with (package_path / 'info' / 'paths.json').open() as f:
+      paths_list = json.load(f)
+    return file_list, paths_list
+
+  info = {}
+  for member, tar in iter_package_members(package_path, 'info'):
+    name = member_name(member.name)
+    if name in ('info/files', 'info/paths.json'):
+      info[name] = tar.extractfile(member).read().decode('utf8')
+      if len(info) == 2:
+        break
+  file_list = info['info/files'].splitlines()
+  paths_list = json.loads(info['info/paths.json'])
+  return file_list, paths_list
 
 # =============================================================================
 class CondaWheelConverter():
-  def __init__(self):
+  def __init__(self, jobs=None, copy_mode='auto', incremental=False, rpath_tool=None,
+               output='verbose', verify=False, dedup=False, strip_debug=False,
+               relative_rpaths=False, shared_cache=None):
+
+    # number of parallel workers for copying files
+    self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+
+    # "auto" tries reflinks and hardlinks before copying, "copy" always copies
+    assert copy_mode in ('auto', 'copy'), copy_mode
+    self.copy_mode = copy_mode
+
+    # reuse unchanged files from the previous conversion in the same tree
+    self.incremental = incremental
+    self.manifest_file = Path('conversion_manifest.json').resolve()
+
+    # tool for rewriting library references (see rpaths.TOOLS), rpaths are
+    # only fixed on macOS if it is None
+    assert rpath_tool is None or rpath_tool in TOOLS, rpath_tool
+    self.rpath_tool = rpath_tool
+
+    # timing of the conversion phases and console output
+    self.report = ConversionReport(output=output)
+
+    # check copied files against the sha256 and size in paths.json
+    self.verify = verify
+
+    # store files with the same contents once in the wheel, the duplicates
+    # are restored at interpreter startup by a module added to the wheel
+    self.dedup = dedup
+
+    # move the debug information of native binaries to sidecar files and
+    # strip the binaries, see debug_symbols
+    self.strip_debug = strip_debug
 
     # python package locations
     self.src_path = (Path('.') / 'src').resolve()
@@ -19,17 +582,6 @@ class CondaWheelConverter():
     self.core_path = (self.src_path / 'libtbx' / 'core').resolve()  # share
     self.entry_point_path = (self.src_path / 'libtbx' / 'core' / 'dispatchers').resolve()  # binaries or dispatchers on Windows
 
-    # create directories
-    os.makedirs(self.src_path, exist_ok=True)
-    os.makedirs(self.bin_path, exist_ok=True)
-    os.makedirs(self.lib_path, exist_ok=True)
-    os.makedirs(self.core_path, exist_ok=True)
-    os.makedirs(self.entry_point_path, exist_ok=True)
-
-    # create __init__.py
-    (Path(self.entry_point_path) / '__init__.py').touch()
-    (Path(self.entry_point_path.parent) / '__init__.py').touch()
-
     # copied files
     self.src_files = []
     self.bin_files = []
@@ -45,11 +597,38 @@ class CondaWheelConverter():
       'cctbx.find_distances',
       ]
 
-    # binary files in share that are used for testing
+    # destination trees and file lists used by the classification rules
+    self.trees = {
+      'src': self.src_path,
+      'bin': self.bin_path,
+      'lib': self.lib_path,
+      'core': self.core_path,
+      'entry_point': self.entry_point_path,
+    }
+    self.file_lists = {
+      'src': self.src_files,
+      'bin': self.bin_files,
+      'lib': self.lib_files,
+    }
+    self.classifier = Classifier(self.binary_files)
+
+    # native executables and libraries found while copying
+    self.native_files = []
+
+    # native binaries in share that are used for testing
     self.shared_binary_files = []
 
-    # for self.fix_rpaths
-    self.fixed_dylib = []
+    # for self.fix_rpaths, created when the conda environment is needed
+    self.rpath_fixer = None
+
+    # point the binaries to the lib tree with relative rpaths instead, and
+    # bundle the libraries they load from the conda environment there
+    self.relative_rpaths = relative_rpaths
+    self.library_bundler = None
+
+    # SharedFileCache for the files that are identical in several packages
+    # of a batch conversion, see convert_packages
+    self.shared_cache = shared_cache
 
     # template for entry point for running dispatchers/executables
     self.entry_point_template =  '''\
@@ -67,19 +646,115 @@ def run_command():
   sys.exit(subprocess.call([executable, *sys.argv[1:]], shell=False))
 '''
 
+    # template for entry point for running native executables, the process
+    # is replaced instead of waiting for a child process
+    self.binary_entry_point_template =  '''\
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+def run_command():
+  import libtbx.core.dispatchers
+  executable = Path(libtbx.core.dispatchers.__file__).parent / '{dispatcher_name}'
+  executable = str(executable.resolve())
+
+  # Windows has no exec
+  if sys.platform == 'win32':
+    sys.exit(subprocess.call([executable, *sys.argv[1:]], shell=False))
+  os.execv(executable, [executable, *sys.argv[1:]])
+'''
+
+    # template for entry point for dispatchers that run a Python script, the
+    # script is run in the same interpreter with the environment the
+    # dispatcher sets, see dispatcher_environment
+    self.script_entry_point_template =  '''\
+import os
+import runpy
+import sys
+
+from pathlib import Path
+
+# (name, value parts, exported, conditions) of the variables set by the
+# dispatcher, see convert.dispatcher_environment
+ENVIRONMENT = {environment!r}
+
+def evaluate(parts, variables, dispatcher):
+  """Return the value of an assignment of the dispatcher."""
+  paths = {{
+    '~dp0': str(dispatcher.parent) + os.sep,
+    '~nx0': dispatcher.name,
+    '~n0': dispatcher.stem,
+    '0': str(dispatcher),
+  }}
+  value = ''
+  for kind, text in parts:
+    if kind == 'text':
+      value += text
+    elif kind == 'variable':
+      value += variables.get(text, '')
+    elif kind == 'path':
+      value += paths[text]
+    elif kind == 'directory':
+      value += str((dispatcher.parent / text).resolve())
+    elif kind == 'substring':
+      name, start, length = text
+      substring = variables.get(name, '')[start:]
+      value += substring if length is None else substring[:length]
+    elif kind == 'parent':
+      value += os.path.join(os.path.dirname(evaluate(text, variables, dispatcher)), '')
+  return value
+
+def apply_environment(dispatcher, environ):
+  """Set and unset the variables of the dispatcher in environ."""
+  variables = dict(environ)
+  for name, parts, exported, conditions in ENVIRONMENT:
+    if not all(bool(variables.get(test)) == nonempty for test, nonempty in conditions):
+      continue
+    if parts is None:
+      variables.pop(name, None)
+      environ.pop(name, None)
+      continue
+    variables[name] = evaluate(parts, variables, dispatcher)
+    # variables from the environment are passed on without export
+    if exported or name in environ:
+      environ[name] = variables[name]
+
+def run_command():
+  import libtbx.core.dispatchers
+  dispatcher = Path(libtbx.core.dispatchers.__file__).parent / '{dispatcher_name}'
+  site_packages = dispatcher.parents[3]
+  script = site_packages / '{script}'
+
+  os.environ['LIBTBX_DISPATCHER_NAME'] = '{dispatcher_stem}'
+  apply_environment(dispatcher, os.environ)
+
+  # the interpreter started by the dispatcher had the script directory and
+  # PYTHONPATH at the front of sys.path
+  python_path = [path for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path]
+  sys.path[0:0] = [str(script.parent), *python_path]
+  runpy.run_path(str(script), run_name='__main__')
+'''
+
   # ---------------------------------------------------------------------------
-  def copy_files(self, package_path):
-    print('='*79)
-    print('Copying files')
-    print('='*79)
+  def _create_tree(self):
+    # create directories
+    os.makedirs(self.src_path, exist_ok=True)
+    os.makedirs(self.bin_path, exist_ok=True)
+    os.makedirs(self.lib_path, exist_ok=True)
+    os.makedirs(self.core_path, exist_ok=True)
+    os.makedirs(self.entry_point_path, exist_ok=True)
 
-    # load file metadata from conda package
-    package_path = Path(package_path)
-    with (package_path / 'info' / 'files').open() as f:
-      file_list = f.readlines()
-    with (package_path / 'info' / 'paths.json').open() as f:
-      paths_list = json.load(f)
+    # create __init__.py, existing files are not touched for incremental
+    # conversions
+    for init_file in (Path(self.entry_point_path) / '__init__.py',
+                      Path(self.entry_point_path.parent) / '__init__.py'):
+      if not init_file.exists():
+        init_file.touch()
 
+  # ---------------------------------------------------------------------------
+  def _check_file_lists(self, file_list, paths_list):
     paths_file_list = []
     for f in paths_list['paths']:
       paths_file_list.append(f['_path'])
@@ -93,274 +768,1165 @@ def run_command():
       assert file_list[i].strip() == paths_file_list[i].strip(), \
         (file_list[i].strip(), paths_file_list[i].strip())
 
+  # ---------------------------------------------------------------------------
+  def copy_files(self, package_path):
+    report = self.report
+    report.heading('Copying files')
+
+    with report.phase('load') as phase:
+      self._create_tree()
+
+      # load file metadata from conda package
+      package_path = Path(package_path).resolve()
+      file_list, paths_list = load_package_info(package_path)
+
+      self._check_file_lists(file_list, paths_list)
+      phase.add(files=len(file_list))
+
     # counters
     n_ignored = 0
     n_copied = 0
 
-    # copy files
-    for file_json in paths_list['paths']:
-      copied = self._copy_file(file_json, package_path)
-      if copied:
+    # the manifest of the previous conversion maps destinations to the
+    # paths.json entries they were copied from
+    previous_manifest = {}
+    if self.incremental and self.manifest_file.exists():
+      with self.manifest_file.open() as f:
+        previous_manifest = json.load(f)
+    manifest = {}
+    n_reused_bytes = 0
+    n_rewritten_bytes = 0
+
+    # classify files serially so that the file lists keep the package order
+    copy_plan = []
+    entries = {}
+    with report.phase('classify') as phase:
+      for file_json in paths_list['paths']:
+        phase.add(files=1, n_bytes=file_json.get('size_in_bytes'))
+        file_path, dest = self._classify_file(file_json, package_path)
+        if dest is None:
+          report.log(f'''\
+    Ignoring {file_path}\
+    ''')
+          n_ignored += 1
+          continue
+        key = dest.relative_to(self.manifest_file.parent).as_posix()
+        manifest[key] = {
+          '_path': file_json['_path'],
+          'sha256': file_json.get('sha256'),
+          'size_in_bytes': file_json.get('size_in_bytes'),
+        }
+        previous = previous_manifest.get(key, {})
+        if manifest[key]['sha256'] is not None \
+          and 'native' in previous \
+          and (self.strip_debug or 'debug' not in previous) \
+          and all(previous.get(k) == v for k, v in manifest[key].items()) \
+          and dest.exists():
+          report.log(f'''\
+    Reusing {dest}\
+    ''')
+          manifest[key]['native'] = previous.get('native')
+          if manifest[key]['native'] is not None:
+            self.native_files.append(dest)
+          if 'debug' in previous:
+            manifest[key]['debug'] = previous['debug']
+          n_reused_bytes += manifest[key]['size_in_bytes'] or 0
+          n_copied += 1
+        else:
+          copy_plan.append((file_path, dest))
+          entries[dest] = file_json
+          n_rewritten_bytes += manifest[key]['size_in_bytes'] or 0
+
+    # remove files that are no longer in the package. The files written by
+    # the converter (entry points, bundled libraries and debug sidecars) are
+    # only in the manifest after they are generated, so they are removed at
+    # the end if they were not generated again.
+    def remove(keys):
+      n_removed = 0
+      with report.phase('remove') as phase:
+        for key in sorted(keys):
+          removed = self.manifest_file.parent / key
+          if removed.exists():
+            report.log(f'''\
+    Removing {removed}\
+    ''')
+            phase.add(files=1, n_bytes=removed.stat().st_size)
+            removed.unlink()
+            n_removed += 1
+      return n_removed
+
+    n_removed = remove(key for key in set(previous_manifest) - set(manifest)
+                       if not previous_manifest[key].get('generated'))
+
+    # copy files in parallel
+    methods = {'reflink': 0, 'hardlink': 0, 'copy': 0, 'cache': 0}
+    n_cached_bytes = 0
+    with report.phase('copy') as phase:
+      results = self._copy_plan(copy_plan, entries=entries, verify=self.verify)
+      for n, ((file_path, dest), (method, file_format, size)) \
+        in enumerate(zip(copy_plan, results), start=1):
+        report.log(f'''\
+    Copying {file_path}
+            {dest} ({method})\
+    ''')
+        report.progress('Copying', n, len(copy_plan))
+        phase.add(files=1, n_bytes=size)
+        methods[method] += 1
+        if method == 'cache':
+          n_cached_bytes += size
+        manifest[dest.relative_to(self.manifest_file.parent).as_posix()]['native'] = file_format
+        if file_format is not None:
+          self.native_files.append(dest)
         n_copied += 1
-      else:
-        n_ignored += 1
     n_processed = n_copied + n_ignored
 
+    # only files copied in this conversion need the platform specific fixes
+    rewritten = {dest for _, dest in copy_plan}
+
     assert n_copied == len(self.bin_files) + len(self.lib_files) + len(self.src_files)
 
-    # find binary files in shared
-    shared_binary_files = []
-    core_path = str(self.core_path.resolve())
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, '**/tst*'), recursive=True))
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, '**/*test*'), recursive=True))
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, '**/driver?'), recursive=True))
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, 'fftpack_timer'), recursive=True))
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, 'hybrid_36_fem'), recursive=True))
-    shared_binary_files.extend(glob.glob(os.path.join(core_path, 'time_trigonometry'), recursive=True))
+    # native binaries in share were identified while copying, the binaries
+    # wrapped as entry points are handled with bin_files
+    with report.phase('binaries') as phase:
+      for dest in self.native_files:
+        if dest.is_relative_to(self.core_path) and dest.parent != self.entry_point_path:
+          self.shared_binary_files.append(str(dest))
+      for key in manifest:
+        if self._is_test_file(self.manifest_file.parent / key, manifest[key].get('native')):
+          manifest[key]['test'] = True
+      phase.add(files=len(self.native_files))
+
+    # split the debug information before the rpaths are fixed, the Mach-O
+    # signatures are only valid for the final binaries
+    n_stripped_bytes = 0
+    if self.strip_debug:
+      report.heading('Splitting debug symbols')
+      with report.phase('debug symbols') as phase:
+        # binaries reused from a previous conversion are already stripped
+        binaries = {dest.relative_to(self.manifest_file.parent).as_posix(): dest
+                    for dest in self.native_files}
+        binaries = [(dest, manifest[key]['native']) for key, dest in binaries.items()
+                    if 'debug' not in manifest[key]]
+        results = self.split_debug_symbols(binaries)
+        for filename, result in results.items():
+          key = filename.relative_to(self.manifest_file.parent).as_posix()
+          manifest[key]['debug'] = [
+            sidecar.relative_to(self.manifest_file.parent).as_posix()
+            for sidecar in result['sidecars']]
+          n_stripped_bytes += result['bytes'] - result['stripped_bytes']
+        phase.add(files=len(results), n_bytes=n_stripped_bytes)
+
+    # relative rpaths to the lib tree, every binary is relocated because the
+    # bundled libraries are copied again
+    load_ok = True
+    n_bundled = 0
+    if self.relative_rpaths:
+      report.heading('Relocating binaries')
+      with report.phase('relocate') as phase:
+        relocated = self.relocate_binaries(self.native_files)
+        for bundled, library in self.library_bundler.bundled.items():
+          key = bundled.relative_to(self.manifest_file.parent).as_posix()
+          manifest[key] = {'_path': None, 'generated': True, 'bundled_from': str(library)}
+          report.log(f'''\
+    Bundling {library}\
+    ''')
+          n_bundled += 1
+        # libraries bundled by the previous conversion are found in the
+        # bundle instead of being copied again
+        for filename in relocated:
+          key = filename.relative_to(self.manifest_file.parent).as_posix()
+          if key not in manifest and 'bundled_from' in previous_manifest.get(key, {}):
+            manifest[key] = previous_manifest[key]
+        phase.add(files=len(relocated))
+      with report.phase('load check') as phase:
+        missing = self.library_bundler.check(self.native_files)
+        for filename, dependencies in missing.items():
+          print(f'Cannot load {", ".join(dependencies)} from {filename}')
+        load_ok = not missing
+        phase.add(files=len(self.native_files))
 
-    for binary in shared_binary_files:
-      if not os.path.isdir(binary):
-        self.shared_binary_files.append(binary)
+    # fix rpaths on macOS, or with the requested tool
+    elif sys.platform == 'darwin' or self.rpath_tool is not None:
+      report.heading('Fixing RPATH')
+      with report.phase('rpaths') as phase:
+        binaries = [extension for extension in self.lib_files if extension in rewritten]
+        binaries.extend(binary for binary in self.bin_files
+                        if binary.name in self.binary_files and binary in rewritten)
+        binaries.extend(Path(binary) for binary in self.shared_binary_files
+                        if Path(binary) in rewritten)
+        phase.add(files=len(self.fix_rpaths(binaries)))
 
     # macOS specific fixes
     if sys.platform == 'darwin':
-      # fix rpaths on macOS
-      print('='*79)
-      print('Fixing RPATH')
-      print('='*79)
-      for extension in self.lib_files:
-        self.fixed_dylib = []
-        self.fix_rpaths(extension.name)
-      for binary in self.bin_files:
-        if binary.name in self.binary_files:
-          self.fix_rpaths(binary.name)
-      for binary in self.shared_binary_files:
-        self.fix_rpaths(binary)
-
       # fix macOS dispatchers to remove python.app
-      print('='*79)
-      print('Removing python.app')
-      print('='*79)
-      original = 'LIBTBX_PYEXE="$LIBTBX_PREFIX/python.app/Contents/MacOS/$LIBTBX_PYEXE_BASENAME"'
-      patched = 'LIBTBX_PYEXE="$LIBTBX_PREFIX/bin/$LIBTBX_PYEXE_BASENAME"\n'
-      for dispatcher in self.bin_path.iterdir():
-        with open(dispatcher, 'r') as f:
-          lines = f.readlines()
-        with open(dispatcher, 'w') as f:
-          for line in lines:
-            if original in line:
-              line = patched
-            f.write(line)
+      report.heading('Removing python.app')
+      with report.phase('dispatchers') as phase:
+        for dispatcher in self.bin_files:
+          if dispatcher.parent != self.bin_path or dispatcher not in rewritten:
+            continue
+          with open(dispatcher, 'r') as f:
+            text = f.read()
+          with open(dispatcher, 'w') as f:
+            f.write(self._patch_macos_dispatcher(text))
+          phase.add(files=1, n_bytes=len(text))
 
     # Windows specific fixes
     if sys.platform == 'win32':
-      for dispatcher in self.entry_point_path.iterdir():
-        if dispatcher.suffix == '.bat':
-          with open(dispatcher, 'r') as f:
-            lines = f.readlines()
-          with open(dispatcher, 'w') as f:
-            for line in lines:
-              # correct python must already be in PATH
-              if r'@set LIBTBX_PYEXE=%LIBTBX_PREFIX%\..\python.exe' in line:
-                line = '@set LIBTBX_PYEXE=python.exe'
-              # simplify batch file path
-              elif r'@"%LIBTBX_PYEXE%" "%LIBTBX_PREFIX%\..\lib\site-packages' in line:
-                python_file = line.split('site-packages')[-1].split()[0].strip().strip('"')
-                line = r'@"%LIBTBX_PYEXE%" "%~dp0\..\..\..{python_file}" %*'.format(python_file=python_file)
-              # do not change PATH
-              elif 'PATH=' in line:
-                continue
-              f.write(line.strip())
-              f.write('\n')
+      with report.phase('dispatchers') as phase:
+        for dispatcher in self.bin_files:
+          if dispatcher.parent == self.entry_point_path and dispatcher.suffix == '.bat' \
+            and dispatcher in rewritten:
+            with open(dispatcher, 'r') as f:
+              text = f.read()
+            with open(dispatcher, 'w') as f:
+              f.write(self._patch_windows_dispatcher(text))
+            phase.add(files=1, n_bytes=len(text))
 
     # add entry points for some commands
-    dispatchers = list(self.entry_point_path.iterdir())
-    for dispatcher in dispatchers:
-      # ignore __init__.py
-      if dispatcher.name == '__init__.py':
-        dispatchers.remove(dispatcher)
-        continue
-      # import modules cannot have .
-      dispatcher_import = dispatcher.stem.replace('.', '_')
-      if dispatcher.name in self.binary_files:
-        dispatcher_import = dispatcher.name.replace('.', '_')
-      entry_point_file = self.entry_point_path /  (dispatcher_import + '.py')
-      entry_point = self.entry_point_template.format(dispatcher_name=dispatcher.name)
-      with open(entry_point_file, 'w') as f:
-        f.write(entry_point)
+    with report.phase('entry points') as phase:
+      generated = [self.entry_point_path / '__init__.py',
+                   self.entry_point_path.parent / '__init__.py']
+      dispatchers = sorted(dest.name for dest in self.bin_files
+                           if dest.parent == self.entry_point_path)
+      for dispatcher in dispatchers:
+        _, dispatcher_import = self._entry_point_names(dispatcher)
+        entry_point_file = self.entry_point_path /  (dispatcher_import + '.py')
+        with open(self.entry_point_path / dispatcher, 'rb') as f:
+          entry_point = self._entry_point(dispatcher, f.read())
+        # unchanged entry points of an incremental conversion are kept
+        if not entry_point_file.exists() or entry_point_file.read_text() != entry_point:
+          with open(entry_point_file, 'w') as f:
+            f.write(entry_point)
+        generated.append(entry_point_file)
+        phase.add(files=1, n_bytes=len(entry_point))
 
     # update pyproject.toml with entry points
-    with open('pyproject.toml', 'r') as f:
-      lines = f.readlines()
-
-    with open('pyproject.toml', 'w') as f:
-      for line in lines:
-        if 'INSERT_SCRIPTS_HERE' in line:
-          for dispatcher in dispatchers:
-            dispatcher_stem = dispatcher.stem
-            if dispatcher.name in self.binary_files:
-              dispatcher_stem = dispatcher.name
-            dispatcher_import = dispatcher_stem.replace('.', '_')
-            line = f'"{dispatcher_stem}" = "libtbx.core.dispatchers.{dispatcher_import}:run_command"'
-            f.write(line)
+    with report.phase('pyproject') as phase:
+      with open('pyproject.toml', 'r') as f:
+        lines = f.readlines()
+
+      with open('pyproject.toml', 'w') as f:
+        for line in lines:
+          if 'INSERT_SCRIPTS_HERE' in line:
+            for line in self._console_scripts(dispatchers):
+              f.write(line)
+              f.write('\n')
             f.write('\n')
-          f.write('\n')
+          else:
+            f.write(line)
+      phase.add(files=1)
+
+    # files with the same contents are stored once in the wheel
+    n_duplicates = 0
+    n_duplicate_bytes = 0
+    if self.dedup:
+      with report.phase('dedup') as phase:
+        duplicates = self.find_duplicates(manifest)
+        for key, canonical in duplicates.items():
+          report.log(f'''\
+    Deduplicating {key}
+               -> {canonical}\
+    ''')
+          manifest[key]['duplicate_of'] = canonical
+          n_duplicates += 1
+          n_duplicate_bytes += (self.manifest_file.parent / key).stat().st_size
+        phase.add(files=n_duplicates, n_bytes=n_duplicate_bytes)
+
+    # files written by the converter are part of the wheel, but do not come
+    # from the package
+    with report.phase('manifest') as phase:
+      for generated_file in generated:
+        key = generated_file.relative_to(self.manifest_file.parent).as_posix()
+        manifest.setdefault(key, {'_path': None, 'generated': True})
+      for key, entry in list(manifest.items()):
+        for sidecar in entry.get('debug', []):
+          manifest[sidecar] = {'_path': None, 'generated': True, 'debug_of': key}
+      n_removed += remove(set(previous_manifest) - set(manifest))
+
+      # save the manifest for the next incremental conversion and the build
+      with self.manifest_file.open('w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+      phase.add(files=len(manifest))
+
+    # summary
+    report.counts.update({
+      'copied': n_copied, 'ignored': n_ignored, 'total': n_processed,
+      'original': len(file_list), 'reused': n_copied - len(copy_plan),
+      'removed': n_removed, 'reused_bytes': n_reused_bytes,
+      'rewritten_bytes': n_rewritten_bytes, 'duplicates': n_duplicates,
+      'duplicate_bytes': n_duplicate_bytes, 'stripped_bytes': n_stripped_bytes,
+      'bundled': n_bundled, 'cached_bytes': n_cached_bytes, **methods,
+    })
+    print()
+    print(f'Copied   {n_copied} files '
+          f'({methods["reflink"]} reflinked, {methods["hardlink"]} hardlinked, '
+          f'{methods["copy"]} copied, {n_copied - len(copy_plan)} reused)')
+    if self.shared_cache is not None:
+      print(f'Shared   {methods["cache"]} files ({n_cached_bytes} bytes) from '
+            f'{self.shared_cache.root}')
+    print(f'Ignored  {n_ignored} files')
+    print(f'Total    {n_processed} files')
+    print(f'Original {len(file_list)} files')
+    if self.dedup:
+      print(f'Deduplicated {n_duplicates} files ({n_duplicate_bytes} bytes saved)')
+    if self.strip_debug:
+      print(f'Stripped {n_stripped_bytes} bytes of debug information and symbols')
+    if self.relative_rpaths:
+      print(f'Bundled  {n_bundled} libraries from the conda environment')
+    if self.incremental:
+      print(f'Reused    {n_reused_bytes} bytes')
+      print(f'Rewritten {n_rewritten_bytes} bytes')
+      print(f'Removed   {n_removed} files')
+    print()
+    report.print_phases()
+
+    return n_processed == len(file_list) and load_ok
+
+  # ---------------------------------------------------------------------------
+  def classify_files(self, package_path, show_plan=True):
+    """Classify the files of a conda package without writing anything.
+
+    Prints the destination of every file if show_plan is True and the
+    number of files handled by every classification rule.
+    """
+    print('='*79)
+    print('Classifying files')
+    print('='*79)
+
+    package_path = Path(package_path).resolve()
+    file_list, paths_list = load_package_info(package_path)
+    self._check_file_lists(file_list, paths_list)
+
+    for file_json in paths_list['paths']:
+      rule, tree, relative, _ = self.classifier.classify(file_json['_path'])
+      if show_plan:
+        dest = None if tree is None else self.trees[tree].joinpath(*relative)
+        print(f'{rule:<16} {file_json["_path"]} -> {dest}')
+
+    print()
+    for rule, count in self.classifier.counts.items():
+      print(f'{rule:<16} {count} files')
+    print(f'{"total":<16} {sum(self.classifier.counts.values())} files')
+
+    return sum(self.classifier.counts.values()) == len(file_list)
+
+  # ---------------------------------------------------------------------------
+  def convert_archive(self, archive_path, wheel_dir='wheels', compression_levels=None):
+    """Convert a .conda or .tar.bz2 package directly into a wheel.
+
+    The members are classified like in copy_files and streamed from the
+    archive into the wheel, so the package is never extracted and no
+    src/, bin/ or lib/ tree is written. The dispatcher fixes, the entry
+    point modules and the console scripts are added on the fly. On
+    macOS, binaries are written to a temporary file for fixing rpaths.
+    """
+    report = self.report
+    report.heading('Converting archive')
+
+    with report.phase('load') as phase:
+      archive_path = Path(archive_path).resolve()
+
+      # load file metadata from conda package
+      file_list, paths_list = load_package_info(archive_path)
+
+      self._check_file_lists(file_list, paths_list)
+      phase.add(files=len(file_list))
+
+    project = read_pyproject()
+    writer = WheelWriter(wheel_dir, project['name'], project['version'],
+                         jobs=self.jobs, levels=compression_levels)
+
+    # counters
+    n_ignored = 0
+    n_copied = 0
+
+    # stream files into the wheel, links are written after all other files
+    entries = {file_json['_path']: file_json for file_json in paths_list['paths']}
+    written = {}
+    duplicates = {}
+    n_duplicate_bytes = 0
+    canonical = {}
+    sizes = {}
+    modes = {}
+    links = {}
+    deferred = []
+    with report.phase('stream') as phase:
+      for member, tar in iter_package_members(archive_path, 'pkg'):
+        if member.isdir():
+          continue
+        relative_path = member_name(member.name)
+        if member.issym():
+          links[relative_path] = os.path.normpath(
+            os.path.join(os.path.dirname(relative_path), member.linkname)).replace(os.sep, '/')
+        elif member.islnk():
+          links[relative_path] = member_name(member.linkname)
+        file_path, dest = self._classify_file({'_path': relative_path}, archive_path)
+        if dest is None:
+          report.log(f'''\
+    Ignoring {file_path}\
+    ''')
+          n_ignored += 1
+          continue
+        arcname = self._arcname(dest, writer)
+        if relative_path in links:
+          deferred.append((relative_path, dest, arcname))
+          continue
+        if self.dedup and self._may_deduplicate(dest, arcname, writer, member.size):
+          # members that are written unchanged are identified by paths.json
+          key = (entries.get(relative_path, {}).get('sha256'), member.mode)
+          if key[0] is not None and key in canonical:
+            duplicates[arcname] = canonical[key]
+            n_duplicate_bytes += member.size
+            written[relative_path] = canonical[key]
+            sizes[relative_path] = member.size
+            report.log(f'''\
+    Deduplicating {file_path}
+            {arcname} -> {canonical[key]}\
+    ''')
+            n_copied += 1
+            continue
+          if key[0] is not None:
+            canonical[key] = arcname
+        fileobj = tar.extractfile(member)
+        if self.verify:
+          fileobj = HashingReader(fileobj)
+        self._write_member(writer, dest, arcname, fileobj, member.mode)
+        if self.verify:
+          verify_file(entries.get(relative_path, {'_path': relative_path}),
+                      fileobj.hexdigest(), fileobj.size)
+        written[relative_path] = arcname
+        sizes[relative_path] = member.size
+        modes[relative_path] = member.mode
+        report.log(f'''\
+    Copying {file_path}
+            {arcname}\
+    ''')
+        n_copied += 1
+        report.progress('Streaming', n_copied + n_ignored, len(file_list))
+        phase.add(files=1, n_bytes=member.size)
+
+    # resolve links to regular files, targets that were not written to the
+    # wheel are read with a second pass over the archive
+    with report.phase('links') as phase:
+      targets = {}
+      for relative_path, _, _ in deferred:
+        target = relative_path
+        while target in links:
+          target = links[target]
+        targets[relative_path] = target
+      missing = set(targets.values()) - set(written)
+      contents = {}
+      if missing:
+        for member, tar in iter_package_members(archive_path, 'pkg'):
+          if member_name(member.name) in missing:
+            contents[member_name(member.name)] = tar.extractfile(member).read()
+            modes[member_name(member.name)] = member.mode
+      for relative_path, dest, arcname in deferred:
+        target = targets[relative_path]
+        # a link to a member in site-packages is restored from that member,
+        # which already has the fixes
+        if self.dedup and target in written \
+          and not written[target].startswith(writer.data_dir) \
+          and self._may_deduplicate(dest, arcname, writer, sizes[target], patched=False):
+          duplicates[arcname] = written[target]
+          n_duplicate_bytes += sizes[target]
+          report.log(f'''\
+    Deduplicating {relative_path} -> {target}
+            {arcname}\
+    ''')
+          n_copied += 1
+          phase.add(files=1)
+          continue
+        if target in written:
+          data = writer.read(written[target])
         else:
-          f.write(line)
+          assert target in contents, (relative_path, target)
+          data = contents[target]
+        self._write_member(writer, dest, arcname, io.BytesIO(data), modes[target])
+        report.log(f'''\
+    Copying {relative_path} -> {target}
+            {arcname}\
+    ''')
+        n_copied += 1
+        phase.add(files=1, n_bytes=len(data))
+    n_processed = n_copied + n_ignored
+
+    assert n_copied == len(self.bin_files) + len(self.lib_files) + len(self.src_files)
+
+    # add entry points for some commands
+    with report.phase('entry points') as phase:
+      arcnames = set(written.values()) | {arcname for _, _, arcname in deferred}
+      for init in ('libtbx/core/__init__.py', 'libtbx/core/dispatchers/__init__.py'):
+        if init not in arcnames:
+          writer.write_bytes(init, '')
+      dispatchers = sorted(dest.name for dest in self.bin_files
+                           if dest.parent == self.entry_point_path)
+      for dispatcher in dispatchers:
+        _, dispatcher_import = self._entry_point_names(dispatcher)
+        contents = writer.read(f'libtbx/core/dispatchers/{dispatcher}')
+        entry_point = self._entry_point(dispatcher, contents)
+        writer.write_bytes(f'libtbx/core/dispatchers/{dispatcher_import}.py', entry_point)
+        phase.add(files=1, n_bytes=len(entry_point))
+
+    # module that restores the duplicates after installation
+    if duplicates:
+      with report.phase('dedup') as phase:
+        writer.write_duplicates(duplicates, size=n_duplicate_bytes)
+        phase.add(files=len(duplicates), n_bytes=n_duplicate_bytes)
+
+    # metadata with the console scripts
+    with report.phase('metadata'):
+      project = read_pyproject(scripts=self._console_scripts(dispatchers))
+      writer.write_metadata(project)
+    with report.phase('compression') as phase:
+      writer.close()
+      phase.add(files=len(writer.zf.filelist), n_bytes=writer.compress_size)
 
     # summary
+    report.counts.update({
+      'copied': n_copied, 'ignored': n_ignored, 'total': n_processed,
+      'original': len(file_list), 'file_size': writer.file_size,
+      'compress_size': writer.compress_size, 'duplicates': len(duplicates),
+      'duplicate_bytes': n_duplicate_bytes,
+    })
     print()
+    print(f'Wrote    {writer.filename}')
+    print(writer.report())
     print(f'Copied   {n_copied} files')
     print(f'Ignored  {n_ignored} files')
     print(f'Total    {n_processed} files')
     print(f'Original {len(file_list)} files')
+    print()
+    report.print_phases()
 
     return n_processed == len(file_list)
 
   # ---------------------------------------------------------------------------
-  def _copy_file(self, file_json, package_path):
+  def _arcname(self, dest, writer):
+    """Return the path in the wheel of a destination in the tree."""
+    if dest.parent == self.bin_path:
+      return f'{writer.data_dir}/scripts/{dest.name}'
+    for root in (self.src_path, self.lib_path):
+      if dest.is_relative_to(root):
+        return dest.relative_to(root).as_posix()
+    raise ValueError(dest)
+
+  def _may_deduplicate(self, dest, arcname, writer, size, patched=None):
+    """Whether a member of convert_archive may be restored from another
+    member with the same contents, see find_duplicates. Members that may
+    be changed by _write_member (patched=None) are not compared."""
+    if patched is None:
+      patched = sys.platform == 'darwin' or self.rpath_tool is not None
+    return size >= MIN_DUPLICATE_SIZE and not patched \
+      and not arcname.startswith(writer.data_dir) \
+      and not is_native_library(dest.name) \
+      and dest.parent != self.entry_point_path
+
+  def _write_member(self, writer, dest, arcname, fileobj, mode):
+    """Write a member into the wheel with the platform specific fixes of
+    copy_files applied."""
+    # all dispatchers and binaries in bin are executable
+    if dest.parent in (self.bin_path, self.entry_point_path):
+      mode = 0o755
+
+    if sys.platform == 'darwin' or self.rpath_tool is not None:
+      # fix rpaths in a temporary copy of the binary
+      if dest in self.lib_files \
+        or dest.name in self.binary_files \
+        or (dest.is_relative_to(self.core_path)
+            and native_format(peek_header(fileobj)) is not None):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+          tmp_file = Path(tmp_dir) / dest.name
+          with open(tmp_file, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+          os.chmod(tmp_file, mode)
+          self.fix_rpaths([tmp_file])
+          writer.write_file(arcname, tmp_file, mode=mode)
+        return
+
+    if sys.platform == 'darwin':
+      if dest.parent == self.bin_path:
+        text = self._patch_macos_dispatcher(fileobj.read().decode('utf8'))
+        writer.write_bytes(arcname, text, mode=mode)
+        return
+
+    if sys.platform == 'win32' \
+      and dest.parent == self.entry_point_path and dest.suffix == '.bat':
+      text = self._patch_windows_dispatcher(fileobj.read().decode('utf8'))
+      writer.write_bytes(arcname, text.replace('\n', os.linesep), mode=mode)
+      return
+
+    writer.write_stream(arcname, fileobj, mode=mode)
+
+  # ---------------------------------------------------------------------------
+  def _patch_macos_dispatcher(self, text):
+    """Remove python.app from a macOS dispatcher."""
+    original = 'LIBTBX_PYEXE="$LIBTBX_PREFIX/python.app/Contents/MacOS/$LIBTBX_PYEXE_BASENAME"'
+    patched = 'LIBTBX_PYEXE="$LIBTBX_PREFIX/bin/$LIBTBX_PYEXE_BASENAME"\n'
+    lines = []
+    for line in text.splitlines(keepends=True):
+      if original in line:
+        line = patched
+      lines.append(line)
+    return ''.join(lines)
+
+  def _patch_windows_dispatcher(self, text):
+    """Make a Windows batch dispatcher use the python in PATH and the
+    installed location of the script."""
+    lines = []
+    for line in text.splitlines(keepends=True):
+      # correct python must already be in PATH
+      if r'@set LIBTBX_PYEXE=%LIBTBX_PREFIX%\..\python.exe' in line:
+        line = '@set LIBTBX_PYEXE=python.exe'
+      # simplify batch file path
+      elif r'@"%LIBTBX_PYEXE%" "%LIBTBX_PREFIX%\..\lib\site-packages' in line:
+        python_file = line.split('site-packages')[-1].split()[0].strip().strip('"')
+        line = r'@"%LIBTBX_PYEXE%" "%~dp0\..\..\..{python_file}" %*'.format(python_file=python_file)
+      # do not change PATH
+      elif 'PATH=' in line:
+        continue
+      lines.append(line.strip())
+      lines.append('\n')
+    return ''.join(lines)
+
+  # ---------------------------------------------------------------------------
+  def _entry_point_names(self, dispatcher):
+    """Return the console script name and the module name of the entry
+    point for a dispatcher in libtbx/core/dispatchers."""
+    dispatcher_stem = Path(dispatcher).stem
+    if dispatcher in self.binary_files:
+      dispatcher_stem = dispatcher
+    # import modules cannot have .
+    return dispatcher_stem, dispatcher_stem.replace('.', '_')
+
+  def _dispatcher_script(self, contents):
+    """Return the path relative to site-packages of the Python script run
+    by a dispatcher, or None if it does something else."""
+    text = contents.decode('utf8', errors='replace')
+    scripts = set()
+    for script in PYTHON_DISPATCHER.findall(text):
+      script = script.replace('\\', '/')
+      if 'site-packages/' in script:
+        script = script.split('site-packages/')[-1]
+      # path of a Windows dispatcher after _patch_windows_dispatcher
+      elif script.startswith('%~dp0/../../../'):
+        script = script[len('%~dp0/../../../'):]
+      if script.startswith('/') or any(c in script for c in '$%:'):
+        return None
+      scripts.add(script)
+    if len(scripts) != 1:
+      return None
+    return scripts.pop()
+
+  def _entry_point(self, dispatcher, contents):
+    """Return the entry point module for a file in libtbx/core/dispatchers.
+
+    Native binaries replace the entry point process, dispatchers that only
+    set variables (LIBTBX_BUILD, LIBTBX_PREFIX, LIBTBX_PYEXE, PYTHONPATH,
+    ...) and run a Python script are run in-process with the same
+    environment, and anything else is run as a subprocess.
+    """
+    if dispatcher in self.binary_files:
+      return self.binary_entry_point_template.format(dispatcher_name=dispatcher)
+    script = self._dispatcher_script(contents)
+    environment = dispatcher_environment(contents.decode('utf8', errors='replace'))
+    if script is not None and environment is not None:
+      dispatcher_stem, _ = self._entry_point_names(dispatcher)
+      return self.script_entry_point_template.format(script=script,
+                                                     dispatcher_name=dispatcher,
+                                                     dispatcher_stem=dispatcher_stem,
+                                                     environment=environment)
+    return self.entry_point_template.format(dispatcher_name=dispatcher)
+
+  def _console_scripts(self, dispatchers):
+    """Return the [project.scripts] lines for the dispatchers."""
+    lines = []
+    for dispatcher in dispatchers:
+      dispatcher_stem, dispatcher_import = self._entry_point_names(dispatcher)
+      lines.append(f'"{dispatcher_stem}" = "libtbx.core.dispatchers.{dispatcher_import}:run_command"')
+    return lines
+
+  # ---------------------------------------------------------------------------
+  def _classify_file(self, file_json, package_path):
+    """Return the source path and the destination (None if ignored) of
+    a file from paths.json and add the destination to the file lists."""
+
     # source file
-    relative_path = Path(file_json['_path'])
-    file_path = (package_path / relative_path).resolve()
+    file_path = package_path / file_json['_path']
 
     # destination
     dest = None
+    _, tree, relative, kind = self.classifier.classify(file_json['_path'])
+    if tree is not None:
+      dest = self.trees[tree].joinpath(*relative)
+      self.file_lists[kind].append(dest)
 
-    # ignore __pycache__ files
-    # ignore existing .egg-info and .dist-info directories
-    if '__pycache__' in relative_path.parent.parts \
-      or 'egg-info' in os.fspath(relative_path.parent) \
-      or 'dist-info' in os.fspath(relative_path.parent) \
-      or '.pythonw.' in relative_path.name:
-      pass
-    elif file_path.name in self.binary_files:
-      dest = (self.entry_point_path / file_path.name)
-      self.bin_files.append(dest)
-    # copy all dispatchers in bin
-    elif 'bin' in relative_path.parent.parts[0]:
-      dest = self.bin_path / relative_path.name
-      self.bin_files.append(dest)
-    # copy site-packages files to src
-    elif 'site-packages' in relative_path.parent.parts:
-      dest = (self.src_path / Path(os.fspath(file_path).split('site-packages')[-1][1:])).resolve()
-      self.src_files.append(dest)
-    # copy share files to libtbx/core
-    elif 'share' in relative_path.parent.parts[0]:
-      dest = (self.core_path / relative_path)
-      self.src_files.append(dest)
-    elif relative_path.suffix == '.so':
-      dest = (self.lib_path / relative_path.name).resolve()
-      self.lib_files.append(dest)
-    # Windows
-    elif sys.platform == 'win32':
-      if 'Library' in relative_path.parent.parts:
-        library_path = Path(os.fspath(file_path).split('Library')[-1][1:])
-        library_parts = library_path.parent.parts[0]
-        if ('bin' in library_parts and not library_path.name.endswith('.exe')) \
-          or (library_path.name[:-4]) in self.binary_files:
-          dest = self.entry_point_path / library_path.name
-          self.bin_files.append(dest)
-        elif 'share' in library_parts \
-          or 'include' in library_parts:
-          dest = (self.core_path / library_path)
-          self.src_files.append(dest)
-        elif 'lib' in library_parts:
-          dest = (self.lib_path / library_path.name).resolve()
-          self.lib_files.append(dest)
-      elif 'Lib' in relative_path.parent.parts:
-        library_path = Path(os.fspath(file_path).split('Lib')[-1][1:])
-        if '__pycache__' in library_path.parent.parts \
-          or 'egg-info' in os.fspath(library_path.parent) \
-          or 'dist-info' in os.fspath(library_path.parent):
-          pass
-        elif 'site-packages' in relative_path.parent.parts:
-          dest = (self.src_path / Path(os.fspath(file_path).split('site-packages')[-1][1:])).resolve()
-          self.src_files.append(dest)
-        else:
-          dest = (self.lib_path / library_path)
-          self.lib_files.append(dest)
-
-    if dest is not None:
-      os.makedirs(dest.parent, exist_ok=True)
-      shutil.copyfile(file_path, dest)
-      shutil.copymode(file_path, dest)
-      if dest in self.bin_files:
+    return file_path, dest
+
+  # ---------------------------------------------------------------------------
+  def _copy_plan(self, copy_plan, entries=None, verify=False):
+    """Copy (source, destination) pairs with a pool of workers and return
+    the copy method, the native_format and the size of each pair, in
+    order.
+
+    entries maps destinations to their paths.json entries. With verify,
+    every file is checked with verify_file and the first mismatch stops
+    the copy. Files from the shared cache were checked when they were
+    stored.
+    """
+
+    bin_files = set(self.bin_files)
+
+    # only files that are never modified afterwards can be linked to the
+    # conda package or the shared cache. Files in bin are made executable
+    # and patched, the entry point directory is written by the converter
+    # and native binaries (checked per file below) are stripped, relocated
+    # or get their rpaths fixed in place.
+    link_files = set()
+    if self.copy_mode == 'auto':
+      link_files = {dest for dest in self.src_files
+                    if dest.parent != self.entry_point_path
+                    and dest != self.core_path / '__init__.py'}
+
+    # create directories before starting the workers
+    for dest_dir in sorted({dest.parent for _, dest in copy_plan}):
+      os.makedirs(dest_dir, exist_ok=True)
+
+    def copy_one(pair):
+      file_path, dest = pair
+      file_json = entries.get(dest) if entries is not None else None
+      linked = dest in link_files and not self._is_native(file_path)
+      if linked and self.shared_cache is not None and self.shared_cache.shares(file_json):
+        method, header = self.shared_cache.materialize(file_path, dest, file_json)
+        return method, native_format(header, dest), os.path.getsize(dest)
+      hasher = hashlib.sha256() if verify else None
+      method, header = materialize_file(file_path, dest, allow_hardlink=linked,
+                                        allow_reflink=self.copy_mode == 'auto',
+                                        hasher=hasher)
+      size = os.path.getsize(dest)
+      if hasher is not None:
+        verify_file(file_json, hasher.hexdigest(), size)
+      if dest in bin_files:
         os.chmod(dest, 0o755)
-      print(f'''\
-    Copying {file_path}
-            {dest}\
-    ''')
-      return True
-    else:
-      print(f'''\
-    Ignoring {file_path}\
-    ''')
+      return method, native_format(header, dest), size
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      futures = [executor.submit(copy_one, pair) for pair in copy_plan]
+      # stop at the first error instead of copying the rest of the package
+      done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+      for future in futures:
+        if future in done and future.exception() is not None:
+          for pending in futures:
+            pending.cancel()
+          raise future.exception()
+      return [future.result() for future in futures]
+
+  # ---------------------------------------------------------------------------
+  def _is_test_file(self, dest, file_format):
+    """Return True if a file in share is a native test binary (see
+    TEST_BINARY_PATTERNS) or test data below a directory in
+    TEST_DATA_DIRECTORIES of a module."""
+    share_path = self.core_path / 'share'
+    if not dest.is_relative_to(share_path):
+      return False
+    if file_format is not None:
+      return any(fnmatch.fnmatch(dest.name, pattern) for pattern in TEST_BINARY_PATTERNS)
+    directories = dest.relative_to(share_path).parts[1:-1]
+    return any(directory in TEST_DATA_DIRECTORIES for directory in directories)
+
+  @staticmethod
+  def _is_native(filename):
+    """Return True if a file in the conda package is a native binary,
+    softlinks are checked by their target."""
+    try:
+      with open(filename, 'rb') as f:
+        return native_format(f.read(HEADER_SIZE), filename) is not None
+    except OSError:
       return False
 
   # ---------------------------------------------------------------------------
-  def fix_rpaths(self, filename):
+  def find_duplicates(self, keys):
+    """Return {key: canonical key} for the files in src and lib with the
+    same contents and mode as the file with the smallest key.
 
-    # replace @rpath with CONDA_PREFIX
-    new_rpath = os.environ.get('CONDA_PREFIX', None)
-    assert new_rpath is not None, 'The conda environment must be active.'
-    new_rpath = Path(new_rpath) / 'lib'
+    The files are grouped by size and mode first, so only files that share
+    both are hashed. Files in bin are installed as scripts and cannot be
+    restored from site-packages. Native libraries, which are needed if the
+    restore fails or never runs (see wheel_writer.DUPLICATES_MODULE), and
+    files smaller than MIN_DUPLICATE_SIZE are kept.
+    """
+    root = self.manifest_file.parent
+    groups = {}
+    for key in keys:
+      if not key.startswith(('src/', 'lib/')) or is_native_library(key.rsplit('/', 1)[-1]):
+        continue
+      stat = (root / key).stat()
+      if stat.st_size >= MIN_DUPLICATE_SIZE:
+        groups.setdefault((stat.st_size, stat.st_mode & 0o777), []).append(key)
+    candidates = [(key, group) for group, group_keys in groups.items()
+                  if len(group_keys) > 1 for key in group_keys]
 
-    if os.path.isabs(filename):
-      file_path = filename
-    if filename.endswith('dylib'):
-      file_path = new_rpath / filename
-    else:
-      file_path = Path(self.lib_path) / filename
-    if not file_path.exists():
-      file_path = Path(self.entry_point_path) / filename
-    assert file_path.exists(), file_path
-
-    # get library links
-    otool_lines = check_output(['otool', '-L', file_path]).decode('utf8').split('\n')
-    print('Fixing', filename)
-    print('='*79)
-    print('\n'.join(otool_lines))
-    print('-'*79)
-
-    for line in otool_lines:
-      if line.strip().startswith('@rpath'):
-        rpath_line = line.split()[0]
-        library = rpath_line.split('/')[-1]
-        if library == filename or library == filename.split('/')[-1]:
-          continue
-        new_lib = new_rpath / library
-        assert new_lib.exists(), new_lib
-        output = check_output(['install_name_tool', '-change', rpath_line, new_lib, file_path])
-        print('\n'.join(output))
-        if library.endswith('dylib') and library not in self.fixed_dylib:
-          self.fix_rpaths(library)
-          self.fixed_dylib.append(library)
-          print(self.fixed_dylib)
-
-    # check updated library links
-    print('-'*79)
-    otool_lines = check_output(['otool', '-L', file_path]).decode('utf8').split('\n')
-    print('\n'.join(otool_lines))
-    print('='*79)
-    print('\n')
+    def digest(candidate):
+      hasher = hashlib.sha256()
+      with open(root / candidate[0], 'rb') as f:
+        copy_stream(f, None, hasher=hasher)
+      return hasher.hexdigest(), candidate[1]
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      digests = dict(zip((key for key, _ in candidates),
+                         executor.map(digest, candidates)))
 
-    # sign file
-    output = check_output(['codesign', '--continue', '-s', '-', '-f', file_path]).decode('utf8').split('\n')
-    print('\n'.join(output))
+    canonical = {}
+    duplicates = {}
+    for key in sorted(digests):
+      first = canonical.setdefault(digests[key], key)
+      if first != key:
+        duplicates[key] = first
+    return duplicates
+
+  # ---------------------------------------------------------------------------
+  def split_debug_symbols(self, binaries):
+    """Move the debug information of (filename, native_format) binaries to
+    sidecar files, strip them in parallel and print the size change of
+    every binary.
+
+    Only the binaries of the platform are changed, PE files keep their
+    debug information in .pdb files.
+    """
+    splitter = DebugSymbolSplitter(jobs=self.jobs)
+    results = splitter.split([filename for filename, file_format in binaries
+                              if file_format == splitter.tool.format])
+    if results:
+      for line in format_sizes(results, root=self.manifest_file.parent):
+        print(line)
+    return results
+
+  # ---------------------------------------------------------------------------
+  def relocate_binaries(self, filenames):
+    """Point the binaries to the lib tree with rpaths relative to each of
+    them and bundle the libraries they load from the lib directory of the
+    active conda environment, if there is one.
+
+    The binaries are rewritten in place, LibraryBundler replaces hardlinks
+    to the conda package by copies first.
+    """
+    if self.library_bundler is None:
+      conda_prefix = os.environ.get('CONDA_PREFIX', None)
+      search_dirs = [Path(conda_prefix) / 'lib'] if conda_prefix is not None else []
+      self.library_bundler = LibraryBundler(self.lib_path,
+                                            roots=[self.src_path, self.lib_path],
+                                            search_dirs=search_dirs,
+                                            tool=self.rpath_tool, jobs=self.jobs)
+    relocated = self.library_bundler.relocate(filenames)
+    for filename, rpath in relocated.items():
+      self.report.log(f'Relocating {filename} ({rpath})')
+    return relocated
+
+  # ---------------------------------------------------------------------------
+  def fix_rpaths(self, filenames):
+    """Point the @rpath (RUNPATH with patchelf) references of binaries to
+    the lib directory of the active conda environment.
+
+    Libraries of the conda environment that are loaded by the binaries are
+    fixed as well, but only once per converter.
+    """
+    if self.rpath_fixer is None:
+      conda_prefix = os.environ.get('CONDA_PREFIX', None)
+      assert conda_prefix is not None, 'The conda environment must be active.'
+      self.rpath_fixer = RpathFixer(Path(conda_prefix) / 'lib',
+                                    tool=self.rpath_tool, jobs=self.jobs)
+
+    fixed = self.rpath_fixer.fix(filenames)
+    for filename, changes in fixed.items():
+      self.report.log(f'Fixing {filename}')
+      for dependency, library in changes:
+        self.report.log(f'  {dependency} -> {library}')
+    self.report.log(f'Fixed {len(fixed)} files')
+    return fixed
 
 # =============================================================================
-def create_wheel(prefix_path):
-  converter = CondaWheelConverter()
+def create_wheel(prefix_path, jobs=None, copy_mode='auto', incremental=False,
+                 rpath_tool=None, output='verbose', report_file=None, verify=False,
+                 dedup=False, strip_debug=False, relative_rpaths=False):
+  converter = CondaWheelConverter(jobs=jobs, copy_mode=copy_mode,
+                                  incremental=incremental, rpath_tool=rpath_tool,
+                                  output=output, verify=verify, dedup=dedup,
+                                  strip_debug=strip_debug,
+                                  relative_rpaths=relative_rpaths)
   result = converter.copy_files(prefix_path)
+  if report_file is not None:
+    converter.report.write(report_file)
+
+  return result
+
+def classify_package(package_path, show_plan=True):
+  converter = CondaWheelConverter()
+  result = converter.classify_files(package_path, show_plan=show_plan)
 
   return result
 
+def create_wheel_from_archive(archive_path, wheel_dir='wheels', rpath_tool=None,
+                              jobs=None, compression_levels=None,
+                              output='verbose', report_file=None, verify=False,
+                              dedup=False):
+  converter = CondaWheelConverter(jobs=jobs, rpath_tool=rpath_tool, output=output,
+                                  verify=verify, dedup=dedup)
+  result = converter.convert_archive(archive_path, wheel_dir=wheel_dir,
+                                     compression_levels=compression_levels)
+  if report_file is not None:
+    converter.report.write(report_file)
+
+  return result
+
+# =============================================================================
+def shared_hashes(paths_lists):
+  """Return the sha256 of the files that are in more than one package."""
+  counts = Counter()
+  for paths_list in paths_lists:
+    counts.update({file_json['sha256'] for file_json in paths_list['paths']
+                   if file_json.get('sha256') and file_json.get('path_type') != 'softlink'})
+  return {sha256 for sha256, count in counts.items() if count > 1}
+
+def fill_shared_cache(cache, package_paths, paths_lists, jobs=None):
+  """Store the shared files that are copied to src once, before the
+  packages are converted in parallel, and return the number of files and
+  bytes that were stored."""
+  classifier = Classifier(CondaWheelConverter().binary_files)
+  sources = {}
+  for package_path, paths_list in zip(package_paths, paths_lists):
+    for file_json in paths_list['paths']:
+      if cache.shares(file_json) and classifier.classify(file_json['_path'])[3] == 'src':
+        sources.setdefault(file_json['sha256'], (package_path / file_json['_path'], file_json))
+
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    results = list(executor.map(lambda source: cache.add(*source), sources.values()))
+  stored = [cached for cached, is_new in results if is_new]
+  return len(stored), sum(cached.stat().st_size for cached in stored)
+
+def _convert_target(package_path, target_dir, source_dir, cache, options):
+  """Convert one package of convert_packages in its own directory with the
+  wheel files of source_dir, in a worker process."""
+  target_dir = Path(target_dir)
+  target_dir.mkdir(parents=True, exist_ok=True)
+  names = TARGET_FILES + [path.name for path in Path(source_dir).glob('LICEN[CS]E*.txt')]
+  for name in names:
+    shutil.copy(Path(source_dir) / name, target_dir)
+  os.chdir(target_dir)
+  with open('convert.log', 'w') as log, redirect_stdout(log):
+    converter = CondaWheelConverter(shared_cache=cache, **options)
+    result = converter.copy_files(package_path)
+  converter.report.write('convert_report.json')
+  return result, converter.report.to_dict()
+
+def convert_packages(package_paths, output_dir='targets', cache_dir=None, processes=None,
+                     report_file=None, **options):
+  """Convert several extracted conda packages with a pool of processes.
+
+  Every package is converted in output_dir/<package directory name> with
+  a copy of the wheel files of the current directory (TARGET_FILES), so
+  the wheels can be built there. Files that are in more than one package
+  are found by their sha256 and stored once in a SharedFileCache, which
+  the trees hardlink. The console output of every target is written to
+  convert.log in its directory and a summary is printed.
+
+  The other keyword arguments are passed to CondaWheelConverter, and jobs
+  defaults to the number of CPUs per process.
+  """
+  t0 = time.perf_counter()
+  package_paths = [Path(package_path).resolve() for package_path in package_paths]
+  names = [package_path.name for package_path in package_paths]
+  assert len(set(names)) == len(names), 'The package directory names must be unique.'
+  output_dir = Path(output_dir).resolve()
+  cache_dir = Path(cache_dir) if cache_dir is not None else output_dir / 'shared-cache'
+  source_dir = Path('.').resolve()
+
+  print('='*79)
+  print(f'Converting {len(package_paths)} packages')
+  print('='*79)
+
+  paths_lists = [load_package_info(package_path)[1] for package_path in package_paths]
+  cache = SharedFileCache(cache_dir, hashes=shared_hashes(paths_lists))
+  n_stored, n_stored_bytes = fill_shared_cache(cache, package_paths, paths_lists,
+                                               jobs=options.get('jobs'))
+  cache_seconds = time.perf_counter() - t0
+
+  processes = processes or min(len(package_paths), os.cpu_count() or 1)
+  if options.get('jobs') is None:
+    options['jobs'] = max(1, (os.cpu_count() or 1) // processes)
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    futures = {name: executor.submit(_convert_target, package_path, output_dir / name,
+                                     source_dir, cache, options)
+               for name, package_path in zip(names, package_paths)}
+    results = {name: future.result() for name, future in futures.items()}
+
+  print(f'Stored {n_stored} shared files ({n_stored_bytes} bytes) in {cache.root} '
+        f'in {cache_seconds:.3f}s')
+  print()
+  print(f'{"target":<40} {"seconds":>8} {"files":>7} {"shared":>7} '
+        f'{"shared bytes":>13} {"copied bytes":>13} {"ok":>3}')
+  targets = {}
+  for name, (result, report) in results.items():
+    counts = report['counts']
+    copy_bytes = sum(phase['bytes'] for phase in report['phases'] if phase['name'] == 'copy')
+    targets[name] = {
+      'ok': result,
+      'seconds': report['total_seconds'],
+      'files': counts['copied'],
+      'shared_files': counts['cache'],
+      'shared_bytes': counts['cached_bytes'],
+      'copied_bytes': copy_bytes - counts['cached_bytes'],
+      'report': report,
+    }
+    target = targets[name]
+    print(f'{name[:40]:<40} {target["seconds"]:>8.3f} {target["files"]:>7} '
+          f'{target["shared_files"]:>7} {target["shared_bytes"]:>13} '
+          f'{target["copied_bytes"]:>13} {"yes" if result else "no":>3}')
+  total_seconds = time.perf_counter() - t0
+  print(f'{"total":<40} {total_seconds:>8.3f} '
+        f'{sum(target["files"] for target in targets.values()):>7} '
+        f'{sum(target["shared_files"] for target in targets.values()):>7} '
+        f'{sum(target["shared_bytes"] for target in targets.values()):>13} '
+        f'{sum(target["copied_bytes"] for target in targets.values()):>13}')
+
+  if report_file is not None:
+    with open(report_file, 'w') as f:
+      json.dump({'seconds': total_seconds, 'processes': processes,
+                 'cache': {'root': str(cache.root), 'files': n_stored,
+                           'bytes': n_stored_bytes, 'seconds': cache_seconds},
+                 'targets': targets}, f, indent=2)
+
+  return all(result for result, _ in results.values())
+
 # =============================================================================
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
-  parser.add_argument('--conda-package-path', type=str,
-                      help='The root directory of the extracted conda package.',
-                      required=True)
+  package = parser.add_mutually_exclusive_group(required=True)
+  package.add_argument('--conda-package-path', type=str, nargs='+',
+                       help='The root directory of the extracted conda package. '
+                            'Several packages are converted in parallel into '
+                            'directories below --output-dir.')
+  package.add_argument('--conda-archive', type=str,
+                       help='A .conda or .tar.bz2 package that is converted '
+                            'directly into a wheel without extracting it.')
+  parser.add_argument('--wheel-dir', type=str, default='wheels',
+                      help='The output directory for the wheel built from '
+                           '--conda-archive.')
+  parser.add_argument('--output-dir', type=str, default='targets',
+                      help='The directory for the trees of several '
+                           '--conda-package-path packages.')
+  parser.add_argument('--shared-cache', type=str, default=None,
+                      help='The cache for the files that are in more than one '
+                           'package, on the filesystem of --output-dir. The '
+                           'default is the shared-cache directory in --output-dir.')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='The number of packages converted at the same time. '
+                           'The default is the number of packages or CPUs.')
+  parser.add_argument('--jobs', type=int, default=None,
+                      help='The number of parallel workers for copying and '
+                           'compressing files. The default is the number of CPUs.')
+  parser.add_argument('--copy-mode', type=str, default='auto',
+                      choices=['auto', 'copy'],
+                      help='"auto" uses reflinks or hardlinks when possible, '
+                           '"copy" always copies the file contents.')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Only copy files that changed since the previous '
+                           'conversion in this directory and remove files that '
+                           'are no longer in the package.')
+  parser.add_argument('--compression-levels', type=parse_compression_levels,
+                      default=None,
+                      help='Deflate levels of the wheel members by suffix, e.g. '
+                           '".so=6,.py=9,.png=store,*=6" (see '
+                           'wheel_writer.COMPRESSION_LEVELS).')
+  parser.add_argument('--rpath-tool', type=str, default=None,
+                      choices=sorted(TOOLS),
+                      help='Fix the library references of the binaries with '
+                           'this tool. The default is "otool" on macOS and no '
+                           'changes on other platforms.')
+  output = parser.add_mutually_exclusive_group()
+  output.add_argument('--quiet', dest='output', action='store_const', const='quiet',
+                      default='verbose',
+                      help='Do not print every file, only the summary.')
+  output.add_argument('--progress', dest='output', action='store_const',
+                      const='progress',
+                      help='Show a progress line instead of every file.')
+  parser.add_argument('--report', type=str, default=None,
+                      help='Write the time, files and bytes of every phase of '
+                           'the conversion to this JSON file.')
+  parser.add_argument('--verify', action='store_true',
+                      help='Check the sha256 and size of every copied file '
+                           'against info/paths.json, the files are hashed '
+                           'while they are copied.')
+  parser.add_argument('--dedup', action='store_true',
+                      help='Store files with the same contents once in the '
+                           'wheel, the copies are restored as hardlinks when '
+                           'Python first starts after the installation. The '
+                           'wheel must be installed into a writable site '
+                           'directory, .pth files are not processed with pip '
+                           'install --target or PYTHONPATH. Native libraries '
+                           'are always stored.')
+  parser.add_argument('--relative-rpaths', action='store_true',
+                      help='Point the binaries to the bundled libraries with '
+                           '$ORIGIN (@loader_path) relative rpaths, copy the '
+                           'libraries they load from the active conda '
+                           'environment into the bundle and check that every '
+                           'binary loads. Only with --conda-package-path.')
+  parser.add_argument('--strip-debug', action='store_true',
+                      help='Move the debug information of the native binaries '
+                           'to sidecar files for the debug wheel (see '
+                           'build_backend.py --split) and strip the binaries. '
+                           'Only with --conda-package-path.')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='Print the destination of every file without '
+                           'writing anything.')
+  parser.add_argument('--classify-only', action='store_true',
+                      help='Only classify the files and print the number of '
+                           'files handled by every classification rule.')
   namespace = parser.parse_args()
-  result = create_wheel(namespace.conda_package_path)
+  if namespace.strip_debug and namespace.conda_archive is not None:
+    parser.error('--strip-debug needs --conda-package-path')
+  if namespace.relative_rpaths and namespace.conda_archive is not None:
+    parser.error('--relative-rpaths needs --conda-package-path')
+  package_paths = namespace.conda_package_path or []
+  if namespace.dry_run or namespace.classify_only:
+    if len(package_paths) > 1:
+      parser.error('--dry-run and --classify-only need one package')
+    result = classify_package(package_paths[0] if package_paths else namespace.conda_archive,
+                              show_plan=namespace.dry_run)
+  elif namespace.conda_archive is not None:
+    result = create_wheel_from_archive(namespace.conda_archive,
+                                       wheel_dir=namespace.wheel_dir,
+                                       rpath_tool=namespace.rpath_tool,
+                                       jobs=namespace.jobs,
+                                       compression_levels=namespace.compression_levels,
+                                       output=namespace.output,
+                                       report_file=namespace.report,
+                                       verify=namespace.verify,
+                                       dedup=namespace.dedup)
+  elif len(package_paths) > 1:
+    result = convert_packages(package_paths,
+                              output_dir=namespace.output_dir,
+                              cache_dir=namespace.shared_cache,
+                              processes=namespace.processes,
+                              report_file=namespace.report,
+                              jobs=namespace.jobs,
+                              copy_mode=namespace.copy_mode,
+                              incremental=namespace.incremental,
+                              rpath_tool=namespace.rpath_tool,
+                              output=namespace.output,
+                              verify=namespace.verify,
+                              dedup=namespace.dedup,
+                              strip_debug=namespace.strip_debug,
+                              relative_rpaths=namespace.relative_rpaths)
+  else:
+    result = create_wheel(package_paths[0],
+                          jobs=namespace.jobs,
+                          copy_mode=namespace.copy_mode,
+                          incremental=namespace.incremental,
+                          rpath_tool=namespace.rpath_tool,
+                          output=namespace.output,
+                          report_file=namespace.report,
+                          verify=namespace.verify,
+                          dedup=namespace.dedup,
+                          strip_debug=namespace.strip_debug,
+                          relative_rpaths=namespace.relative_rpaths)
   assert result
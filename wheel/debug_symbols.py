@@ -0,0 +1,160 @@
+"""
+Separation of the debug information of native binaries
+
+Extensions and executables built by conda keep their symbol tables and,
+for debug builds, their DWARF sections. The debug information is moved to
+sidecar files that debuggers find next to the binary, and the binaries are
+stripped in place:
+
+  ELF     <dir>/.debug/<name>.debug, linked with .gnu_debuglink (objcopy)
+  Mach-O  <dir>/<name>.dSYM bundle (dsymutil and strip), re-signed
+
+PE files keep their debug information in .pdb files and are not changed.
+The sidecars are part of the converted tree and go into the debug wheel of
+a split build (see build_backend.SPLITS).
+"""
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from subprocess import check_output
+
+# directory next to an ELF binary that gdb searches for its .gnu_debuglink
+DEBUG_DIR = '.debug'
+
+# =============================================================================
+def is_debug_file(key):
+  """Return True if a path in the converted tree is a debug sidecar."""
+  parts = key.split('/')
+  return DEBUG_DIR in parts[:-1] or any(part.endswith('.dSYM') for part in parts[:-1])
+
+# =============================================================================
+class ELFStripper():
+  """objcopy for ELF binaries.
+
+  The sidecar is only written if the binary has DWARF sections, the symbol
+  tables that are not needed for relocations are removed in any case.
+  """
+
+  name = 'objcopy'
+  format = 'elf'
+
+  def has_debug_info(self, filename):
+    output = check_output(['readelf', '-S', '-W', str(filename)]).decode('utf8')
+    return ' .debug_info ' in output or ' .zdebug_info ' in output
+
+  def strip(self, filename, stripped):
+    """Write the stripped binary to stripped and return the sidecars."""
+    filename = Path(filename)
+    sidecars = []
+    command = ['objcopy', '--strip-unneeded']
+    if self.has_debug_info(filename):
+      sidecar = filename.parent / DEBUG_DIR / f'{filename.name}.debug'
+      sidecar.parent.mkdir(exist_ok=True)
+      check_output(['objcopy', '--only-keep-debug', '--compress-debug-sections',
+                    str(filename), str(sidecar)])
+      command.append(f'--add-gnu-debuglink={sidecar}')
+      sidecars.append(sidecar)
+    check_output([*command, str(filename), str(stripped)])
+    return sidecars
+
+  def sign(self, filename):
+    return ''
+
+# =============================================================================
+class MachOStripper():
+  """dsymutil, strip and codesign for Mach-O binaries."""
+
+  name = 'dsymutil'
+  format = 'mach-o'
+
+  def has_debug_info(self, filename):
+    # dsymutil follows the debug map to the object files, which only exist
+    # on the build machine, so it is tried for every binary
+    return True
+
+  def strip(self, filename, stripped):
+    filename = Path(filename)
+    bundle = filename.parent / f'{filename.name}.dSYM'
+    check_output(['dsymutil', str(filename), '-o', str(bundle)])
+    sidecars = sorted(path for path in bundle.rglob('*') if path.is_file())
+    # keep the global symbols of libraries and bundles
+    check_output(['strip', '-x', '-o', str(stripped), str(filename)])
+    return sidecars
+
+  def sign(self, filename):
+    return check_output(['codesign', '-s', '-', '-f', str(filename)]).decode('utf8')
+
+TOOLS = {
+  ELFStripper.name: ELFStripper,
+  MachOStripper.name: MachOStripper,
+}
+
+# =============================================================================
+class DebugSymbolSplitter():
+  """Move the debug information of binaries to sidecar files and strip the
+  binaries, with a pool of workers.
+
+  The stripped binary is written to a new file that replaces the original,
+  so files hardlinked from the conda package are not changed.
+
+  Parameters
+  ----------
+  tool : str, optional
+      The key of the tool in TOOLS. Default is None, "dsymutil" on macOS
+      and "objcopy" on other platforms.
+  jobs : int, optional
+      The number of parallel workers. Default is None, the number of CPUs.
+  """
+  def __init__(self, tool=None, jobs=None):
+    if tool is None:
+      tool = MachOStripper.name if sys.platform == 'darwin' else ELFStripper.name
+    self.tool = TOOLS[tool]()
+    self.jobs = jobs
+
+  # ---------------------------------------------------------------------------
+  def _split(self, filename):
+    filename = Path(filename)
+    stat = filename.stat()
+    stripped = filename.with_name(f'{filename.name}.stripped')
+    try:
+      sidecars = self.tool.strip(filename, stripped)
+      os.chmod(stripped, stat.st_mode & 0o7777)
+      os.replace(stripped, filename)
+    finally:
+      if stripped.exists():
+        stripped.unlink()
+    output = self.tool.sign(filename)
+    if output:
+      print(output)
+    return {
+      'sidecars': sidecars,
+      'bytes': stat.st_size,
+      'stripped_bytes': filename.stat().st_size,
+      'debug_bytes': sum(sidecar.stat().st_size for sidecar in sidecars),
+    }
+
+  def split(self, filenames):
+    """Split the files and return {filename: sizes and sidecars}."""
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      return dict(zip(filenames, executor.map(self._split, filenames)))
+
+# =============================================================================
+def format_sizes(results, root=None):
+  """Return the lines of a table with the size change of every binary,
+  largest saving first."""
+  lines = [f'{"binary":<48} {"bytes":>12} {"stripped":>12} {"debug":>12} {"change":>7}']
+  rows = sorted(results.items(),
+                key=lambda item: item[1]['stripped_bytes'] - item[1]['bytes'])
+  for filename, result in rows:
+    name = str(Path(filename).relative_to(root)) if root is not None else str(filename)
+    change = result['stripped_bytes'] / result['bytes'] - 1 if result['bytes'] else 0
+    lines.append(f'{name:<48} {result["bytes"]:>12} {result["stripped_bytes"]:>12} '
+                 f'{result["debug_bytes"]:>12} {change:>7.1%}')
+  n_bytes = sum(result['bytes'] for result in results.values())
+  n_stripped = sum(result['stripped_bytes'] for result in results.values())
+  n_debug = sum(result['debug_bytes'] for result in results.values())
+  change = n_stripped / n_bytes - 1 if n_bytes else 0
+  lines.append(f'{"total":<48} {n_bytes:>12} {n_stripped:>12} {n_debug:>12} {change:>7.1%}')
+  return lines
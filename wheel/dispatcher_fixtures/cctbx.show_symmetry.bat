@@ -0,0 +1,12 @@
+@setlocal
+@set LIBTBX_BUILD=%~dp0
+@set LIBTBX_BUILD=%LIBTBX_BUILD:~0,-1%
+@for %%F in ("%LIBTBX_BUILD%") do @set LIBTBX_BUILD=%%~dpF
+@set LIBTBX_BUILD=%LIBTBX_BUILD:~0,-1%
+@set LIBTBX_BUILD=%LIBTBX_BUILD%\share\cctbx
+@set LIBTBX_PREFIX=%LIBTBX_BUILD%\..\..
+@set LIBTBX_DISPATCHER_NAME=%~nx0
+@set PATH=%LIBTBX_PREFIX%\..\Scripts;%LIBTBX_PREFIX%\bin;%PATH%
+@set PYTHONPATH=%LIBTBX_PREFIX%\..\lib\site-packages;%PYTHONPATH%
+@set LIBTBX_PYEXE=%LIBTBX_PREFIX%\..\python.exe
+@"%LIBTBX_PYEXE%" "%LIBTBX_PREFIX%\..\lib\site-packages\cctbx\command_line\show_symmetry.py" %*
@@ -0,0 +1,116 @@
+"""
+Timing, counters and console output for the phases of a conversion
+"""
+import json
+import platform
+import sys
+import time
+
+from contextlib import contextmanager
+
+# console output modes
+OUTPUT_MODES = ('verbose', 'progress', 'quiet')
+
+# =============================================================================
+class Phase():
+  """Wall time, number of files and bytes of one phase. A phase that is
+  entered several times accumulates."""
+  def __init__(self, name):
+    self.name = name
+    self.seconds = 0.0
+    self.files = 0
+    self.bytes = 0
+
+  def add(self, files=0, n_bytes=0):
+    self.files += files
+    self.bytes += n_bytes or 0
+
+  def to_dict(self):
+    return {'name': self.name, 'seconds': self.seconds,
+            'files': self.files, 'bytes': self.bytes}
+
+# =============================================================================
+class ConversionReport():
+  """Collect the phases of a conversion and control the console output.
+
+  Parameters
+  ----------
+  output : str, optional
+      "verbose" prints every file, "progress" updates one line per phase
+      and "quiet" only prints the summary. Default is "verbose".
+  """
+  def __init__(self, output='verbose'):
+    assert output in OUTPUT_MODES, output
+    self.output = output
+    self.phases = {}
+    self.counts = {}
+    self.start_time = time.perf_counter()
+    self._progress = None
+
+  # ---------------------------------------------------------------------------
+  @contextmanager
+  def phase(self, name):
+    """Time a block and yield its Phase for the counters."""
+    phase = self.phases.get(name)
+    if phase is None:
+      phase = self.phases[name] = Phase(name)
+    t0 = time.perf_counter()
+    try:
+      yield phase
+    finally:
+      phase.seconds += time.perf_counter() - t0
+      self._end_progress()
+
+  def heading(self, title):
+    if self.output != 'quiet':
+      print('='*79)
+      print(title)
+      print('='*79)
+
+  def log(self, text):
+    """Print per-file output in verbose mode."""
+    if self.output == 'verbose':
+      print(text)
+
+  def progress(self, label, done, total):
+    """Update the progress line, at most once per percent."""
+    if self.output != 'progress' or total == 0:
+      return
+    percent = 100 * done // total
+    if self._progress == (label, percent) and done != total:
+      return
+    self._progress = (label, percent)
+    sys.stdout.write(f'\r{label:<12} {done}/{total} files ({percent}%)')
+    sys.stdout.flush()
+
+  def _end_progress(self):
+    if self._progress is not None:
+      sys.stdout.write('\n')
+      sys.stdout.flush()
+      self._progress = None
+
+  # ---------------------------------------------------------------------------
+  @property
+  def total_seconds(self):
+    return time.perf_counter() - self.start_time
+
+  def print_phases(self):
+    print(f'{"phase":<16} {"seconds":>10} {"files":>10} {"bytes":>14}')
+    for phase in self.phases.values():
+      print(f'{phase.name:<16} {phase.seconds:>10.3f} {phase.files:>10} {phase.bytes:>14}')
+    print(f'{"total":<16} {self.total_seconds:>10.3f}')
+
+  def to_dict(self):
+    return {
+      'platform': sys.platform,
+      'machine': platform.machine(),
+      'python': platform.python_version(),
+      'output': self.output,
+      'total_seconds': self.total_seconds,
+      'phases': [phase.to_dict() for phase in self.phases.values()],
+      'counts': self.counts,
+    }
+
+  def write(self, filename):
+    with open(filename, 'w') as f:
+      json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,478 @@
+"""
+Rewriting of the library references of native binaries
+
+The binaries of a conda package find their libraries through @rpath
+(macOS) or RUNPATH (Linux) entries that point into the conda environment
+they were built for. The references are rewritten to the lib directory of
+the active conda environment, following the libraries that are found
+there, so that every binary is inspected and rewritten only once.
+
+LibraryBundler instead makes the converted tree relocatable. The
+libraries loaded from the conda environment are copied into one bundled
+library directory and every binary finds them with an rpath relative to
+itself ($ORIGIN on Linux, @loader_path on macOS), so the installed wheel
+loads without LD_LIBRARY_PATH and the dynamic loader searches a single
+directory. The load closure can be checked offline with check.
+"""
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from subprocess import check_output
+
+# number of files signed by one codesign call
+SIGN_BATCH_SIZE = 64
+
+# auditwheel policy with the libraries every Linux system provides
+POLICY_FILE = Path(__file__).resolve().parent / 'manylinux-policy.json'
+
+# directory of the installed files in the paths that LibraryBundler.check
+# resolves like the dynamic loader
+INSTALL_ROOT = '/<site-packages>'
+
+# =============================================================================
+def break_hardlink(filename):
+  """Replace a file that shares its inode with other paths by a copy, so
+  that the tools, which rewrite binaries in place, do not modify the other
+  paths (e.g. the extracted conda package or the package cache)."""
+  if os.stat(filename).st_nlink < 2:
+    return False
+  filename = Path(filename)
+  tmp_file = filename.with_name(f'.{filename.name}.{os.getpid()}.tmp')
+  try:
+    shutil.copy2(filename, tmp_file)
+    os.replace(tmp_file, filename)
+  finally:
+    if tmp_file.exists():
+      tmp_file.unlink()
+  return True
+
+# =============================================================================
+class MachOTool():
+  """otool, install_name_tool and codesign for Mach-O binaries."""
+
+  name = 'otool'
+
+  def dependencies(self, filename):
+    """Return the install names of the libraries loaded by a binary."""
+    output = check_output(['otool', '-L', filename]).decode('utf8')
+    dependencies = []
+    for line in output.splitlines():
+      # skip the file name (once per architecture of universal binaries)
+      if not line.startswith(('\t', ' ')):
+        continue
+      dependency = line.split()[0]
+      if dependency not in dependencies:
+        dependencies.append(dependency)
+    return dependencies
+
+  def resolve(self, dependency, lib_dir):
+    """Return the library in lib_dir that replaces a dependency, or None
+    if the dependency is kept."""
+    if not dependency.startswith('@rpath'):
+      return None
+    return lib_dir / dependency.split('/')[-1]
+
+  def rewrite(self, filename, changes, lib_dir):
+    """Apply all (dependency, library) changes with one call."""
+    command = ['install_name_tool']
+    for dependency, library in changes:
+      command.extend(['-change', dependency, str(library)])
+    command.append(str(filename))
+    return check_output(command).decode('utf8')
+
+  def sign(self, filenames):
+    command = ['codesign', '--continue', '-s', '-', '-f']
+    command.extend(str(filename) for filename in filenames)
+    return check_output(command).decode('utf8')
+
+  # ---------------------------------------------------------------------------
+  # relative rpaths, see LibraryBundler
+
+  origin = '@loader_path'
+
+  def is_system(self, dependency, system_libraries):
+    return dependency.startswith(('/usr/lib/', '/System/')) \
+      or dependency in system_libraries
+
+  def rpaths(self, filename):
+    """Return the LC_RPATH entries of a binary."""
+    output = check_output(['otool', '-l', str(filename)]).decode('utf8')
+    return list(dict.fromkeys(
+      re.findall(r'cmd LC_RPATH\n\s+cmdsize \d+\n\s+path (.+?) \(offset', output)))
+
+  def candidates(self, dependency, origin, rpaths):
+    """Return the paths the loader tries for a dependency of a binary in
+    the directory origin, in order."""
+    if dependency.startswith('@rpath/'):
+      return [posixpath.join(rpath.replace(self.origin, origin), dependency[7:])
+              for rpath in rpaths]
+    return [dependency.replace(self.origin, origin)]
+
+  def relocate(self, filename, changes, rpath):
+    """Load the (dependency, library) changes through @rpath and replace
+    the LC_RPATH entries with rpath."""
+    command = ['install_name_tool']
+    for dependency, library in changes:
+      if library.name == Path(filename).name:
+        command.extend(['-id', f'@rpath/{library.name}'])
+      else:
+        command.extend(['-change', dependency, f'@rpath/{library.name}'])
+    for old_rpath in self.rpaths(filename):
+      command.extend(['-delete_rpath', old_rpath])
+    command.extend(['-add_rpath', rpath, str(filename)])
+    return check_output(command).decode('utf8')
+
+# =============================================================================
+class ELFTool():
+  """patchelf for ELF binaries.
+
+  Libraries that are loaded by their soname and exist in the lib directory
+  are resolved there, and the RUNPATH of the binary is set to the lib
+  directory. ELF files do not need to be signed.
+  """
+
+  name = 'patchelf'
+
+  def dependencies(self, filename):
+    output = check_output(['patchelf', '--print-needed', filename]).decode('utf8')
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+  def resolve(self, dependency, lib_dir):
+    if '/' in dependency or not (lib_dir / dependency).exists():
+      return None
+    return lib_dir / dependency
+
+  def rewrite(self, filename, changes, lib_dir):
+    return check_output(['patchelf', '--set-rpath', str(lib_dir),
+                         str(filename)]).decode('utf8')
+
+  def sign(self, filenames):
+    return ''
+
+  # ---------------------------------------------------------------------------
+  # relative rpaths, see LibraryBundler
+
+  origin = '$ORIGIN'
+
+  def is_system(self, dependency, system_libraries):
+    return dependency in system_libraries or dependency.startswith('ld-linux')
+
+  def rpaths(self, filename):
+    """Return the RUNPATH (or RPATH) entries of a binary."""
+    output = check_output(['patchelf', '--print-rpath', str(filename)]).decode('utf8')
+    return [rpath for rpath in output.strip().split(':') if rpath]
+
+  def candidates(self, dependency, origin, rpaths):
+    if '/' in dependency:
+      return [dependency]
+    return [posixpath.join(rpath.replace('${ORIGIN}', origin).replace(self.origin, origin),
+                           dependency) for rpath in rpaths]
+
+  def relocate(self, filename, changes, rpath):
+    """Load the (dependency, library) changes by their file name and set
+    the RUNPATH to rpath."""
+    command = ['patchelf', '--set-rpath', rpath]
+    for dependency, library in changes:
+      if dependency != library.name and library.name != Path(filename).name:
+        command.extend(['--replace-needed', dependency, library.name])
+    command.append(str(filename))
+    return check_output(command).decode('utf8')
+
+TOOLS = {
+  MachOTool.name: MachOTool,
+  ELFTool.name: ELFTool,
+}
+
+# =============================================================================
+class RpathFixer():
+  """Rewrite the library references of binaries and of the libraries they
+  load from lib_dir.
+
+  The dependencies of every file are read once and cached, and files that
+  were already fixed are skipped by later calls to fix, so the libraries
+  shared by many extensions are only handled the first time. Hardlinked
+  files are copied before they are rewritten (see break_hardlink).
+
+  Parameters
+  ----------
+  lib_dir : str or Path
+      The lib directory of the conda environment.
+  tool : str, optional
+      The key of the tool in TOOLS. Default is None, "otool" on macOS and
+      "patchelf" on other platforms.
+  jobs : int, optional
+      The number of parallel workers. Default is None, the number of CPUs.
+  """
+  def __init__(self, lib_dir, tool=None, jobs=None):
+    self.lib_dir = Path(lib_dir)
+    if tool is None:
+      tool = MachOTool.name if sys.platform == 'darwin' else ELFTool.name
+    self.tool = TOOLS[tool]()
+    self.jobs = jobs
+    self.dependencies = {}
+    self.changes = {}
+    self.fixed = set()
+
+  # ---------------------------------------------------------------------------
+  def _inspect(self, filename):
+    """Return the changes and the libraries in lib_dir of a file."""
+    changes = []
+    libraries = []
+    for dependency in self.tool.dependencies(filename):
+      library = self.tool.resolve(dependency, self.lib_dir)
+      # the install name of a library refers to itself
+      if library is None or library.name == filename.name:
+        continue
+      assert library.exists(), library
+      changes.append((dependency, library))
+      libraries.append(library.resolve())
+    return changes, libraries
+
+  def graph(self, filenames, executor):
+    """Inspect the files and the libraries they load, one level of the
+    dependency graph at a time, and return the files that are not fixed."""
+    level = []
+    for filename in filenames:
+      filename = Path(filename).resolve()
+      if filename not in self.fixed and filename not in level:
+        level.append(filename)
+    found = list(level)
+    while level:
+      new = [filename for filename in level if filename not in self.changes]
+      for filename, (changes, libraries) in zip(new, executor.map(self._inspect, new)):
+        self.changes[filename] = changes
+        self.dependencies[filename] = libraries
+      next_level = []
+      for filename in level:
+        for library in self.dependencies[filename]:
+          if library not in self.fixed and library not in found:
+            found.append(library)
+            next_level.append(library)
+      level = next_level
+    return found
+
+  def _rewrite(self, filename):
+    changes = self.changes[filename]
+    if changes:
+      break_hardlink(filename)
+      self.tool.rewrite(filename, changes, self.lib_dir)
+    return changes
+
+  # ---------------------------------------------------------------------------
+  def fix(self, filenames):
+    """Fix the files and their libraries and return the changes of every
+    file that was rewritten."""
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      found = self.graph(filenames, executor)
+
+      # every file is rewritten with one call
+      fixed = {}
+      for filename, changes in zip(found, executor.map(self._rewrite, found)):
+        self.fixed.add(filename)
+        if changes:
+          fixed[filename] = changes
+
+      # sign in batches after all changes
+      rewritten = sorted(fixed)
+      batches = [rewritten[i:i + SIGN_BATCH_SIZE]
+                 for i in range(0, len(rewritten), SIGN_BATCH_SIZE)]
+      for output in executor.map(self.tool.sign, batches):
+        if output:
+          print(output)
+    return fixed
+
+# =============================================================================
+def load_system_libraries(policy_file=POLICY_FILE):
+  """Return the libraries that every manylinux policy allows to be loaded
+  from the system."""
+  with open(policy_file) as f:
+    policies = json.load(f)
+  return frozenset(library for policy in policies
+                   for library in policy.get('lib_whitelist', []))
+
+class LibraryBundler():
+  """Point binaries to one bundled library directory with rpaths relative
+  to every binary.
+
+  The rpaths are computed for the installed layout, where the roots (e.g.
+  the src and lib trees) are merged into site-packages. Dependencies that
+  are neither system libraries nor installed next to the bundle are copied
+  into it from the search directories (the lib directory of the conda
+  environment) and relocated as well, so the bundle holds the whole load
+  closure. Like RpathFixer, every file is inspected and rewritten once per
+  bundler.
+
+  Parameters
+  ----------
+  bundle_dir : str or Path
+      The bundled library directory.
+  roots : list, optional
+      Directories that are installed into the same directory, bundle_dir
+      must be in one of them. Default is None, the parent of bundle_dir.
+  search_dirs : list, optional
+      Directories with the libraries that are copied into the bundle.
+  tool : str, optional
+      The key of the tool in TOOLS. Default is None, "otool" on macOS and
+      "patchelf" on other platforms.
+  jobs : int, optional
+      The number of parallel workers. Default is None, the number of CPUs.
+  system_libraries : set of str, optional
+      Libraries that are loaded from the system. Default is None, the
+      libraries allowed by manylinux-policy.json.
+  """
+  def __init__(self, bundle_dir, roots=None, search_dirs=(), tool=None, jobs=None,
+               system_libraries=None):
+    self.bundle_dir = Path(bundle_dir).resolve()
+    if roots is None:
+      roots = [self.bundle_dir.parent]
+    self.roots = [Path(root).resolve() for root in roots]
+    self.search_dirs = [Path(search_dir) for search_dir in search_dirs]
+    if tool is None:
+      tool = MachOTool.name if sys.platform == 'darwin' else ELFTool.name
+    self.tool = TOOLS[tool]()
+    self.jobs = jobs
+    if system_libraries is None:
+      system_libraries = load_system_libraries()
+    self.system_libraries = frozenset(system_libraries)
+    self.installed_bundle = self.installed(self.bundle_dir)
+    assert self.installed_bundle is not None, (bundle_dir, roots)
+    self.dependencies = {}
+    self.relocated = set()
+    self.bundled = {}
+
+  # ---------------------------------------------------------------------------
+  def installed(self, path):
+    """Return the installed path of a file below INSTALL_ROOT, or None if
+    it is not in a root."""
+    path = Path(path)
+    for root in self.roots:
+      if path.is_relative_to(root):
+        return posixpath.join(INSTALL_ROOT, path.relative_to(root).as_posix())
+    return None
+
+  def installed_file(self, path):
+    """Return the file that is installed at a path below INSTALL_ROOT."""
+    path = posixpath.normpath(path)
+    if not path.startswith(INSTALL_ROOT + '/'):
+      return None
+    relative = path[len(INSTALL_ROOT) + 1:]
+    for root in self.roots:
+      if (root / relative).exists():
+        return (root / relative).resolve()
+    return None
+
+  def rpath(self, filename):
+    """Return the rpath from an installed binary to the bundle."""
+    relative = posixpath.relpath(self.installed_bundle,
+                                 posixpath.dirname(self.installed(filename)))
+    if relative == '.':
+      return self.tool.origin
+    return f'{self.tool.origin}/{relative}'
+
+  def _find(self, dependency):
+    """Return the library installed in the bundle or in a search directory
+    for a dependency, or None."""
+    name = dependency.split('/')[-1]
+    library = self.installed_file(posixpath.join(self.installed_bundle, name))
+    if library is not None:
+      return library
+    for directory in self.search_dirs:
+      if (directory / name).exists():
+        return directory / name
+    return None
+
+  def _dependencies(self, filename):
+    return [dependency for dependency in self.tool.dependencies(filename)
+            if not self.tool.is_system(dependency, self.system_libraries)]
+
+  def _bundle(self, library):
+    """Copy a library from a search directory into the bundle."""
+    if self.installed(library) is not None:
+      return library
+    bundled = self.bundle_dir / library.name
+    shutil.copyfile(library, bundled)
+    os.chmod(bundled, 0o755)
+    self.bundled[bundled] = library
+    return bundled
+
+  # ---------------------------------------------------------------------------
+  def relocate(self, filenames):
+    """Bundle the libraries of the files and point the files and the
+    bundled libraries to the bundle. Return the rpath of every file that
+    was rewritten."""
+    self.bundle_dir.mkdir(parents=True, exist_ok=True)
+    level = list(dict.fromkeys(Path(filename).resolve() for filename in filenames))
+    level = [filename for filename in level if filename not in self.relocated]
+    found = list(level)
+    changes = {}
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      # one level of the dependency graph at a time
+      while level:
+        next_level = []
+        for filename, dependencies in zip(level, executor.map(self._dependencies, level)):
+          self.dependencies[filename] = dependencies
+          changes[filename] = []
+          for dependency in dependencies:
+            library = self._find(dependency)
+            if library is None:
+              continue
+            library = self._bundle(library)
+            changes[filename].append((dependency, library))
+            if library not in self.relocated and library not in found:
+              found.append(library)
+              next_level.append(library)
+        level = next_level
+
+      def relocate_one(filename):
+        rpath = self.rpath(filename)
+        break_hardlink(filename)
+        self.tool.relocate(filename, changes[filename], rpath)
+        return rpath
+
+      relocated = dict(zip(found, executor.map(relocate_one, found)))
+      self.relocated.update(relocated)
+
+      rewritten = sorted(relocated)
+      batches = [rewritten[i:i + SIGN_BATCH_SIZE]
+                 for i in range(0, len(rewritten), SIGN_BATCH_SIZE)]
+      for output in executor.map(self.tool.sign, batches):
+        if output:
+          print(output)
+    return relocated
+
+  def check(self, filenames):
+    """Resolve the load closure of the installed files like the dynamic
+    loader, only with their own rpaths and without any environment
+    variables or files outside the roots, and return {filename:
+    [dependencies that are not found]}."""
+    level = list(dict.fromkeys(Path(filename).resolve() for filename in filenames))
+    checked = set(level)
+    missing = {}
+
+    def inspect(filename):
+      return self._dependencies(filename), self.tool.rpaths(filename)
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      while level:
+        next_level = []
+        for filename, (dependencies, rpaths) in zip(level, executor.map(inspect, level)):
+          origin = posixpath.dirname(self.installed(filename))
+          for dependency in dependencies:
+            library = None
+            for candidate in self.tool.candidates(dependency, origin, rpaths):
+              library = self.installed_file(candidate)
+              if library is not None:
+                break
+            if library is None:
+              missing.setdefault(filename, []).append(dependency)
+            elif library not in checked:
+              checked.add(library)
+              next_level.append(library)
+        level = next_level
+    return missing
@@ -0,0 +1,48 @@
+"""
+Regression test of the classification rules against classify_cases.json, run
+with
+
+  python -m pytest -c wheel/pytest.ini wheel
+
+The table has representative paths of conda packages for every platform
+with the rule, destination tree, path below the tree and file list they
+got from the if-chain that preceded the rule table. Update it only for
+intended changes of the classification.
+"""
+import json
+import os
+
+import pytest
+
+from classify import RULES, Classifier
+
+CASES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classify_cases.json')
+
+with open(CASES_FILE) as f:
+  CASES = json.load(f)
+
+# =============================================================================
+@pytest.mark.parametrize('platform', sorted(CASES['platforms']))
+def test_classification_unchanged(platform):
+  classifier = Classifier(CASES['binary_files'], platform=platform)
+  mismatches = []
+  for path, rule, tree, relative, kind in CASES['platforms'][platform]:
+    result = classifier.classify(path)
+    result = (result[0], result[1], '/'.join(result[2]) if result[1] else None, result[3])
+    if result != (rule, tree, relative, kind):
+      mismatches.append((path, (rule, tree, relative, kind), result))
+  assert mismatches == []
+
+@pytest.mark.parametrize('platform', sorted(CASES['platforms']))
+def test_every_rule_is_covered(platform):
+  rules = {rule['name'] for rule in RULES
+           if rule.get('platforms') is None or platform in rule['platforms']}
+  covered = {case[1] for case in CASES['platforms'][platform]}
+  assert rules - covered == set()
+
+def test_classification_is_cached_per_directory():
+  classifier = Classifier(CASES['binary_files'], platform='linux')
+  paths = [case[0] for case in CASES['platforms']['linux']]
+  first = [classifier.classify(path) for path in paths]
+  assert [classifier.classify(path) for path in paths] == first
+  assert sum(classifier.counts.values()) == 2 * len(paths)
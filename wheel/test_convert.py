@@ -0,0 +1,276 @@
+"""
+Tests of CondaWheelConverter.copy_files against a small extracted conda
+package, run with
+
+  python -m pytest -c wheel/pytest.ini wheel
+
+The rpaths are fixed with a fake patchelf that rewrites binaries in place
+like the real one, so the tests run without patchelf and a conda
+environment.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+import pytest
+
+from pathlib import Path
+
+from build_backend import _split_keys
+from convert import CondaWheelConverter, dispatcher_environment
+from rpaths import RpathFixer
+
+WHEEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# dispatchers written by libtbx for cctbx.show_symmetry
+FIXTURES_DIR = os.path.join(WHEEL_DIR, 'dispatcher_fixtures')
+
+ELF = b'\x7fELF\x02\x01\x01\x00' + bytes(248)
+
+# path in the package and contents
+PACKAGE_FILES = {
+  'lib/libcctbx.so': ELF,
+  'lib/python3.12/site-packages/cctbx_sgtbx_ext.cpython-312-x86_64-linux-gnu.so': ELF,
+  'lib/python3.12/site-packages/cctbx/__init__.py': b'import sys\n' * 100,
+  'share/cctbx/tst_foo': ELF,
+  'share/cctbx/regression/data.cif': b'data_cctbx\n' * 100,
+  'share/cctbx/libtbx_env': b'libtbx environment\n' * 100,
+  'share/cctbx/reference/sym_op.lib': b'symop\n' * 100,
+  'lib/python3.12/site-packages/cctbx/command_line/show_symmetry.py': b'print()\n',
+  'bin/cctbx.show_symmetry': b'''\
+#! /bin/sh
+LIBTBX_BUILD="$(cd "$(dirname "$0")" && cd ../share/cctbx && pwd)"
+export LIBTBX_BUILD
+LIBTBX_PYEXE="$LIBTBX_PREFIX/bin/python3.12"
+"$LIBTBX_PYEXE" "$LIBTBX_PREFIX/lib/python3.12/site-packages/cctbx/command_line/show_symmetry.py" "$@"
+''',
+  'bin/cctbx.find_distances': ELF,
+}
+
+# prints the dependency libdep.so for every file, and writes the rpath
+# into the file without replacing it
+FAKE_PATCHELF = '''\
+import sys
+with open(sys.argv[-1], 'r+b') as f:
+  f.seek(16)
+  if sys.argv[1] == '--print-needed':
+    print('libdep.so')
+  elif sys.argv[1] == '--print-rpath':
+    print(f.read(240).partition(b'\\0')[0].decode('utf8'))
+  elif sys.argv[1] == '--set-rpath':
+    f.write(sys.argv[2].encode('utf8') + b'\\0')
+'''
+
+# =============================================================================
+def write_package(root, files):
+  """Write an extracted conda package with info/files and info/paths.json."""
+  entries = []
+  for path, contents in sorted(files.items()):
+    filename = root / path
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    filename.write_bytes(contents)
+    entries.append({'_path': path, 'path_type': 'hardlink',
+                    'sha256': hashlib.sha256(contents).hexdigest(),
+                    'size_in_bytes': len(contents)})
+  (root / 'info').mkdir(exist_ok=True)
+  (root / 'info' / 'files').write_text(''.join(f'{path}\n' for path in sorted(files)))
+  with open(root / 'info' / 'paths.json', 'w') as f:
+    json.dump({'paths': entries, 'paths_version': 1}, f)
+
+def snapshot(root):
+  """Return {path: (inode, sha256)} of the files below root."""
+  files = {}
+  for filename in sorted(root.rglob('*')):
+    if filename.is_file():
+      files[filename.relative_to(root).as_posix()] = (
+        filename.stat().st_ino, hashlib.sha256(filename.read_bytes()).hexdigest())
+  return files
+
+@pytest.fixture
+def package(tmp_path):
+  root = tmp_path / 'cctbx-base-1.0-0'
+  write_package(root, PACKAGE_FILES)
+  return root
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+  """The wheel directory with the pyproject.toml template as the working
+  directory of the conversion."""
+  work_dir = tmp_path / 'wheel'
+  work_dir.mkdir()
+  shutil.copy(os.path.join(WHEEL_DIR, 'pyproject.toml'), work_dir)
+  monkeypatch.chdir(work_dir)
+  return work_dir
+
+@pytest.fixture
+def patchelf(tmp_path, monkeypatch):
+  """A fake patchelf on PATH and a conda environment with libdep.so."""
+  bin_dir = tmp_path / 'tools'
+  bin_dir.mkdir()
+  script = bin_dir / 'patchelf'
+  script.write_text(f'#!{sys.executable}\n{FAKE_PATCHELF}')
+  script.chmod(0o755)
+  monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+  conda_prefix = tmp_path / 'env'
+  (conda_prefix / 'lib').mkdir(parents=True)
+  (conda_prefix / 'lib' / 'libdep.so').write_bytes(ELF)
+  monkeypatch.setenv('CONDA_PREFIX', str(conda_prefix))
+  return conda_prefix
+
+# =============================================================================
+@pytest.mark.skipif(sys.platform != 'linux', reason='patchelf is used on Linux')
+def test_rpath_pass_keeps_package(package, work_dir, patchelf):
+  before = snapshot(package)
+  converter = CondaWheelConverter(rpath_tool='patchelf', output='quiet')
+  assert converter.copy_files(package)
+
+  # the binaries in lib and share were rewritten, the package was not
+  fixed = [work_dir / 'lib' / 'libcctbx.so',
+           work_dir / 'src' / 'libtbx' / 'core' / 'share' / 'cctbx' / 'tst_foo']
+  for filename in fixed:
+    assert str(patchelf / 'lib').encode('utf8') in filename.read_bytes()
+  assert snapshot(package) == before
+
+  # only files that are never modified are linked to the package
+  manifest = json.loads((work_dir / 'conversion_manifest.json').read_text())
+  for key, entry in manifest.items():
+    if entry.get('native') is not None:
+      assert (work_dir / key).stat().st_nlink == 1, key
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='patchelf is used on Linux')
+def test_rpath_fixer_breaks_hardlinks(tmp_path, patchelf):
+  source = tmp_path / 'libcctbx.so'
+  source.write_bytes(ELF)
+  source.chmod(0o755)
+  linked = tmp_path / 'linked.so'
+  os.link(source, linked)
+
+  fixed = RpathFixer(patchelf / 'lib', tool='patchelf').fix([linked])
+  assert list(fixed) == [linked.resolve()]
+  assert source.read_bytes() == ELF
+  assert linked.read_bytes() != ELF
+  assert linked.stat().st_nlink == 1
+  assert linked.stat().st_mode & 0o777 == 0o755
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='patchelf is used on Linux')
+def test_unchanged_incremental_conversion(package, work_dir, patchelf, capsys):
+  converter = CondaWheelConverter(incremental=True, relative_rpaths=True,
+                                  rpath_tool='patchelf', output='quiet')
+  assert converter.copy_files(package)
+  manifest = json.loads((work_dir / 'conversion_manifest.json').read_text())
+  assert any('bundled_from' in entry for entry in manifest.values())
+  entry_points = sorted((work_dir / 'src' / 'libtbx' / 'core' / 'dispatchers').glob('*.py'))
+  before = {filename: filename.stat().st_mtime_ns for filename in entry_points}
+  capsys.readouterr()
+
+  converter = CondaWheelConverter(incremental=True, relative_rpaths=True,
+                                  rpath_tool='patchelf', output='quiet')
+  assert converter.copy_files(package)
+  output = capsys.readouterr().out
+  assert 'Removed   0 files' in output
+  counts = converter.report.counts
+  assert counts['removed'] == 0
+  assert counts['reused'] == counts['copied'] == len(PACKAGE_FILES)
+  assert json.loads((work_dir / 'conversion_manifest.json').read_text()) == manifest
+  assert {filename: filename.stat().st_mtime_ns for filename in entry_points} == before
+
+# =============================================================================
+def dispatcher_references(converter, manifest):
+  """Return the manifest keys of the files the dispatchers and entry points
+  of a converted tree need: themselves, the Python script they run and the
+  libtbx_env of the LIBTBX_BUILD directory."""
+  root = converter.manifest_file.parent
+  references = set()
+  for key in manifest:
+    filename = root / key
+    if filename.parent not in (converter.bin_path, converter.entry_point_path):
+      continue
+    references.add(key)
+    contents = filename.read_bytes()
+    script = converter._dispatcher_script(contents)
+    if script is not None:
+      references.add(f'src/{script}')
+    for module in re.findall(rb'LIBTBX_BUILD=.*share/(\w+)', contents):
+      references.add(f'src/libtbx/core/share/{module.decode()}/libtbx_env')
+  return references
+
+def test_split_keeps_dispatcher_references(package, work_dir):
+  converter = CondaWheelConverter(output='quiet')
+  assert converter.copy_files(package)
+  manifest = json.loads((work_dir / 'conversion_manifest.json').read_text())
+  splits = {split: set(_split_keys(manifest, split)[0])
+            for split in ('runtime', 'dispatchers', 'tests')}
+
+  references = dispatcher_references(converter, manifest)
+  assert 'src/libtbx/core/share/cctbx/libtbx_env' in references
+  assert 'src/cctbx/command_line/show_symmetry.py' in references
+  assert references <= splits['runtime'] | splits['dispatchers']
+
+  # only the test binaries and the test data are in the tests wheel
+  assert splits['tests'] == {'src/libtbx/core/share/cctbx/tst_foo',
+                             'src/libtbx/core/share/cctbx/regression/data.cif'}
+  assert 'src/libtbx/core/share/cctbx/reference/sym_op.lib' in splits['runtime']
+
+# =============================================================================
+def entry_point_namespace(dispatcher, contents):
+  """Return the globals of the entry point module of a dispatcher."""
+  entry_point = CondaWheelConverter()._entry_point(dispatcher, contents)
+  assert 'runpy.run_path' in entry_point
+  namespace = {}
+  exec(entry_point, namespace)
+  return namespace
+
+def read_fixture(name):
+  with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+    return f.read()
+
+@pytest.mark.parametrize('pythonpath', ['', '/site'])
+def test_shell_dispatcher_environment(tmp_path, pythonpath):
+  namespace = entry_point_namespace('cctbx.show_symmetry.bat',
+                                    read_fixture('cctbx.show_symmetry'))
+  prefix = tmp_path / 'libtbx' / 'core'
+  (prefix / 'share' / 'cctbx').mkdir(parents=True)
+  environ = {'PYTHONHOME': '/conda', 'PYTHONPATH': pythonpath}
+  namespace['apply_environment'](prefix / 'dispatchers' / 'cctbx.show_symmetry.bat', environ)
+
+  site_packages = f'{prefix.resolve()}/lib/python3.12/site-packages'
+  assert 'PYTHONHOME' not in environ
+  assert environ['LIBTBX_BUILD'] == str((prefix / 'share' / 'cctbx').resolve())
+  assert environ['LIBTBX_PREFIX'] == str(prefix.resolve())
+  assert environ['LIBTBX_PYEXE'] == f'{prefix.resolve()}/bin/python3.12'
+  assert environ['PYTHONPATH'] == (f'{site_packages}:{pythonpath}' if pythonpath
+                                   else site_packages)
+  assert '?0' not in environ
+
+@pytest.mark.parametrize('patched', [False, True])
+def test_batch_dispatcher_environment(patched):
+  contents = read_fixture('cctbx.show_symmetry.bat')
+  if patched:
+    contents = CondaWheelConverter()._patch_windows_dispatcher(
+      contents.decode('utf8')).encode('utf8')
+  namespace = entry_point_namespace('cctbx.show_symmetry.bat', contents)
+  environ = {'PYTHONPATH': '/site'}
+  namespace['apply_environment'](Path('/conda/Library/bin/cctbx.show_symmetry.bat'), environ)
+
+  # %~dp0 without the separator, its directory and again without the separator
+  assert environ['LIBTBX_BUILD'] == '/conda/Library\\share\\cctbx'
+  assert environ['LIBTBX_DISPATCHER_NAME'] == 'cctbx.show_symmetry.bat'
+  if patched:
+    assert environ['LIBTBX_PYEXE'] == 'python.exe'
+    assert environ['PYTHONPATH'] == '/site'
+  else:
+    assert environ['LIBTBX_PYEXE'] == '/conda/Library\\share\\cctbx\\..\\..\\..\\python.exe'
+    assert environ['PYTHONPATH'].endswith('\\lib\\site-packages;/site')
+
+@pytest.mark.parametrize('line', [
+  'cd "$LIBTBX_BUILD"',
+  'LIBTBX_BUILD="$(cd "$LIBTBX_PREFIX" && pwd)"',
+  'if [ $# -eq 0 ]; then\n  PYTHONPATH="/site"\nfi',
+  'if [ -n "$PYTHONPATH" ]; then',
+  '@set LIBTBX_BUILD=%LIBTBX_BUILD:a=b%',
+])
+def test_unsupported_dispatcher(line):
+  assert dispatcher_environment(f'#!/bin/sh\n{line}\n') is None
@@ -0,0 +1,512 @@
+"""
+Functions for writing wheels directly, without setuptools
+"""
+import base64
+import glob
+import hashlib
+import importlib.util
+import marshal
+import os
+import re
+import sys
+import sysconfig
+import time
+import zipfile
+import zlib
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+try:
+  import tomllib
+except ImportError:
+  try:
+    import tomli as tomllib
+  except ImportError:
+    tomllib = None
+
+# size of the blocks copied into the wheel, every block is compressed by
+# one worker
+CHUNK_SIZE = 1024 * 1024
+
+# the compressed blocks continue the deflate stream of the previous block
+# with its last 32 KiB as dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+# deflate level by file suffix, "*" for other files and None to store the
+# file without compression
+COMPRESSION_LEVELS = {
+  '*': 6,
+  # libraries
+  '.so': 6, '.pyd': 6, '.dll': 6, '.dylib': 6,
+  # text
+  '.py': 9, '.txt': 9, '.md': 9, '.json': 9, '.h': 9, '.hpp': 9, '.c': 9,
+  '.cpp': 9, '.cif': 9, '.pdb': 9, '.params': 9, '.html': 9,
+  # already compressed
+  '.gz': None, '.bz2': None, '.xz': None, '.zst': None, '.zip': None,
+  '.whl': None, '.png': None, '.jpg': None, '.jpeg': None, '.gif': None,
+  '.npz': None, '.pickle': None,
+}
+
+# flags of .pyc files that are validated against the hash of the source
+# instead of its timestamp (PEP 552)
+CHECKED_HASH_PYC = 0b11
+
+# module installed with a wheel that has deduplicated members, it is imported
+# by a .pth file at interpreter startup and links (or copies) the canonical
+# member to the paths of its duplicates once, see WheelWriter.write_duplicates.
+# .pth files are only processed in site directories, so the wheel has to be
+# installed into one (not with pip install --target or on PYTHONPATH)
+DUPLICATES_MODULE = '''\
+"""
+Restore the members of %(dist_info)s that were stored only once
+"""
+import os
+import sys
+
+DIST_INFO = %(dist_info)r
+
+# duplicate path: canonical path, relative to site-packages
+DUPLICATES = %(duplicates)r
+
+def restore():
+  root = os.path.dirname(os.path.abspath(__file__))
+  marker = os.path.join(root, DIST_INFO, 'DUPLICATES_RESTORED')
+  if os.path.exists(marker):
+    return
+  import shutil
+  try:
+    for duplicate, canonical in sorted(DUPLICATES.items()):
+      dest = os.path.join(root, duplicate)
+      if os.path.exists(dest):
+        continue
+      os.makedirs(os.path.dirname(dest), exist_ok=True)
+      tmp_dest = '%%s.%%d.tmp' %% (dest, os.getpid())
+      try:
+        os.link(os.path.join(root, canonical), tmp_dest)
+      except OSError:
+        shutil.copy2(os.path.join(root, canonical), tmp_dest)
+      os.replace(tmp_dest, dest)
+    # uninstalling removes the restored files as well
+    with open(os.path.join(root, DIST_INFO, 'RECORD'), 'a') as f:
+      for duplicate in sorted(DUPLICATES):
+        f.write(duplicate + ',,\\n')
+      f.write(DIST_INFO + '/DUPLICATES_RESTORED,,\\n')
+    open(marker, 'w').close()
+  except OSError as e:
+    # read-only installation, the duplicates stay missing until restore runs
+    # with write access to site-packages
+    sys.stderr.write('Warning: could not restore the duplicate files of %%s in '
+                     '%%s: %%s\\n' %% (DIST_INFO, root, e))
+
+restore()
+'''
+
+# =============================================================================
+def normalize_name(name):
+  # https://packaging.python.org/en/latest/specifications/binary-distribution-format/#escaping-and-unicode
+  return re.sub(r'[-_.]+', '_', name).lower()
+
+def get_tag():
+  """Return the wheel tag for the running interpreter and platform,
+  e.g. cp311-cp311-linux_x86_64."""
+  python_tag = f'cp{sys.version_info.major}{sys.version_info.minor}'
+  abi_tag = python_tag
+  if sysconfig.get_config_var('Py_GIL_DISABLED'):
+    abi_tag += 't'
+  platform_tag = sysconfig.get_platform().replace('-', '_').replace('.', '_')
+  return f'{python_tag}-{abi_tag}-{platform_tag}'
+
+def read_pyproject(filename='pyproject.toml', scripts=None):
+  """Parse pyproject.toml and return the [project] table.
+
+  Parameters
+  ----------
+  filename : str, optional
+      The pyproject.toml file. Default is "pyproject.toml".
+  scripts : list of str, optional
+      Lines that replace the INSERT_SCRIPTS_HERE placeholder, which is
+      not valid TOML. Default is None, no scripts.
+
+  Returns
+  -------
+  dict
+  """
+  if tomllib is None:
+    raise ImportError('Reading pyproject.toml requires Python 3.11 or the tomli package.')
+  with open(filename, 'r') as f:
+    lines = f.readlines()
+  text = []
+  for line in lines:
+    if 'INSERT_SCRIPTS_HERE' in line:
+      text.extend(line + '\n' for line in (scripts or []))
+    else:
+      text.append(line)
+  return tomllib.loads(''.join(text))['project']
+
+def parse_compression_levels(text):
+  """Parse "suffix=level" pairs separated by commas into a dictionary for
+  COMPRESSION_LEVELS, the level is 0-9 or "store"."""
+  levels = {}
+  for item in text.split(','):
+    if not item.strip():
+      continue
+    suffix, _, level = item.strip().partition('=')
+    if level == 'store':
+      levels[suffix] = None
+    elif level.isdigit() and 0 <= int(level) <= 9:
+      levels[suffix] = int(level)
+    else:
+      raise ValueError(f'Invalid compression level in {item!r}.')
+  return levels
+
+def _compress_block(data, level, dictionary, last):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zdict=dictionary) if dictionary \
+    else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) \
+    + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def bytecode_arcname(arcname):
+  """Return the path of the .pyc file of a module for the running
+  interpreter, e.g. a/__pycache__/b.cpython-311.pyc for a/b.py."""
+  path = PurePosixPath(arcname)
+  return str(path.parent / '__pycache__' / f'{path.stem}.{sys.implementation.cache_tag}.pyc')
+
+def compile_source(arcname, filename):
+  """Return the contents of a checked-hash .pyc file for a module, or None
+  if it cannot be compiled. The file name in the code objects is arcname,
+  the import system replaces it with the installed path."""
+  with open(filename, 'rb') as f:
+    source = f.read()
+  try:
+    code = compile(source, arcname, 'exec', dont_inherit=True)
+  except (SyntaxError, ValueError):
+    return None
+  return (importlib.util.MAGIC_NUMBER + CHECKED_HASH_PYC.to_bytes(4, 'little')
+          + importlib.util.source_hash(source) + marshal.dumps(code))
+
+def core_metadata(project, root='.'):
+  """Return the METADATA text and the license files for a [project] table.
+
+  Only the fields used by the pyproject.toml files in this repository
+  are translated.
+  """
+  lines = [
+    'Metadata-Version: 2.4',
+    f'Name: {project["name"]}',
+    f'Version: {project["version"]}',
+  ]
+  if 'description' in project:
+    lines.append(f'Summary: {project["description"]}')
+  for url_label, url in project.get('urls', {}).items():
+    lines.append(f'Project-URL: {url_label}, {url}')
+  for author in project.get('authors', []):
+    if 'name' in author:
+      lines.append(f'Author: {author["name"]}')
+    if 'email' in author:
+      lines.append(f'Author-email: {author["email"]}')
+  for maintainer in project.get('maintainers', []):
+    if 'email' in maintainer:
+      lines.append(f'Maintainer-email: {maintainer.get("name", "")} <{maintainer["email"]}>')
+    elif 'name' in maintainer:
+      lines.append(f'Maintainer: {maintainer["name"]}')
+  if isinstance(project.get('license'), str):
+    lines.append(f'License-Expression: {project["license"]}')
+  license_files = []
+  for pattern in project.get('license-files', []):
+    license_files.extend(sorted(glob.glob(os.path.join(root, pattern))))
+  for license_file in license_files:
+    lines.append(f'License-File: {os.path.relpath(license_file, root)}')
+  for classifier in project.get('classifiers', []):
+    lines.append(f'Classifier: {classifier}')
+  if 'requires-python' in project:
+    lines.append(f'Requires-Python: {project["requires-python"]}')
+  for dependency in project.get('dependencies', []):
+    lines.append(f'Requires-Dist: {dependency}')
+  for extra, dependencies in project.get('optional-dependencies', {}).items():
+    lines.append(f'Provides-Extra: {extra}')
+    for dependency in dependencies:
+      requirement, _, marker = dependency.partition(';')
+      marker = f'({marker.strip()}) and ' if marker.strip() else ''
+      lines.append(f'Requires-Dist: {requirement.strip()}; {marker}extra == "{extra}"')
+  description = ''
+  readme = project.get('readme')
+  if isinstance(readme, str):
+    content_type = 'text/markdown' if readme.endswith('.md') else 'text/plain'
+    lines.append(f'Description-Content-Type: {content_type}')
+    with open(os.path.join(root, readme), 'r', encoding='utf8') as f:
+      description = f.read()
+  return '\n'.join(lines) + '\n\n' + description, license_files
+
+def entry_points(project):
+  """Return the entry_points.txt text for a [project] table."""
+  groups = {}
+  if project.get('scripts'):
+    groups['console_scripts'] = project['scripts']
+  groups.update(project.get('entry-points', {}))
+  lines = []
+  for group, points in groups.items():
+    lines.append(f'[{group}]')
+    for point_name, value in points.items():
+      lines.append(f'{point_name} = {value}')
+    lines.append('')
+  return '\n'.join(lines)
+
+# =============================================================================
+class WheelWriter():
+  """Write a wheel member by member and keep track of the RECORD.
+
+  Members are hashed while they are read, so every file is read only
+  once. The blocks of the members are compressed by a pool of workers and
+  written in order, with at most a few blocks per worker in memory. The
+  timestamps are fixed (SOURCE_DATE_EPOCH if set) for reproducible
+  archives.
+
+  Parameters
+  ----------
+  wheel_dir : str
+      The output directory for the wheel.
+  name : str
+      The distribution name.
+  version : str
+      The distribution version.
+  tag : str, optional
+      The wheel tag. Default is None, the tag of the running interpreter.
+  jobs : int, optional
+      The number of compression workers. Default is None, the number of
+      CPUs.
+  levels : dict, optional
+      Changes to COMPRESSION_LEVELS.
+  """
+  def __init__(self, wheel_dir, name, version, tag=None, jobs=None, levels=None):
+    self.name = normalize_name(name)
+    self.version = version
+    self.tag = tag if tag is not None else get_tag()
+    self.dist_info = f'{self.name}-{self.version}.dist-info'
+    self.data_dir = f'{self.name}-{self.version}.data'
+    os.makedirs(wheel_dir, exist_ok=True)
+    self.filename = os.path.join(wheel_dir, f'{self.name}-{self.version}-{self.tag}.whl')
+    self.records = []
+    self.date_time = time.gmtime(int(os.environ.get('SOURCE_DATE_EPOCH', 315532800)))[:6]
+    self.zf = zipfile.ZipFile(self.filename, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    # compression
+    self.levels = dict(COMPRESSION_LEVELS)
+    self.levels.update(levels or {})
+    self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+    self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+    self.max_queued_bytes = 4 * self.jobs * CHUNK_SIZE
+    self._queue = deque()
+    self._queued_bytes = 0
+
+    # statistics for report
+    self.file_size = 0
+    self.compress_size = 0
+    self.duplicates = 0
+    self.duplicate_size = 0
+    self.compiled = 0
+    self.not_compiled = []
+    self.start_time = time.perf_counter()
+    self.elapsed = None
+
+  # ---------------------------------------------------------------------------
+  def _zipinfo(self, arcname, mode):
+    zinfo = zipfile.ZipInfo(arcname, date_time=self.date_time)
+    zinfo.external_attr = ((0o100000 | (mode & 0o7777)) << 16)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+  def compression_level(self, arcname):
+    """Return the deflate level of a member, None if it is stored."""
+    for suffix in reversed(PurePosixPath(arcname).suffixes):
+      if suffix in self.levels:
+        return self.levels[suffix]
+    return self.levels['*']
+
+  def _write_chunks(self, arcname, chunks, mode, size=None, record=True):
+    """Queue the blocks of a member for compression and return the number
+    of bytes."""
+    zinfo = self._zipinfo(arcname, mode)
+    zinfo.CRC = 0
+    level = self.compression_level(arcname)
+    if level is None:
+      zinfo.compress_type = zipfile.ZIP_STORED
+    zip64 = size is None or size * 1.05 >= zipfile.ZIP64_LIMIT
+    self._enqueue(('start', zinfo, zip64, 0))
+
+    h = hashlib.sha256()
+    crc = 0
+    n_bytes = 0
+    dictionary = b''
+    chunk = next(chunks, b'')
+    while True:
+      next_chunk = next(chunks, None)
+      last = next_chunk is None
+      h.update(chunk)
+      crc = zlib.crc32(chunk, crc)
+      n_bytes += len(chunk)
+      if level is None:
+        self._enqueue(('data', zinfo, chunk, len(chunk)))
+      else:
+        future = self.executor.submit(_compress_block, chunk, level, dictionary, last)
+        self._enqueue(('data', zinfo, future, len(chunk)))
+        dictionary = chunk[-DICTIONARY_SIZE:]
+      if last:
+        break
+      chunk = next_chunk
+
+    zinfo.CRC = crc
+    zinfo.file_size = n_bytes
+    self._enqueue(('end', zinfo, zip64, 0))
+    if record:
+      self._record(arcname, h, n_bytes)
+    return n_bytes
+
+  def _enqueue(self, item):
+    self._queue.append(item)
+    self._queued_bytes += item[3]
+    while self._queued_bytes > self.max_queued_bytes:
+      self._write_queued()
+
+  def _write_queued(self):
+    """Write the oldest queued item into the archive."""
+    kind, zinfo, value, n_bytes = self._queue.popleft()
+    self._queued_bytes -= n_bytes
+    fp = self.zf.fp
+    if kind == 'start':
+      # placeholder header, rewritten with the sizes at the end of the member
+      fp.seek(self.zf.start_dir)
+      zinfo.header_offset = fp.tell()
+      zinfo.compress_size = 0
+      fp.write(zinfo.FileHeader(value))
+    elif kind == 'data':
+      data = value if isinstance(value, bytes) else value.result()
+      fp.write(data)
+      zinfo.compress_size += len(data)
+    else:
+      if not value and (zinfo.file_size > zipfile.ZIP64_LIMIT
+                        or zinfo.compress_size > zipfile.ZIP64_LIMIT):
+        raise RuntimeError(f'{zinfo.filename} exceeds the size of a member without '
+                           'ZIP64 extensions.')
+      end = fp.tell()
+      fp.seek(zinfo.header_offset)
+      fp.write(zinfo.FileHeader(value))
+      fp.seek(end)
+      self.zf.start_dir = end
+      self.zf.filelist.append(zinfo)
+      self.zf.NameToInfo[zinfo.filename] = zinfo
+      self.zf._didModify = True
+      self.file_size += zinfo.file_size
+      self.compress_size += zinfo.compress_size
+
+  def flush(self):
+    """Write all queued members."""
+    while self._queue:
+      self._write_queued()
+
+  # ---------------------------------------------------------------------------
+  def write_stream(self, arcname, fileobj, mode=0o644, size=None):
+    """Copy a readable binary file object into the wheel."""
+    chunks = iter(lambda: fileobj.read(CHUNK_SIZE), b'')
+    return self._write_chunks(arcname, chunks, mode, size=size)
+
+  def write_bytes(self, arcname, data, mode=0o644):
+    if isinstance(data, str):
+      data = data.encode('utf8')
+    chunks = iter([data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)])
+    return self._write_chunks(arcname, chunks, mode, size=len(data))
+
+  def write_file(self, arcname, filename, mode=None):
+    if mode is None:
+      mode = os.stat(filename).st_mode
+    with open(filename, 'rb') as f:
+      return self.write_stream(arcname, f, mode=mode, size=os.path.getsize(filename))
+
+  def read(self, arcname):
+    """Return the contents of a member that was already written."""
+    self.flush()
+    return self.zf.read(arcname)
+
+  def _record(self, arcname, h, n_bytes):
+    digest = base64.urlsafe_b64encode(h.digest()).rstrip(b'=').decode('ascii')
+    self.records.append(f'{arcname},sha256={digest},{n_bytes}')
+
+  # ---------------------------------------------------------------------------
+  def write_metadata(self, project, root='.'):
+    """Write METADATA, entry_points.txt and the license files."""
+    metadata, license_files = core_metadata(project, root=root)
+    self.write_bytes(f'{self.dist_info}/METADATA', metadata)
+    points = entry_points(project)
+    if points:
+      self.write_bytes(f'{self.dist_info}/entry_points.txt', points)
+    for license_file in license_files:
+      self.write_file(f'{self.dist_info}/licenses/{os.path.relpath(license_file, root)}',
+                      license_file)
+
+  def write_bytecode(self, sources):
+    """Compile (arcname, filename) pairs of modules in a pool of processes
+    and write their .pyc files. The .pyc files are reproducible and are
+    only used while the hash of the source matches, so they stay valid on
+    read-only installations. Modules with syntax errors are skipped and
+    listed in not_compiled."""
+    arcnames = [arcname for arcname, _ in sources]
+    filenames = [str(filename) for _, filename in sources]
+    if self.jobs > 1 and len(sources) > 1:
+      with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+        results = list(executor.map(compile_source, arcnames, filenames,
+                                    chunksize=max(1, len(sources) // (4 * self.jobs))))
+    else:
+      results = list(map(compile_source, arcnames, filenames))
+    for arcname, pyc in zip(arcnames, results):
+      if pyc is None:
+        self.not_compiled.append(arcname)
+        continue
+      self.write_bytes(bytecode_arcname(arcname), pyc)
+      self.compiled += 1
+
+  def write_duplicates(self, duplicates, size=0):
+    """Write the module and .pth file that restore duplicates, a dict of
+    arcnames that were not written to the arcnames of members with the
+    same contents. size is the number of bytes that were not written.
+
+    The duplicates are only restored if the wheel is installed into a site
+    directory, which processes .pth files, with write access to it."""
+    module = f'_{self.name}_duplicates'
+    self.write_bytes(f'{module}.py', DUPLICATES_MODULE % {
+      'dist_info': self.dist_info, 'duplicates': dict(sorted(duplicates.items()))})
+    self.write_bytes(f'{module}.pth', f'import {module}\n')
+    self.duplicates += len(duplicates)
+    self.duplicate_size += size
+
+  def close(self):
+    """Write WHEEL and RECORD and close the archive."""
+    wheel = '\n'.join([
+      'Wheel-Version: 1.0',
+      'Generator: cctbx wheel_writer',
+      'Root-Is-Purelib: false',
+      f'Tag: {self.tag}',
+    ]) + '\n'
+    self.write_bytes(f'{self.dist_info}/WHEEL', wheel)
+    self.records.append(f'{self.dist_info}/RECORD,,')
+    record = ('\n'.join(self.records) + '\n').encode('utf8')
+    self._write_chunks(f'{self.dist_info}/RECORD', iter([record]), 0o644,
+                       size=len(record), record=False)
+    self.flush()
+    self.executor.shutdown()
+    self.zf.close()
+    self.elapsed = time.perf_counter() - self.start_time
+
+  def report(self):
+    """Return a summary of the compression."""
+    ratio = self.compress_size / self.file_size if self.file_size else 1
+    summary = (f'Compressed {self.file_size} bytes to {self.compress_size} bytes '
+               f'({ratio:.1%}) in {self.elapsed:.2f}s with {self.jobs} workers')
+    if self.compiled or self.not_compiled:
+      summary += (f'\nCompiled {self.compiled} modules, {len(self.not_compiled)} '
+                  'could not be compiled')
+    if self.duplicates:
+      summary += (f'\nDeduplicated {self.duplicates} files, {self.duplicate_size} '
+                  'bytes were not written')
+    return summary